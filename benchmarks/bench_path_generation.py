@@ -0,0 +1,79 @@
+"""
+    Compares the closed form path generation in stock_price.iter_scenarios against the original
+    per-step loop with the legacy global random generator.
+
+    Example: python benchmarks/bench_path_generation.py --sizes 1000 100000 10000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'sample'))
+from constants_company_plans import cvs_stock_plan
+from constants_company_stock_start_parameters import cvs_stock_params
+
+from models.company_plan import CompanyStockPlan
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from stock_price import iter_scenarios
+
+
+def legacy_generate(
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    simulations: int
+) -> np.ndarray:
+    """
+        The original generate_scenarios loop, kept here as the baseline.
+    """
+    time_frame = 1
+    steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
+    dt = time_frame / steps
+
+    prices = np.zeros((simulations, steps + 1))
+    prices[:, 0] = company_stock_start_parameters.initial_price
+
+    for t in range(1, steps + 1):
+        z = np.random.standard_normal(simulations)
+        prices[:, t] = (
+            prices[:, t - 1] *
+            np.exp(
+                (company_stock_start_parameters.expected_rate_of_return - 0.5 * company_stock_start_parameters.volatility**2) * dt +
+                company_stock_start_parameters.volatility * np.sqrt(dt) * z
+            )
+        )
+    return prices
+
+
+def time_call(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def consume(blocks) -> None:
+    for _ in blocks:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument('--chunk-size', type=int, default=100_000)
+    parser.add_argument('--legacy-max', type=int, default=10_000_000,
+                        help='Skip the legacy loop above this many paths, it needs the full matrix in memory')
+    args = parser.parse_args()
+
+    print(f'{"paths":>12} {"legacy s":>10} {"float64 s":>10} {"float32 s":>10} {"speedup 64":>11} {"speedup 32":>11}')
+    for size in args.sizes:
+        legacy = time_call(lambda: legacy_generate(cvs_stock_plan, cvs_stock_params, size)) if size <= args.legacy_max else float('nan')
+        fast_64 = time_call(lambda: consume(iter_scenarios(cvs_stock_plan, cvs_stock_params, size, args.chunk_size, seed=0)))
+        fast_32 = time_call(lambda: consume(iter_scenarios(cvs_stock_plan, cvs_stock_params, size, args.chunk_size, seed=0, dtype=np.float32)))
+        print(f'{size:>12} {legacy:>10.3f} {fast_64:>10.3f} {fast_32:>10.3f} {legacy / fast_64:>10.1f}x {legacy / fast_32:>10.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+    Benchmarks the stages of the simulation pipeline over a range of path counts, reporting paths per second and
+    peak memory, and compares them against a saved JSON baseline.
+
+    Example:
+        python benchmarks/bench_pipeline.py --save benchmarks/baselines/pipeline.json
+        python benchmarks/bench_pipeline.py --compare benchmarks/baselines/pipeline.json
+
+    Benchmarks:
+        generate_scenarios: Simulating and saving the price paths
+        scenario_run[strategy]: ESPPScenarioRun.run over every path, one path at a time
+        batch_run[strategy]: run_strategy over every path with the batch engine
+        result_add: ESPPResult.add of one path's result at a time
+        roi_chart: save_roi_distribution_chart of the paths' ROI
+        end_to_end: run_strategies_against_scenarios with every strategy
+
+    Each benchmark is timed on its own, as the best of up to --repeat runs when a run is quick, and then run once
+    more under tracemalloc for its peak memory, so tracing doesn't slow down the timed runs. Baselines are machine
+    specific, save one per machine and compare on the same machine.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing as t
+from datetime import datetime
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'sample'))
+from constants_company_plans import cvs_stock_plan
+from constants_company_stock_start_parameters import cvs_stock_params
+from constants_employee_options import cvs_employee_options
+
+from charts import save_roi_distribution_chart
+from espp_scenario_run import ESPPScenarioRun
+from models.espp_result import ESPPResult
+from stock_price import generate_scenario_rows, generate_scenarios, run_strategies_against_scenarios, run_strategy
+import strategies
+
+BASELINE_VERSION = 1
+
+# Repeats stop once a benchmark has run for this many seconds in total
+_MIN_REPEAT_SECONDS = 1.0
+
+
+class Benchmark(t.NamedTuple):
+    name: str
+    # Builds the function to time for a price matrix, outside of the timing
+    setup: t.Callable[[np.ndarray], t.Callable[[], t.Any]]
+    scalar: bool = False
+
+
+def _generate_scenarios(prices: np.ndarray) -> t.Callable[[], t.Any]:
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            generate_scenarios(cvs_stock_plan, cvs_stock_params, os.path.join(directory, 'prices'), prices.shape[0], seed=0)
+    return run
+
+
+def _scenario_run(func: t.Dict[str, t.Any]) -> t.Callable[[np.ndarray], t.Callable[[], t.Any]]:
+    def setup(prices: np.ndarray) -> t.Callable[[], t.Any]:
+        def run():
+            for price in prices:
+                ESPPScenarioRun(price, cvs_employee_options, func["strategy"]).run()
+        return run
+    return setup
+
+
+def _batch_run(func: t.Dict[str, t.Any]) -> t.Callable[[np.ndarray], t.Callable[[], t.Any]]:
+    def setup(prices: np.ndarray) -> t.Callable[[], t.Any]:
+        return lambda: run_strategy(prices, cvs_employee_options, func)
+    return setup
+
+
+def _result_add(prices: np.ndarray) -> t.Callable[[], t.Any]:
+    # The results of a few paths, added over and over, so only ESPPResult.add is timed
+    path_results = [
+        ESPPScenarioRun(price, cvs_employee_options, strategies.maximize_for_large_periods).run()
+        for price in prices[:100]
+    ]
+    def run():
+        espp_result = ESPPResult(capacity=prices.shape[0])
+        for path in range(prices.shape[0]):
+            espp_result.add(path_results[path % len(path_results)])
+    return run
+
+
+def _roi_chart(prices: np.ndarray) -> t.Callable[[], t.Any]:
+    roi = run_strategy(prices, cvs_employee_options, strategies.get_all_strategies()[-1]).roi
+    return lambda: save_roi_distribution_chart("benchmark", roi, cvs_employee_options)
+
+
+def _end_to_end(prices: np.ndarray) -> t.Callable[[], t.Any]:
+    def run():
+        # run_strategies_against_scenarios prints its estimates
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_strategies_against_scenarios(prices, cvs_employee_options)
+    return run
+
+
+def all_benchmarks() -> t.List[Benchmark]:
+    functions = strategies.get_all_strategies()
+    return (
+        [Benchmark("generate_scenarios", _generate_scenarios)]
+        + [Benchmark(f"scenario_run[{func['name']}]", _scenario_run(func), scalar=True) for func in functions]
+        + [Benchmark(f"batch_run[{func['name']}]", _batch_run(func)) for func in functions]
+        + [
+            Benchmark("result_add", _result_add, scalar=True),
+            Benchmark("roi_chart", _roi_chart),
+            Benchmark("end_to_end", _end_to_end)
+        ]
+    )
+
+
+def measure(run: t.Callable[[], t.Any], repeat: int) -> t.Tuple[float, int]:
+    """
+        Best time of up to repeat runs, and the peak traced memory of one more run.
+    """
+    times = []
+    while len(times) < repeat and sum(times) < _MIN_REPEAT_SECONDS:
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run_benchmarks(
+    sizes: t.Sequence[int],
+    names: t.Optional[t.Sequence[str]] = None,
+    repeat: int = 3,
+    scalar_max: int = 100_000
+) -> t.Dict[str, t.Any]:
+    benchmarks = [
+        benchmark for benchmark in all_benchmarks()
+        if names is None or any(benchmark.name == name or benchmark.name.startswith(f"{name}[") for name in names)
+    ]
+    results: t.Dict[str, t.Dict[str, t.Dict[str, float]]] = {}
+    width = max([len(benchmark.name) for benchmark in benchmarks] + [len("benchmark")])
+    print(f'{"benchmark":<{width}} {"paths":>9} {"time":>12} {"throughput":>22} {"peak memory":>14}')
+    for size in sizes:
+        prices = generate_scenario_rows(cvs_stock_plan, cvs_stock_params, 0, size, 0)
+        for benchmark in benchmarks:
+            # The one path at a time loops take minutes at a million paths
+            if benchmark.scalar and size > scalar_max:
+                continue
+            seconds, peak = measure(benchmark.setup(prices), repeat)
+            results.setdefault(benchmark.name, {})[str(size)] = {
+                "seconds": seconds,
+                "paths_per_second": size / seconds,
+                "peak_memory_bytes": peak
+            }
+            print(f'{benchmark.name:<{width}} {size:>9} {seconds:>10.4f} s {size / seconds:>14,.0f} paths/s {peak / 2**20:>10.1f} MiB', flush=True)
+        del prices
+
+    return {
+        "version": BASELINE_VERSION,
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__
+        },
+        "results": results
+    }
+
+
+def compare(
+    current: t.Dict[str, t.Any],
+    baseline: t.Dict[str, t.Any],
+    tolerance: float = 0.2,
+    memory_tolerance: float = 0.2
+) -> t.List[str]:
+    """
+        Regressions of current against baseline: benchmarks whose paths per second dropped by more than tolerance,
+        or whose peak memory grew by more than memory_tolerance. Only sizes measured in both are compared.
+    """
+    regressions = []
+    for name, sizes in current["results"].items():
+        for size, measured in sizes.items():
+            expected = baseline["results"].get(name, {}).get(size)
+            if expected is None:
+                continue
+            speed = measured["paths_per_second"] / expected["paths_per_second"]
+            memory = measured["peak_memory_bytes"] / max(expected["peak_memory_bytes"], 1)
+            if speed < 1 - tolerance:
+                regressions.append(f'{name} at {size} paths: {speed:.0%} of the baseline paths/s')
+            if memory > 1 + memory_tolerance:
+                regressions.append(f'{name} at {size} paths: {memory:.0%} of the baseline peak memory')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--benchmarks', nargs='+', help='Only run these benchmarks, e.g. batch_run end_to_end')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scalar-max', type=int, default=100_000,
+                        help='Skip the one path at a time benchmarks above this many paths')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against this JSON baseline, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed drop in paths per second')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='Allowed growth in peak memory')
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.sizes, args.benchmarks, args.repeat, args.scalar_max)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as baseline_file:
+            json.dump(current, baseline_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(current, baseline, args.tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline')
+
+
+if __name__ == "__main__":
+    main()
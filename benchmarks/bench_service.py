@@ -0,0 +1,93 @@
+"""
+    Latency of SimulationService under many concurrent small requests, with and without batching.
+
+    Example:
+        python benchmarks/bench_service.py --requests 2000 --concurrency 200
+
+    Each request runs one strategy for one of --employees different EmployeeOptions, with max contributions and
+    capital gains tax rates varying between employees, against the warm matrix of the sample stock. Without batching
+    every request is sent to the process pool on its own (max_batch_size=1).
+"""
+import argparse
+import asyncio
+import copy
+import os
+import sys
+import time
+import typing as t
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'sample'))
+from constants_employee_options import cvs_employee_options
+
+from models.employee_options import EmployeeOptions
+from simulation_service import SimulationService
+
+
+def employees(count: int) -> t.List[EmployeeOptions]:
+    options = []
+    for employee in range(count):
+        employee_options = copy.deepcopy(cvs_employee_options)
+        employee_options.max_contribution = 500 + 500 * (employee % 4)
+        employee_options.capital_gains_tax_rate = (0.15, 0.2, 0.24)[employee % 3]
+        options.append(employee_options)
+    return options
+
+
+async def measure(
+    service: SimulationService,
+    options: t.List[EmployeeOptions],
+    requests: int,
+    concurrency: int,
+    strategy: str
+) -> t.Tuple[float, np.ndarray]:
+    """
+        Wall seconds of every request and each request's latency, with at most concurrency requests in flight.
+    """
+    # Warm the matrix and the workers, so the first requests don't pay for them
+    await asyncio.gather(*(service.simulate(employee_options, [strategy]) for employee_options in options[:service.workers]))
+
+    latencies = np.empty(requests)
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def request(index: int) -> None:
+        async with in_flight:
+            start = time.perf_counter()
+            await service.simulate(options[index % len(options)], [strategy])
+            latencies[index] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(requests)))
+    return time.perf_counter() - start, latencies
+
+
+async def run(args: argparse.Namespace) -> None:
+    options = employees(args.employees)
+    print(f'{"mode":<12} {"requests/s":>12} {"p50 ms":>10} {"p99 ms":>10} {"batches":>9} {"engine runs":>12}')
+    for mode, max_batch_size in (("unbatched", 1), ("batched", args.max_batch_size)):
+        async with SimulationService(args.simulations, workers=args.workers, batch_window=args.batch_window, max_batch_size=max_batch_size) as service:
+            seconds, latencies = await measure(service, options, args.requests, args.concurrency, args.strategy)
+            statistics = service.statistics
+        print(
+            f'{mode:<12} {args.requests / seconds:>12,.0f} {np.percentile(latencies, 50) * 1000:>10.1f} '
+            f'{np.percentile(latencies, 99) * 1000:>10.1f} {statistics.batches:>9} {statistics.engine_runs:>12}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--employees', type=int, default=50)
+    parser.add_argument('--simulations', type=int, default=10_000)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--batch-window', type=float, default=0.002)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--strategy', default="Maximize for large periods")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+    Estimates the CompanyStockStartParameters of every company in a plan catalog at once, from monthly prices.
+
+        table = estimate_capm_table(tickers, monthly_prices, spy_monthly_prices, risk_free_rate=0.04, market_return=0.1)
+        table.to_csv("capm")
+        start_parameters = CapmTable.from_csv("capm.csv").start_parameters()
+
+    Expected returns come from CAPM with betas from stock_calculations.capm_betas, and volatilities are the
+    annualized standard deviation of the monthly returns over the same months. A calibrated volatility, see
+    volatility_surface, can replace the historical one.
+"""
+import csv
+import typing as t
+
+import numpy as np
+
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from stock_calculations import capm_betas
+
+CAPM_COLUMNS = ("ticker", "initial_price", "beta", "expected_rate_of_return", "volatility")
+
+
+class CapmTable():
+    """
+        One row per ticker with CAPM_COLUMNS.
+    """
+    def __init__(self, rows: t.Optional[t.List[t.Dict[str, t.Any]]] = None):
+        self.columns = CAPM_COLUMNS
+        self.rows = rows if rows is not None else []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def column(self, name: str) -> t.List[t.Any]:
+        return [row[name] for row in self.rows]
+
+    def start_parameters(self) -> t.Dict[str, CompanyStockStartParameters]:
+        return {
+            row["ticker"]: CompanyStockStartParameters(
+                initial_price=row["initial_price"],
+                expected_rate_of_return=row["expected_rate_of_return"],
+                volatility=row["volatility"]
+            )
+            for row in self.rows
+        }
+
+    def to_csv(self, file_name: str) -> str:
+        path = file_name if file_name.endswith('.csv') else f'{file_name}.csv'
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
+        return path
+
+    @classmethod
+    def from_csv(cls, file_name: str) -> 'CapmTable':
+        with open(file_name, newline='') as csv_file:
+            return cls([
+                {name: row[name] if name == "ticker" else float(row[name]) for name in CAPM_COLUMNS}
+                for row in csv.DictReader(csv_file)
+            ])
+
+
+def estimate_capm_table(
+    tickers: t.Sequence[str],
+    stock_prices: np.ndarray,
+    spy_prices: np.ndarray,
+    risk_free_rate: float,
+    market_return: float,
+    window: t.Optional[int] = None
+) -> CapmTable:
+    """
+        stock_prices: (tickers, months) monthly prices, in the order of tickers
+        spy_prices: (months,) monthly prices of SPY
+        window: Estimate from only the most recent window monthly returns instead of all of them.
+            capm_betas(stock_prices, spy_prices, window) gives the betas of every window.
+    """
+    stock_prices = np.atleast_2d(np.asarray(stock_prices, dtype=float))
+    if stock_prices.shape[0] != len(tickers):
+        raise ValueError(f"{len(tickers)} tickers but prices for {stock_prices.shape[0]}")
+    if window is not None:
+        stock_prices = stock_prices[:, -(window + 1):]
+        spy_prices = np.asarray(spy_prices)[-(window + 1):]
+
+    betas = capm_betas(stock_prices, spy_prices)
+    expected_returns = risk_free_rate + betas * (market_return - risk_free_rate)
+    monthly_returns = np.diff(stock_prices, axis=1) / stock_prices[:, :-1]
+    volatilities = monthly_returns.std(axis=1, ddof=1) * np.sqrt(12)
+
+    return CapmTable([
+        {
+            "ticker": ticker,
+            "initial_price": float(initial_price),
+            "beta": float(beta),
+            "expected_rate_of_return": float(expected_return),
+            "volatility": float(volatility)
+        }
+        for ticker, initial_price, beta, expected_return, volatility
+        in zip(tickers, stock_prices[:, -1], betas, expected_returns, volatilities)
+    ])
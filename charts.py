@@ -1,43 +1,92 @@
+"""
+    ROI distribution charts.
+
+    Charts are drawn in two steps: roi_histogram reduces a strategy's ROI values to the few numbers a chart shows,
+    and render_roi_histogram draws a RoiHistogram to a PNG. Bulk runs can keep only the histograms and render
+    the PNGs later, on demand with LazyChart, or for many strategies at once with render_charts.
+"""
+import concurrent.futures
 import io
 import math
 import typing as t
+from dataclasses import dataclass
 
 import cairo
 import numpy as np
 
 from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
 
-def save_roi_distribution_chart(function_name: str, roi_list: t.List[float], employee_options: EmployeeOptions, save: bool = False, top_value: t.Optional[t.SupportsFloat] = None) -> bytes:
-    # Set up the surface and context
-    width, height = 800, 600
-    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-    ctx = cairo.Context(surface)
-    
-    # Set white background
-    ctx.set_source_rgb(1, 1, 1)
-    ctx.paint()
+# 11 bins, with the 2nd bin being the discount rate
+ROI_CHART_BINS = 11
+CHART_WIDTH, CHART_HEIGHT = 800, 600
+CHART_FORMATS = ("png", "svg", "pdf")
 
-    minim=0
-    # 11 bins, with the 2nd bin being the discount rate
-    # Adjusted to this random formula
+
+@dataclass
+class RoiHistogram:
+    """
+        The data of an ROI distribution chart. counts has one entry per bin over (0, maximum), with ROI below 0
+        counted in the first bin and ROI above maximum in the last. runs is the number of ROI values counted.
+    """
+    function_name: str
+    counts: np.ndarray
+    maximum: float
+    runs: int
+
+
+def chart_top_value(roi: t.Sequence[float]) -> float:
+    """
+        The default right edge of the chart, three standard deviations above the mean ROI.
+        Adjusted to this random formula.
+    """
+    return round(float(np.mean(roi)) + (float(np.std(roi)) * 3), 2)
+
+
+def roi_histogram(function_name: str, roi: t.Sequence[float], top_value: t.Optional[t.SupportsFloat] = None) -> RoiHistogram:
+    """
+        Histogram of the ROI values for a chart. roi is not modified.
+    """
+    roi = np.asarray(roi, dtype=float)
+    maximum = chart_top_value(roi) if top_value is None else float(top_value)
+    # Values below 0 are counted as 0 and values above the top as just under it, on a copy
+    clamped = np.clip(roi, 0, None)
+    clamped = np.where(roi > maximum, maximum - 0.01, clamped)
+    counts, _ = np.histogram(clamped, bins=ROI_CHART_BINS, range=(0, maximum))
+    return RoiHistogram(function_name=function_name, counts=counts, maximum=maximum, runs=roi.shape[0])
+
+
+def streaming_roi_histogram(function_name: str, espp_result: ESPPResult, top_value: t.Optional[t.SupportsFloat] = None) -> RoiHistogram:
+    """
+        Chart histogram of a streaming ESPPResult, which only keeps a fine histogram of roi. The chart bin edges
+        rarely line up with the fine bins, so the fine bins are assumed to be evenly filled and split between
+        chart bins by overlap. Counts can differ from the exact histogram by a few values per fine bin.
+    """
     if top_value is None:
-        maxim=round(
-            np.mean(roi_list) + (np.std(roi_list) * 3)
-            , 2
-        )   
+        maximum = round(espp_result.mean("roi") + espp_result.std("roi") * 3, 2)
     else:
-        maxim=top_value
-    
-    # Calculate histogram data
-    for i in range(len(roi_list)):
-        if roi_list[i] < 0:
-            roi_list[i] = 0
-        elif roi_list[i] > maxim:
-            roi_list[i] = maxim-0.01
-    bins = 11 # int((maxim - minim) / 0.05)
-
-    hist, bin_edges = np.histogram(roi_list, bins=bins, range=(minim, maxim))
-    
+        maximum = float(top_value)
+    # Number of values below each fine bin edge, interpolated at the chart bin edges
+    below_edges = espp_result.roi_histogram_below + np.concatenate([[0], np.cumsum(espp_result.roi_histogram)])
+    chart_edges = np.linspace(0, maximum, ROI_CHART_BINS + 1)
+    below_chart_edges = np.round(np.interp(chart_edges, espp_result.roi_histogram_edges, below_edges)).astype(np.int64)
+
+    counts = np.diff(below_chart_edges)
+    # ROI below 0 is counted in the first bin and above the top in the last, as in roi_histogram
+    counts[0] += below_chart_edges[0]
+    counts[-1] += espp_result.size - below_chart_edges[-1]
+    return RoiHistogram(function_name=function_name, counts=counts, maximum=maximum, runs=espp_result.size)
+
+
+def _draw_roi_histogram(ctx: cairo.Context, histogram: RoiHistogram, width: float, height: float, title: str = "ROI Distribution") -> None:
+    """
+        Draws the chart into the width x height area at the context's origin.
+    """
+    minim = 0
+    maxim = histogram.maximum
+    hist = histogram.counts
+    bins = hist.shape[0]
+
     # Set up the plot area
     margin = 70
     plot_width = width - 2 * margin
@@ -55,7 +104,7 @@ def save_roi_distribution_chart(function_name: str, roi_list: t.List[float], emp
     # Draw histogram bars
     bar_width = plot_width / bins
     max_count = max(500, max(hist))
-    
+
     for i, count in enumerate(hist):
         # Calculate bar height
         bar_height = (count / max_count) * plot_height
@@ -83,7 +132,6 @@ def save_roi_distribution_chart(function_name: str, roi_list: t.List[float], emp
     ctx.set_font_size(24)
     
     # Title
-    title = f"ROI Distribution"
     text_extents = ctx.text_extents(title)
     ctx.move_to(width/2 - text_extents.width/2, margin/2)
     ctx.show_text(title)
@@ -96,7 +144,7 @@ def save_roi_distribution_chart(function_name: str, roi_list: t.List[float], emp
     ctx.show_text(x_label)
     
     # Y-axis label
-    y_label = f"Frequency in {len(roi_list)} runs"
+    y_label = f"Frequency in {histogram.runs} runs"
     ctx.save()
     ctx.translate(margin/2 - 10, height/2)  # Add more padding by subtracting 20 from margin/2
     ctx.rotate(-math.pi/2)
@@ -147,18 +195,135 @@ def save_roi_distribution_chart(function_name: str, roi_list: t.List[float], emp
         ctx.set_font_size(16)
         ctx.move_to(margin - text_extents.width - 5, y + text_extents.height/2)
         ctx.show_text(label)
-    
+
+
+def render_roi_histogram(histogram: RoiHistogram, save: bool = False) -> bytes:
+    """
+        Draws a chart to an 800x600 PNG and returns its bytes. With save it is also written to
+        {function_name}_roi_distribution.png.
+    """
+    # Set up the surface and context
+    width, height = CHART_WIDTH, CHART_HEIGHT
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+
+    # Set white background
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.paint()
+
+    _draw_roi_histogram(ctx, histogram, width, height)
+
     # Save the surface to a file
     if save:
-        surface.write_to_png(f'{function_name}_roi_distribution.png')
-    
+        surface.write_to_png(f'{histogram.function_name}_roi_distribution.png')
+
     # Get the PNG data as bytes
     png_data = io.BytesIO()
     surface.write_to_png(png_data)
     png_bytes = png_data.getvalue()
-    
+
     # Clean up
     surface.finish()
     png_data.close()
-    
+
     return png_bytes
+
+
+def render_roi_histogram_grid(
+    histograms: t.Sequence[RoiHistogram],
+    chart_format: str = "png",
+    columns: t.Optional[int] = None,
+    save: bool = False,
+    file_name: str = "roi_distributions"
+) -> bytes:
+    """
+        Draws the charts of many strategies into one document and encodes it once, with each chart titled by its
+        function name. Pass histograms computed with the same top_value so the panels share the ROI axis.
+
+        chart_format:
+            "png", "svg": One image with a grid of 800x600 panels, columns wide (about square by default).
+            "pdf": One 800x600 page per strategy, written page by page.
+        With save the document is also written to {file_name}.{chart_format}.
+    """
+    if chart_format not in CHART_FORMATS:
+        raise ValueError(f"unknown chart format {chart_format}, expected one of {', '.join(CHART_FORMATS)}")
+    if columns is None:
+        columns = max(math.ceil(math.sqrt(len(histograms))), 1)
+    rows = max(math.ceil(len(histograms) / columns), 1)
+
+    document = io.BytesIO()
+    if chart_format == "pdf":
+        surface = cairo.PDFSurface(document, CHART_WIDTH, CHART_HEIGHT)
+    elif chart_format == "svg":
+        surface = cairo.SVGSurface(document, CHART_WIDTH * columns, CHART_HEIGHT * rows)
+    else:
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, CHART_WIDTH * columns, CHART_HEIGHT * rows)
+    ctx = cairo.Context(surface)
+
+    for index, histogram in enumerate(histograms):
+        ctx.save()
+        if chart_format != "pdf":
+            ctx.translate((index % columns) * CHART_WIDTH, (index // columns) * CHART_HEIGHT)
+        # White background of the panel
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.rectangle(0, 0, CHART_WIDTH, CHART_HEIGHT)
+        ctx.fill()
+        _draw_roi_histogram(ctx, histogram, CHART_WIDTH, CHART_HEIGHT, histogram.function_name)
+        ctx.restore()
+        if chart_format == "pdf":
+            ctx.show_page()
+
+    if chart_format == "png":
+        surface.write_to_png(document)
+    # Vector surfaces write the rest of the document to the stream when finished
+    surface.finish()
+    document_bytes = document.getvalue()
+    document.close()
+
+    if save:
+        with open(f'{file_name}.{chart_format}', 'wb') as document_file:
+            document_file.write(document_bytes)
+    return document_bytes
+
+
+class LazyChart():
+    """
+        A chart that is only rendered when its png is first read, then kept.
+    """
+    def __init__(self, histogram: RoiHistogram, png: t.Optional[bytes] = None):
+        self.histogram = histogram
+        self._png = png
+
+    @property
+    def png(self) -> bytes:
+        if self._png is None:
+            self._png = render_roi_histogram(self.histogram)
+        return self._png
+
+    @property
+    def rendered(self) -> bool:
+        return self._png is not None
+
+
+def render_charts(
+    histograms: t.Sequence[RoiHistogram],
+    workers: t.Optional[int] = None,
+    processes: bool = False
+) -> t.List[bytes]:
+    """
+        Renders many charts at once, returning the PNGs in order. Charts are independent, so they are drawn in
+        a thread pool, or a process pool with processes=True when the cairo build holds the GIL while drawing.
+        workers=1 renders in this thread.
+    """
+    if workers == 1 or len(histograms) <= 1:
+        return [render_roi_histogram(histogram) for histogram in histograms]
+    executor_type = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    with executor_type(max_workers=workers) as executor:
+        return list(executor.map(render_roi_histogram, histograms))
+
+
+def save_roi_distribution_chart(function_name: str, roi_list: t.Sequence[float], employee_options: EmployeeOptions, save: bool = False, top_value: t.Optional[t.SupportsFloat] = None) -> bytes:
+    """
+        Draws the ROI distribution of a strategy to a PNG and returns its bytes. roi_list is not modified.
+    """
+    return render_roi_histogram(roi_histogram(function_name, roi_list, top_value), save)
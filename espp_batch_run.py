@@ -0,0 +1,235 @@
+import copy
+import typing as t
+
+import numpy as np
+
+from constants import MAX_PRICE_IRS
+from models.espp_batch_state import ESPPBatchState
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+from models.plan_schedule import plan_schedule
+import profiling
+
+class ESPPBatchRun():
+    """
+        Vectorized version of ESPPScenarioRun. Instead of walking a single price path, it takes the whole
+        (simulations, steps + 1) price matrix and advances every path one period at a time with numpy arrays.
+
+        The step function receives an ESPPBatchState and must return an array with one contribution per path.
+        The results match ESPPScenarioRun run over each row of the price matrix.
+
+        With keep_snapshots, the state of every path is copied at each offering boundary and at the end of the run,
+        so rerun can evaluate changed options without replaying the periods they don't affect.
+    """
+    # Options only used to compute the results from the final state, changing them never needs a replay
+    POST_PROCESSING_OPTIONS = ("capital_gains_tax_rate",)
+
+    def __init__(
+        self,
+        scenarios: np.ndarray,
+        strategy: EmployeeOptions,
+        step_function: t.Callable[[EmployeeOptions, ESPPBatchState], np.ndarray],
+        block_size: int = 8192,
+        keep_snapshots: bool = False
+    ):
+        """
+            block_size is the number of price paths advanced together. Paths are independent, so the block size
+            does not change the results, but blocks that fit in the CPU cache run noticeably faster than one huge block.
+
+            keep_snapshots keeps a copy of the state for every offering boundary, which takes about as much memory
+            as the contributions of every path times the number of offering periods.
+        """
+        self.scenarios = np.atleast_2d(scenarios)
+        self.strategy = strategy
+        self.step_function = step_function
+        self.block_size = max(int(block_size), 1)
+        self.keep_snapshots = keep_snapshots
+        self.state = ESPPBatchState(0, self.scenarios.shape[1])
+        # Per block, the state at the start of each offering boundary period, keyed by period
+        self.snapshots: t.List[t.Dict[int, ESPPBatchState]] = []
+        # Per block, the state after the last period
+        self.final_states: t.List[ESPPBatchState] = []
+
+    def run(self) -> ESPPResult:
+        """
+            Run the ESPP scenarios with the given strategy and state
+
+            Returns an ESPPResult with one entry per price path
+        """
+        self.snapshots = []
+        self.final_states = []
+        results = []
+        for start in range(0, self.scenarios.shape[0], self.block_size):
+            self.state = ESPPBatchState(min(self.block_size, self.scenarios.shape[0] - start), self.scenarios.shape[1])
+            if self.keep_snapshots:
+                self.snapshots.append({})
+            results.append(self._run_block(self.scenarios[start:start + self.block_size]))
+            if self.keep_snapshots:
+                self.final_states.append(copy.deepcopy(self.state))
+        return ESPPResult.concat(results)
+
+    def rerun(
+        self,
+        employee_options: EmployeeOptions,
+        step_function: t.Optional[t.Callable[[EmployeeOptions, ESPPBatchState], np.ndarray]] = None,
+        from_period: int = 0
+    ) -> ESPPResult:
+        """
+            Results for changed options or a changed step function, reusing the snapshots of the last run.
+            The snapshots are not changed, so several changes can be tried against the same run.
+
+            from_period is the first period whose contributions or purchases the change can affect. The run resumes
+            from the last offering boundary snapshot at or before it, instead of replaying every pay period.
+            If only POST_PROCESSING_OPTIONS changed, such as the capital gains tax rate, nothing is replayed and the
+            results are computed from the final states. from_period is not checked, a period after the first one
+            the change affects gives wrong results.
+        """
+        if not self.keep_snapshots or len(self.final_states) * self.block_size < self.scenarios.shape[0]:
+            raise RuntimeError("rerun needs a completed run with keep_snapshots=True")
+        step_function = step_function if step_function is not None else self.step_function
+
+        if step_function is self.step_function and self._only_post_processing_changed(employee_options):
+            return ESPPResult.concat(self._result(state, employee_options) for state in self.final_states)
+
+        results = []
+        for block, start in enumerate(range(0, self.scenarios.shape[0], self.block_size)):
+            snapshot_periods = [period for period in self.snapshots[block] if period <= from_period]
+            if snapshot_periods:
+                start_period = max(snapshot_periods)
+                state = copy.deepcopy(self.snapshots[block][start_period])
+            else:
+                start_period = 0
+                state = ESPPBatchState(min(self.block_size, self.scenarios.shape[0] - start), self.scenarios.shape[1])
+            rerun = ESPPBatchRun(self.scenarios[start:start + self.block_size], employee_options, step_function, self.block_size)
+            rerun.state = state
+            results.append(rerun._run_block(rerun.scenarios, start_period))
+        return ESPPResult.concat(results)
+
+    def _only_post_processing_changed(self, employee_options: EmployeeOptions) -> bool:
+        current = self.strategy.to_dict()
+        changed = employee_options.to_dict()
+        return all(current[key] == changed[key] for key in current if key not in self.POST_PROCESSING_OPTIONS)
+
+    def _run_block(self, scenarios: np.ndarray, start_period: int = 0) -> ESPPResult:
+        schedule = plan_schedule(self.strategy, self.state.total_periods)
+        # Set on every block, a state resumed from a snapshot may have been run with other options
+        self.state.schedule = schedule
+
+        # The stages are only wrapped with timers while profiling
+        profile = profiling.active_profile()
+        compound_held_money = profiling.instrument(profile, "compounding", self.state.compound_held_money)
+        purchase = profiling.instrument(profile, "purchase", self._purchase)
+        step_function = profiling.instrument(profile, "strategy", self.step_function)
+        update_contributions_and_uninvested = profiling.instrument(profile, "contributions", self.state.update_contributions_and_uninvested)
+
+        for period in range(start_period, self.state.total_periods):
+            # Everything up to here only depends on the prices before this offering boundary
+            if self.keep_snapshots and schedule.purchase_period[period]:
+                self.snapshots[-1][period] = copy.deepcopy(self.state)
+
+            stock_price = scenarios[:, period]
+
+            self.state.period = period
+            self.state.current_stock_price = stock_price
+
+            # Compound the money that is not invested
+            if schedule.held_money_growth is not None:
+                compound_held_money(schedule.held_money_growth)
+
+            # If the period is the end of an offering period, purchase shares
+            if schedule.purchase_period[period]:
+                purchase_mask = self.state.dollars_ready_for_purchase != 0
+                if purchase_mask.any():
+                    purchase(purchase_mask, stock_price, schedule.max_pay_in)
+
+            # break out of loop once the last purchase has occured
+            if period == self.state.total_periods - 1:
+                break
+
+            # Reset the IRS grant price at the beginning of each offering period, after shares are purchased
+            if schedule.offering_start[period]:
+                self.state.last_grant_price = stock_price.copy()
+
+            contribution = np.broadcast_to(
+                np.asarray(step_function(self.strategy, self.state), dtype=float),
+                (self.state.simulations,)
+            )
+            uninvested_money = self.strategy.max_contribution - contribution
+
+            update_contributions_and_uninvested(contribution, uninvested_money, self.strategy)
+
+        return self._result(self.state, self.strategy)
+
+    def _purchase(self, purchase_mask: np.ndarray, stock_price: np.ndarray, company_max_value: float) -> None:
+        """
+            Buys shares for every path in purchase_mask, applying the IRS and company caps the same way
+            ESPPScenarioRun does for a single path.
+        """
+        state = self.state
+        dollars_ready = state.dollars_ready_for_purchase
+
+        # Stock purchase price = floor of current price, price at the beginning of the offering period
+        if self.strategy.company_stock_plan.allows_lookback:
+            stock_purchase_price = np.minimum(stock_price, state.last_grant_price) * self.strategy.company_stock_plan.discount_rate
+        else:
+            stock_purchase_price = stock_price * self.strategy.company_stock_plan.discount_rate
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # How many shares can you purchase with no limit
+            shares_purchased_in_period = dollars_ready / stock_purchase_price
+
+            # How many shares can you purchase with IRS limits
+            cap_hit_irs = purchase_mask & ((state.irs_purchased_value + (state.last_grant_price * shares_purchased_in_period)) > MAX_PRICE_IRS)
+            shares_purchased_in_period_irs = (MAX_PRICE_IRS - state.irs_purchased_value) / state.last_grant_price
+            leftover_cash_irs = dollars_ready - (shares_purchased_in_period_irs * stock_purchase_price)
+
+            # How many shares can you purchase with Stock limits
+            cap_hit_company = purchase_mask & ((state.espp_dollar_value + (stock_purchase_price * shares_purchased_in_period)) > company_max_value)
+            shares_purchased_in_period_company = (company_max_value - state.espp_dollar_value) / state.last_grant_price
+            leftover_cash_company = dollars_ready - (shares_purchased_in_period_company * stock_purchase_price)
+
+        # If a cap hit, choose the smaller of the caps to apply.
+        use_irs = cap_hit_irs & ~(cap_hit_company & ~(shares_purchased_in_period_irs < shares_purchased_in_period_company))
+        use_company = cap_hit_company & ~use_irs
+
+        shares_purchased_in_period = np.where(use_irs, shares_purchased_in_period_irs, shares_purchased_in_period)
+        shares_purchased_in_period = np.where(use_company, shares_purchased_in_period_company, shares_purchased_in_period)
+        shares_purchased_in_period = np.where(purchase_mask, shares_purchased_in_period, 0.0)
+
+        leftover_cash = np.where(use_irs, leftover_cash_irs, 0.0)
+        leftover_cash = np.where(use_company, leftover_cash_company, leftover_cash)
+
+        state.update_stock_values_after_purchase(purchase_mask, shares_purchased_in_period, leftover_cash, stock_price, self.strategy)
+
+    @staticmethod
+    def _result(state: ESPPBatchState, employee_options: EmployeeOptions) -> ESPPResult:
+        max_contribution = employee_options.max_contribution
+
+        espp_net_value = np.where(state.total_contributed != 0, state.espp_dollar_value - state.total_contributed, 0.0)
+
+        if not employee_options.ignore_liquidity_preference:
+            roi_denominator = np.full(state.simulations, float(max_contribution * (state.total_periods - 1)))
+        else:
+            roi_denominator = state.total_contributed
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            espp_return = np.where(state.total_contributed > 0, espp_net_value / state.total_contributed, 0.0)
+            roi = np.where(
+                roi_denominator != 0,
+                (
+                    state.value_of_held_money
+                    - roi_denominator
+                    - (employee_options.capital_gains_tax_rate * espp_net_value)
+                ) / roi_denominator,
+                0.0
+            )
+
+        # Subtract 1 from the period to have the proper amount contributed
+        return ESPPResult(
+            baseline_value=np.full(state.simulations, float(max_contribution * (state.total_periods - 1))),
+            money_contributed=state.contributions_sum,
+            money_refunded=state.money_refunded,
+            espp_return=espp_return,
+            total_value=state.value_of_held_money - (employee_options.capital_gains_tax_rate * espp_net_value),
+            roi=roi
+        )
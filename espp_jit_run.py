@@ -0,0 +1,398 @@
+"""
+    Compiled version of the ESPPScenarioRun loop for the built-in strategies.
+
+    With numba installed, the per path loop and the strategies are compiled to native code and paths run in parallel
+    threads with prange. numba is optional: without it the same functions run as plain Python, giving the same results
+    as ESPPScenarioRun at about the same speed.
+"""
+import math
+import typing as t
+
+import numpy as np
+
+from constants import MAX_PRICE_IRS
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+import strategies
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+if numba is not None:
+    _jit = numba.njit(cache=True)
+    _parallel_jit = numba.njit(cache=True, parallel=True)
+    _prange = numba.prange
+else:
+    def _jit(func):
+        return func
+    _parallel_jit = _jit
+    _prange = range
+
+# Index of each value in the options array passed to the kernels
+_MAX_CONTRIBUTION = 0
+_RATE_OF_RETURN = 1
+_PAY_PERIODS_PER_OFFERING = 2
+_OFFERING_PERIODS = 3
+_DISCOUNT_RATE = 4
+_MAX_PAY_IN = 5
+_ALLOWS_LOOKBACK = 6
+_IGNORE_LIQUIDITY_PREFERENCE = 7
+_CAPITAL_GAINS_TAX_RATE = 8
+_VOLATILITY = 9
+_EXPECTED_RATE_OF_RETURN = 10
+_LEVEL_1_INTERCEPT = 11
+_LEVEL_1_SLOPE = 12
+_LEVEL_2_INTERCEPT = 13
+_LEVEL_2_SLOPE = 14
+_FILL_FACTOR = 15
+_STD_DEV_FRACTION = 16
+_READJUST_DROP = 17
+_OPTIONS_SIZE = 18
+
+# The kernel of each built-in strategy, keyed by the scalar strategy function
+_NO_CONTRIBUTION = 0
+_MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK = 1
+_PROPORTIONED_MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK = 2
+_MAX_ALL_THE_WAY_IRS_HARD_BLOCK = 3
+_MAX_BOTH_HARD_BLOCK = 4
+_PROPORTIONED_MAX_BOTH_HARD_BLOCK = 5
+_REDUCE_IRS_OVER_RISK = 6
+_READJUST_HALFWAY = 7
+_MAXIMIZE_FOR_LARGE_PERIODS = 8
+
+JIT_STRATEGY_CODES: t.Dict[t.Callable, int] = {
+    strategies.no_contribution: _NO_CONTRIBUTION,
+    strategies.max_all_the_way_company_hard_block: _MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK,
+    strategies.proportioned_max_all_the_way_company_hard_block: _PROPORTIONED_MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK,
+    strategies.max_all_the_way_irs_hard_block: _MAX_ALL_THE_WAY_IRS_HARD_BLOCK,
+    strategies.max_both_hard_block: _MAX_BOTH_HARD_BLOCK,
+    strategies.proportioned_max_both_hard_block: _PROPORTIONED_MAX_BOTH_HARD_BLOCK,
+    strategies.reduce_irs_over_risk: _REDUCE_IRS_OVER_RISK,
+    strategies.readjust_halfway: _READJUST_HALFWAY,
+    strategies.maximize_for_large_periods: _MAXIMIZE_FOR_LARGE_PERIODS,
+}
+
+
+def supports_jit(func: t.Dict[str, t.Any]) -> bool:
+    """
+        Whether a strategy entry has a compiled kernel. User defined strategies don't.
+    """
+    return func.get("strategy") in JIT_STRATEGY_CODES
+
+
+def _options_array(employee_options: EmployeeOptions) -> np.ndarray:
+    company_stock_plan = employee_options.company_stock_plan
+    options = np.empty(_OPTIONS_SIZE)
+    options[_MAX_CONTRIBUTION] = employee_options.max_contribution
+    options[_RATE_OF_RETURN] = employee_options.rate_of_return
+    options[_PAY_PERIODS_PER_OFFERING] = company_stock_plan.pay_periods_per_offering
+    options[_OFFERING_PERIODS] = company_stock_plan.offering_periods
+    options[_DISCOUNT_RATE] = company_stock_plan.discount_rate
+    options[_MAX_PAY_IN] = company_stock_plan.max_pay_in
+    options[_ALLOWS_LOOKBACK] = company_stock_plan.allows_lookback
+    options[_IGNORE_LIQUIDITY_PREFERENCE] = employee_options.ignore_liquidity_preference
+    options[_CAPITAL_GAINS_TAX_RATE] = employee_options.capital_gains_tax_rate
+    options[_VOLATILITY] = employee_options.company_stock_parameters.volatility
+    options[_EXPECTED_RATE_OF_RETURN] = employee_options.company_stock_parameters.expected_rate_of_return
+    strategy_parameters = employee_options.strategy_parameters
+    options[_LEVEL_1_INTERCEPT] = strategy_parameters.level_1_intercept
+    options[_LEVEL_1_SLOPE] = strategy_parameters.level_1_slope
+    options[_LEVEL_2_INTERCEPT] = strategy_parameters.level_2_intercept
+    options[_LEVEL_2_SLOPE] = strategy_parameters.level_2_slope
+    options[_FILL_FACTOR] = strategy_parameters.fill_factor
+    options[_STD_DEV_FRACTION] = strategy_parameters.std_dev_fraction
+    options[_READJUST_DROP] = strategy_parameters.readjust_drop
+    return options
+
+
+# The scalar strategies use the same function, compiling it keeps the probabilities of both engines identical
+_norm_cdf = _jit(strategies._norm_cdf)
+
+
+@_jit
+def _irs_hard_block(contribution, dollars_ready_for_purchase, irs_purchased_value):
+    if irs_purchased_value + dollars_ready_for_purchase + contribution > MAX_PRICE_IRS:
+        contribution = MAX_PRICE_IRS - dollars_ready_for_purchase - irs_purchased_value
+    return contribution
+
+
+@_jit
+def _company_hard_block(contribution, total_contributed, max_pay_in):
+    if contribution != 0 and total_contributed + contribution > max_pay_in:
+        contribution = min(contribution, max_pay_in - total_contributed)
+    return contribution
+
+
+@_jit
+def _contribution(
+    code,
+    options,
+    period,
+    offering_boundary,
+    last_contribution,
+    contributions_sum,
+    total_contributed,
+    dollars_ready_for_purchase,
+    irs_purchased_value,
+    last_grant_price,
+    current_stock_price
+):
+    """
+        The contribution of one path in one period, following the scalar strategy functions in strategies.py.
+    """
+    max_contribution = options[_MAX_CONTRIBUTION]
+    pay_periods_per_offering = options[_PAY_PERIODS_PER_OFFERING]
+    offering_periods = options[_OFFERING_PERIODS]
+    max_pay_in = options[_MAX_PAY_IN]
+    proportioned_contribution = min(max_contribution, MAX_PRICE_IRS / (offering_periods * pay_periods_per_offering))
+
+    if code == _NO_CONTRIBUTION:
+        return 0.0
+
+    if code == _MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK or code == _PROPORTIONED_MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK:
+        contribution = max_contribution if code == _MAX_ALL_THE_WAY_COMPANY_HARD_BLOCK else proportioned_contribution
+        if total_contributed + contribution > max_pay_in:
+            contribution = max_pay_in - total_contributed
+        return contribution
+
+    if code == _MAX_ALL_THE_WAY_IRS_HARD_BLOCK:
+        return _irs_hard_block(max_contribution, dollars_ready_for_purchase, irs_purchased_value)
+
+    if code == _MAX_BOTH_HARD_BLOCK or code == _PROPORTIONED_MAX_BOTH_HARD_BLOCK:
+        contribution = max_contribution if code == _MAX_BOTH_HARD_BLOCK else proportioned_contribution
+        contribution = _irs_hard_block(contribution, dollars_ready_for_purchase, irs_purchased_value)
+        return _company_hard_block(contribution, total_contributed, max_pay_in)
+
+    if code == _REDUCE_IRS_OVER_RISK:
+        if offering_boundary:
+            if max_contribution < (MAX_PRICE_IRS / (pay_periods_per_offering * offering_periods)):
+                contribution = max_contribution
+            else:
+                contribution = MAX_PRICE_IRS / (pay_periods_per_offering * offering_periods)
+        else:
+            contribution = last_contribution
+        return _company_hard_block(contribution, total_contributed, max_pay_in)
+
+    if code == _READJUST_HALFWAY:
+        if offering_boundary:
+            contribution = max_contribution
+        elif (
+            period < pay_periods_per_offering * (offering_periods - 1)
+            and period % pay_periods_per_offering == pay_periods_per_offering / offering_periods / 2
+            and last_grant_price * (1 - options[_READJUST_DROP]) > current_stock_price
+        ):
+            contribution = 0.0
+        else:
+            contribution = last_contribution
+        contribution = _irs_hard_block(contribution, dollars_ready_for_purchase, irs_purchased_value)
+        return _company_hard_block(contribution, total_contributed, max_pay_in)
+
+    # _MAXIMIZE_FOR_LARGE_PERIODS
+    level_1_contribution = min(max_contribution, MAX_PRICE_IRS * 2 / (pay_periods_per_offering * offering_periods))
+    level_2_contribution = min(max_contribution, MAX_PRICE_IRS / (pay_periods_per_offering * offering_periods))
+    std_dev_to_use = last_grant_price + options[_VOLATILITY] * options[_STD_DEV_FRACTION]
+
+    if period == 0:
+        contribution = level_1_contribution
+    elif offering_boundary:
+        contribution = max_contribution
+    elif period < pay_periods_per_offering * (offering_periods - 1):
+        if last_contribution == level_1_contribution or last_contribution == level_2_contribution:
+            current_expected_mean = current_stock_price * math.pow(1 + options[_EXPECTED_RATE_OF_RETURN], period / 24)
+            current_expected_volatility = current_stock_price * options[_VOLATILITY] * math.sqrt(period / 24)
+            normalized_std_dev_goal = (std_dev_to_use - current_expected_mean) / current_expected_volatility
+            probability = 1 - _norm_cdf(normalized_std_dev_goal)
+
+            if probability > options[_LEVEL_1_INTERCEPT] + options[_LEVEL_1_SLOPE] * (period / pay_periods_per_offering) and level_1_contribution == last_contribution:
+                contribution = level_1_contribution
+            elif probability > options[_LEVEL_2_INTERCEPT] + options[_LEVEL_2_SLOPE] * (period / pay_periods_per_offering):
+                contribution = level_2_contribution
+            else:
+                potential_contribution = (
+                    (MAX_PRICE_IRS * options[_DISCOUNT_RATE]
+                    - contributions_sum
+                    - (max_contribution * pay_periods_per_offering))
+                    * options[_FILL_FACTOR]
+                ) / (pay_periods_per_offering - period)
+                potential_contribution = min(potential_contribution, max_contribution)
+                contribution = potential_contribution if potential_contribution > 0 else 0.0
+        else:
+            contribution = last_contribution
+    else:
+        contribution = last_contribution
+
+    contribution = _irs_hard_block(contribution, dollars_ready_for_purchase, irs_purchased_value)
+    return _company_hard_block(contribution, total_contributed, max_pay_in)
+
+
+@_jit
+def _run_path(prices, code, options, offering_boundaries, result):
+    """
+        Runs a single price path, the same way ESPPScenarioRun.run does, and writes its values to result
+        in the order of ESPPResult.COLUMNS. offering_boundaries marks the periods where period % pay_periods_per_offering == 0.
+    """
+    max_contribution = options[_MAX_CONTRIBUTION]
+    pay_periods_per_offering = options[_PAY_PERIODS_PER_OFFERING]
+    discount_rate = options[_DISCOUNT_RATE]
+    allows_lookback = options[_ALLOWS_LOOKBACK] != 0
+    ignore_liquidity_preference = options[_IGNORE_LIQUIDITY_PREFERENCE] != 0
+    held_money_growth = 1 + (options[_RATE_OF_RETURN] / (pay_periods_per_offering * options[_OFFERING_PERIODS]))
+    total_periods = prices.shape[0]
+
+    last_contribution = 0.0
+    contributions_sum = 0.0
+    dollars_ready_for_purchase = 0.0
+    total_contributed = 0.0
+    espp_dollar_value = 0.0
+    irs_purchased_value = 0.0
+    last_grant_price = 0.0
+    value_of_held_money = 0.0
+    money_refunded = 0.0
+
+    for period in range(total_periods):
+        stock_price = prices[period]
+
+        # Compound the money that is not invested
+        if not ignore_liquidity_preference:
+            value_of_held_money = value_of_held_money * held_money_growth
+
+        # If the period is the end of an offering period, purchase shares
+        if period != 0 and offering_boundaries[period] and dollars_ready_for_purchase != 0:
+            if allows_lookback:
+                stock_purchase_price = min(stock_price, last_grant_price) * discount_rate
+            else:
+                stock_purchase_price = stock_price * discount_rate
+
+            shares_purchased_in_period = dollars_ready_for_purchase / stock_purchase_price
+            leftover_cash = 0.0
+            shares_purchased_in_period_irs = 0.0
+            shares_purchased_in_period_company = 0.0
+            leftover_cash_irs = 0.0
+            leftover_cash_company = 0.0
+            cap_hit_irs = False
+            cap_hit_company = False
+            if (irs_purchased_value + (last_grant_price * shares_purchased_in_period)) > MAX_PRICE_IRS:
+                shares_purchased_in_period_irs = (MAX_PRICE_IRS - irs_purchased_value) / last_grant_price
+                leftover_cash_irs = dollars_ready_for_purchase - (shares_purchased_in_period_irs * stock_purchase_price)
+                cap_hit_irs = True
+            if (espp_dollar_value + (stock_purchase_price * shares_purchased_in_period)) > (MAX_PRICE_IRS * discount_rate):
+                shares_purchased_in_period_company = ((MAX_PRICE_IRS * discount_rate) - espp_dollar_value) / last_grant_price
+                leftover_cash_company = dollars_ready_for_purchase - (shares_purchased_in_period_company * stock_purchase_price)
+                cap_hit_company = True
+
+            # If a cap hit, choose the smaller of the caps to apply.
+            if cap_hit_irs and cap_hit_company:
+                if shares_purchased_in_period_irs < shares_purchased_in_period_company:
+                    shares_purchased_in_period = shares_purchased_in_period_irs
+                    leftover_cash = leftover_cash_irs
+                else:
+                    shares_purchased_in_period = shares_purchased_in_period_company
+                    leftover_cash = leftover_cash_company
+            elif cap_hit_irs:
+                shares_purchased_in_period = shares_purchased_in_period_irs
+                leftover_cash = leftover_cash_irs
+            elif cap_hit_company:
+                shares_purchased_in_period = shares_purchased_in_period_company
+                leftover_cash = leftover_cash_company
+
+            espp_dollar_value += shares_purchased_in_period * stock_price
+            money_refunded += leftover_cash
+            total_contributed -= leftover_cash
+            dollars_ready_for_purchase = 0.0
+            if allows_lookback:
+                irs_purchased_value += shares_purchased_in_period * last_grant_price
+            else:
+                irs_purchased_value += shares_purchased_in_period * stock_price
+            if not ignore_liquidity_preference:
+                value_of_held_money += leftover_cash + (shares_purchased_in_period * stock_price)
+            else:
+                value_of_held_money += (shares_purchased_in_period * stock_price)
+
+        # break out of loop once the last purchase has occured
+        if period == total_periods - 1:
+            break
+
+        # Reset the IRS grant price at the beginning of each offering period, after shares are purchased
+        if offering_boundaries[period]:
+            last_grant_price = stock_price
+
+        contribution = _contribution(
+            code,
+            options,
+            period,
+            offering_boundaries[period],
+            last_contribution,
+            contributions_sum,
+            total_contributed,
+            dollars_ready_for_purchase,
+            irs_purchased_value,
+            last_grant_price,
+            stock_price
+        )
+        uninvested_money = max_contribution - contribution
+
+        last_contribution = contribution
+        contributions_sum += contribution
+        if not ignore_liquidity_preference:
+            value_of_held_money += uninvested_money
+        total_contributed += contribution
+        dollars_ready_for_purchase += contribution
+
+    espp_net_value = (espp_dollar_value - total_contributed) if total_contributed != 0 else 0.0
+    baseline_value = max_contribution * (total_periods - 1)
+    roi_denominator = baseline_value if not ignore_liquidity_preference else total_contributed
+    capital_gains_tax = options[_CAPITAL_GAINS_TAX_RATE] * espp_net_value
+
+    result[0] = baseline_value
+    result[1] = value_of_held_money - capital_gains_tax
+    result[2] = contributions_sum
+    result[3] = (value_of_held_money - roi_denominator - capital_gains_tax) / roi_denominator if roi_denominator != 0 else 0.0
+    result[4] = money_refunded
+    result[5] = espp_net_value / total_contributed if total_contributed > 0 else 0.0
+
+
+@_parallel_jit
+def _run_paths(prices, code, options, results):
+    # The float modulo is slow in the inner loop, and the same for every path
+    offering_boundaries = np.empty(prices.shape[1], dtype=np.bool_)
+    for period in range(prices.shape[1]):
+        offering_boundaries[period] = period % options[_PAY_PERIODS_PER_OFFERING] == 0
+    for path in _prange(prices.shape[0]):
+        _run_path(prices[path], code, options, offering_boundaries, results[:, path])
+
+
+class ESPPJitRun():
+    """
+        Runs a built-in strategy over a whole price matrix with the compiled kernels. The results match
+        ESPPScenarioRun run over each row, up to the last bits of the normal CDF used by maximize_for_large_periods.
+
+        Prices are run as float64. The first run compiles the kernels, which takes a few seconds, after that they are cached on disk.
+    """
+    def __init__(
+        self,
+        scenarios: np.ndarray,
+        strategy: EmployeeOptions,
+        step_function: t.Callable
+    ):
+        if step_function not in JIT_STRATEGY_CODES:
+            raise ValueError(f"{getattr(step_function, '__name__', step_function)} has no compiled kernel, use ESPPBatchRun instead")
+        self.scenarios = np.atleast_2d(scenarios)
+        self.strategy = strategy
+        self.step_function = step_function
+
+    def run(self) -> ESPPResult:
+        """
+            Returns an ESPPResult with one entry per price path
+        """
+        results = np.empty((len(ESPPResult.COLUMNS), self.scenarios.shape[0]))
+        _run_paths(
+            np.ascontiguousarray(self.scenarios, dtype=np.float64),
+            JIT_STRATEGY_CODES[self.step_function],
+            _options_array(self.strategy),
+            results
+        )
+        return ESPPResult(**dict(zip(ESPPResult.COLUMNS, results)))
@@ -7,19 +7,26 @@ from constants import MAX_PRICE_IRS
 from models.espp_state import ESPPState
 from models.employee_options import EmployeeOptions
 from models.espp_result import ESPPResult
+from models.plan_schedule import plan_schedule
+import profiling
+import strategies
 
 class ESPPScenarioRun():
     def __init__(
         self,
         scenario: np.ndarray,
         strategy: EmployeeOptions,
-        step_function: t.Callable[[EmployeeOptions, ESPPState], float]
+        step_function: t.Callable[[EmployeeOptions, ESPPState], float],
+        keep_history: t.Optional[bool] = None
     ):
         self.scenario = scenario
         self.strategy = strategy
         self.current_step = 0
         self.step_function = step_function
-        self.state = ESPPState()
+        # Only strategies that read state.contributions or state.uninvested need the history
+        if keep_history is None:
+            keep_history = strategies.needs_history(step_function)
+        self.state = ESPPState(max(len(scenario) - 1, 0) if keep_history else None)
 
     
     def run(self):
@@ -30,6 +37,15 @@ class ESPPScenarioRun():
         """
 
         self.state.total_periods = len(self.scenario)
+        schedule = plan_schedule(self.strategy, self.state.total_periods)
+        self.state.schedule = schedule
+
+        # The stages are only wrapped with timers while profiling
+        profile = profiling.active_profile()
+        compound_held_money = profiling.instrument(profile, "compounding", self.state.compound_held_money)
+        purchase = profiling.instrument(profile, "purchase", self._purchase)
+        step_function = profiling.instrument(profile, "strategy", self.step_function)
+        update_contributions_and_uninvested = profiling.instrument(profile, "contributions", self.state.update_contributions_and_uninvested)
         
         for period, stock_price in enumerate(self.scenario):
 
@@ -37,70 +53,28 @@ class ESPPScenarioRun():
             self.state.current_stock_price = stock_price
 
             # Compound the money that is not invested 
-            self.state.update_value_of_held_money(self.strategy.rate_of_return, self.strategy)
+            if schedule.held_money_growth is not None:
+                compound_held_money(schedule.held_money_growth)
 
             # If the period is the end of an offering period, purchase shares
-            if period != 0 and period % self.strategy.company_stock_plan.pay_periods_per_offering == 0 and self.state.dollars_ready_for_purchase != 0:
-                # Stock purchase price = floor of current price, price at the beginning of the offering period
-                if self.strategy.company_stock_plan.allows_lookback:
-                    stock_purchase_price = (
-                        min(
-                            stock_price,
-                            self.state.last_grant_price
-                        ) * self.strategy.company_stock_plan.discount_rate
-                    )
-                else:
-                    stock_purchase_price = stock_price * self.strategy.company_stock_plan.discount_rate
-
-                # How many shares can you purchase with no limit
-                shares_purchased_in_period = self.state.dollars_ready_for_purchase / stock_purchase_price
-                leftover_cash = 0
-                shares_purchased_in_period_irs = 0
-                cap_hit_irs = False
-                cap_hit_company = False
-                # How many shares can you purchase with IRS limits
-                if (self.state.irs_purchased_value + (self.state.last_grant_price * shares_purchased_in_period)) > MAX_PRICE_IRS:
-                    shares_purchased_in_period_irs = (MAX_PRICE_IRS - self.state.irs_purchased_value) / self.state.last_grant_price
-                    leftover_cash_irs = self.state.dollars_ready_for_purchase - (shares_purchased_in_period_irs * stock_purchase_price)
-                    cap_hit_irs = True
-                # How many shares can you purchase with Stock limits
-                if (self.state.espp_dollar_value + (stock_purchase_price * shares_purchased_in_period)) > (MAX_PRICE_IRS * self.strategy.company_stock_plan.discount_rate):
-                    shares_purchased_in_period_company = ((MAX_PRICE_IRS * self.strategy.company_stock_plan.discount_rate) - self.state.espp_dollar_value) / self.state.last_grant_price
-                    leftover_cash_company = self.state.dollars_ready_for_purchase - (shares_purchased_in_period_company * stock_purchase_price)
-                    cap_hit_company = True
-
-                # If a cap hit, choose the smaller of the caps to apply.
-                if cap_hit_irs and cap_hit_company:
-                    if shares_purchased_in_period_irs < shares_purchased_in_period_company:
-                        shares_purchased_in_period = shares_purchased_in_period_irs
-                        leftover_cash = leftover_cash_irs
-                    else:
-                        shares_purchased_in_period = shares_purchased_in_period_company
-                        leftover_cash = leftover_cash_company
-                elif cap_hit_irs:
-                    shares_purchased_in_period = shares_purchased_in_period_irs
-                    leftover_cash = leftover_cash_irs
-                elif cap_hit_company:
-                    shares_purchased_in_period = shares_purchased_in_period_company
-                    leftover_cash = leftover_cash_company
-
-                self.state.update_stock_values_after_purchase(shares_purchased_in_period, leftover_cash, stock_price, self.strategy)
-                    
+            if schedule.purchase_period[period] and self.state.dollars_ready_for_purchase != 0:
+                purchase(stock_price)
+
             # break out of loop once the last purchase has occured
             if period == len(self.scenario) - 1:
                 break
 
             # Reset the IRS grant price at the beginning of each offering period, after shares are purchased
-            if period % self.strategy.company_stock_plan.pay_periods_per_offering == 0:
+            if schedule.offering_start[period]:
                 self.state.last_grant_price = stock_price
 
-            contribution = self.step_function(
+            contribution = step_function(
                 self.strategy,
                 self.state
             )
             uninvested_money = self.strategy.max_contribution - contribution
 
-            self.state.update_contributions_and_uninvested(contribution, uninvested_money, self.strategy)
+            update_contributions_and_uninvested(contribution, uninvested_money, self.strategy)
 
         espp_net_value = (self.state.espp_dollar_value - (self.state.total_contributed)) if self.state.total_contributed != 0 else 0
 
@@ -109,7 +83,7 @@ class ESPPScenarioRun():
        # Subtract 1 from the period to have the proper amount contributed
         return ESPPResult(
             baseline_value=[self.strategy.max_contribution * (self.state.total_periods - 1)],
-            money_contributed=[sum(self.state.contributions)],
+            money_contributed=[self.state.contributions_sum],
             money_refunded=[self.state.money_refunded],
             espp_return=[espp_net_value/(self.state.total_contributed) if self.state.total_contributed > 0 else 0],
             total_value=[self.state.value_of_held_money - (self.strategy.capital_gains_tax_rate * espp_net_value)],
@@ -121,3 +95,52 @@ class ESPPScenarioRun():
                 ) / roi_denominator if roi_denominator != 0 else 0
             ]
         )
+
+    def _purchase(self, stock_price: float) -> None:
+        """
+            Buys shares with the money contributed over the offering period, applying the IRS and company caps.
+        """
+        # Stock purchase price = floor of current price, price at the beginning of the offering period
+        if self.strategy.company_stock_plan.allows_lookback:
+            stock_purchase_price = (
+                min(
+                    stock_price,
+                    self.state.last_grant_price
+                ) * self.strategy.company_stock_plan.discount_rate
+            )
+        else:
+            stock_purchase_price = stock_price * self.strategy.company_stock_plan.discount_rate
+
+        # How many shares can you purchase with no limit
+        shares_purchased_in_period = self.state.dollars_ready_for_purchase / stock_purchase_price
+        leftover_cash = 0
+        shares_purchased_in_period_irs = 0
+        cap_hit_irs = False
+        cap_hit_company = False
+        # How many shares can you purchase with IRS limits
+        if (self.state.irs_purchased_value + (self.state.last_grant_price * shares_purchased_in_period)) > MAX_PRICE_IRS:
+            shares_purchased_in_period_irs = (MAX_PRICE_IRS - self.state.irs_purchased_value) / self.state.last_grant_price
+            leftover_cash_irs = self.state.dollars_ready_for_purchase - (shares_purchased_in_period_irs * stock_purchase_price)
+            cap_hit_irs = True
+        # How many shares can you purchase with Stock limits
+        if (self.state.espp_dollar_value + (stock_purchase_price * shares_purchased_in_period)) > self.state.schedule.max_pay_in:
+            shares_purchased_in_period_company = (self.state.schedule.max_pay_in - self.state.espp_dollar_value) / self.state.last_grant_price
+            leftover_cash_company = self.state.dollars_ready_for_purchase - (shares_purchased_in_period_company * stock_purchase_price)
+            cap_hit_company = True
+
+        # If a cap hit, choose the smaller of the caps to apply.
+        if cap_hit_irs and cap_hit_company:
+            if shares_purchased_in_period_irs < shares_purchased_in_period_company:
+                shares_purchased_in_period = shares_purchased_in_period_irs
+                leftover_cash = leftover_cash_irs
+            else:
+                shares_purchased_in_period = shares_purchased_in_period_company
+                leftover_cash = leftover_cash_company
+        elif cap_hit_irs:
+            shares_purchased_in_period = shares_purchased_in_period_irs
+            leftover_cash = leftover_cash_irs
+        elif cap_hit_company:
+            shares_purchased_in_period = shares_purchased_in_period_company
+            leftover_cash = leftover_cash_company
+
+        self.state.update_stock_values_after_purchase(shares_purchased_in_period, leftover_cash, stock_price, self.strategy)
@@ -29,3 +29,19 @@ class CompanyStockPlan:
         self.cost_to_sell = cost_to_sell
         self.allows_lookback = allows_lookback
 
+    def to_dict(self) -> dict:
+        """
+            The constructor arguments of the plan, for saving alongside results. max_pay_in is derived, so it is left out.
+        """
+        return {
+            "name": self.name,
+            "discount_rate": self.discount_rate,
+            "offering_periods": self.offering_periods,
+            "pay_periods_per_offering": self.pay_periods_per_offering,
+            "cost_to_sell": self.cost_to_sell,
+            "allows_lookback": self.allows_lookback
+        }
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'CompanyStockPlan':
+        return cls(**values)
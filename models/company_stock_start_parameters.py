@@ -1,10 +1,30 @@
+import typing as t
+
+
 class CompanyStockStartParameters:
-    def __init__(self, initial_price, expected_rate_of_return, volatility):
+    def __init__(self, initial_price, expected_rate_of_return, volatility, volatility_term_structure: t.Optional[t.Sequence[float]] = None):
         """
             initial_price: The price of the stock at the beginning of the year
             expected_rate_of_return: The expected rate of return of the stock
             volatility: The volatility of the stock
+            volatility_term_structure: Optional volatility of each pay period, used instead of volatility when
+                simulating price paths. Usually calibrated from an option chain, see volatility_surface.
         """
         self.initial_price = initial_price
         self.expected_rate_of_return = expected_rate_of_return
-        self.volatility = volatility
\ No newline at end of file
+        self.volatility = volatility
+        self.volatility_term_structure = None if volatility_term_structure is None else tuple(float(value) for value in volatility_term_structure)
+
+    def to_dict(self) -> dict:
+        values = {
+            "initial_price": self.initial_price,
+            "expected_rate_of_return": self.expected_rate_of_return,
+            "volatility": self.volatility
+        }
+        if self.volatility_term_structure is not None:
+            values["volatility_term_structure"] = list(self.volatility_term_structure)
+        return values
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'CompanyStockStartParameters':
+        return cls(**values)
@@ -1,5 +1,8 @@
+import typing as t
+
 from models.company_plan import CompanyStockPlan
 from models.company_stock_start_parameters import CompanyStockStartParameters
+from models.strategy_parameters import StrategyParameters
 
 class EmployeeOptions:
     def __init__(
@@ -11,7 +14,8 @@ class EmployeeOptions:
         liquidity_preference_rate: float=0,
         capital_gains_tax_rate: float=0,
         ignore_liquidity_preference: bool=False,
-        default_to_max_allowed=False
+        default_to_max_allowed=False,
+        strategy_parameters: t.Optional[StrategyParameters] = None
     ):
         """
             rate_of_return represents the expected rate of return for uninvested money
@@ -24,6 +28,8 @@ class EmployeeOptions:
             ignore_liquidity_preference means calculations should be done not taking liquidity preference into account.
             This means that if you accidentally tie up money in the ESPP, the strategy ROI will not be penalized.
             This can be useful for seeing the true ESPP ROI
+
+            strategy_parameters holds the tunable constants of the built-in strategies, see StrategyParameters
             
 
             Parameters to add:
@@ -40,4 +46,29 @@ class EmployeeOptions:
         self.capital_gains_tax_rate = capital_gains_tax_rate
         self.ignore_liquidity_preference = ignore_liquidity_preference
         self.default_to_max_allowed = default_to_max_allowed
+        self.strategy_parameters = strategy_parameters if strategy_parameters is not None else StrategyParameters()
+
+
+    def to_dict(self) -> dict:
+        """
+            The constructor arguments of the options, including the nested plan, stock parameters and strategy parameters.
+        """
+        return {
+            "company_stock_plan": self.company_stock_plan.to_dict(),
+            "company_stock_parameters": self.company_stock_parameters.to_dict(),
+            "max_contribution": self.max_contribution,
+            "steps_to_zero": self.steps_to_zero,
+            "liquidity_preference_rate": self.rate_of_return,
+            "capital_gains_tax_rate": self.capital_gains_tax_rate,
+            "ignore_liquidity_preference": self.ignore_liquidity_preference,
+            "default_to_max_allowed": self.default_to_max_allowed,
+            "strategy_parameters": self.strategy_parameters.to_dict()
+        }
 
+    @classmethod
+    def from_dict(cls, values: dict) -> 'EmployeeOptions':
+        values = dict(values)
+        values["company_stock_plan"] = CompanyStockPlan.from_dict(values["company_stock_plan"])
+        values["company_stock_parameters"] = CompanyStockStartParameters.from_dict(values["company_stock_parameters"])
+        values["strategy_parameters"] = StrategyParameters.from_dict(values["strategy_parameters"])
+        return cls(**values)
@@ -0,0 +1,145 @@
+import typing as t
+
+import numpy as np
+
+from models.employee_options import EmployeeOptions
+from models.espp_state import ESPPState
+from models.plan_schedule import PlanSchedule
+
+
+class ESPPBatchState():
+    """
+        Struct-of-arrays version of ESPPState. Every field that differs between price paths is a numpy array with
+        one entry per path, so a whole price matrix can be advanced one period at a time.
+
+        period and total_periods are shared by all paths and stay plain ints.
+    """
+
+    def __init__(self, simulations: int, total_periods: int):
+        self.simulations = simulations
+
+        # Amount contributed to ESPP
+        self.dollars_ready_for_purchase = np.zeros(simulations)
+        # Amount contributed to ESPP over both stock plans
+        self.total_contributed = np.zeros(simulations)
+
+        # Shares purchased
+        self.shares_purchased = np.zeros(simulations)
+        # Value of the stocks purchased
+        self.espp_dollar_value = np.zeros(simulations)
+        self.irs_purchased_value = np.zeros(simulations)
+
+        # The cost of the stock at the beginning of the offering period
+        self.last_grant_price = np.zeros(simulations)
+        self.current_stock_price = np.zeros(simulations)
+
+        # The contributions for each period, one column per period. Only the first contributions_filled columns are set.
+        # Column-major so writing and reading a single period is a contiguous block of memory.
+        self.contributions = np.zeros((simulations, max(total_periods - 1, 0)), order='F')
+        self.contributions_filled = 0
+        # Running sums of the contributions and uninvested money, added in period order so they match ESPPState
+        self.contributions_sum = np.zeros(simulations)
+        self.uninvested_sum = np.zeros(simulations)
+
+        # Represents money deliberately not contributed to the ESPP, and the interest gained on that money
+        # If ignore_liquidity_preference is False, this money only represents returns from the ESPP
+        self.value_of_held_money = np.zeros(simulations)
+
+        self.period = 0
+        self.total_periods = total_periods
+
+        self.money_refunded = np.zeros(simulations)
+
+        # The precomputed plan values of the run, set by the engine
+        self.schedule: t.Optional[PlanSchedule] = None
+
+    @property
+    def last_contribution(self) -> np.ndarray:
+        """
+            The contribution made in the previous period, equivalent to ESPPState.last_contribution
+        """
+        if self.contributions_filled == 0:
+            return np.zeros(self.simulations)
+        return self.contributions[:, self.contributions_filled - 1]
+
+    def path_state(self, path: int, employee_options: EmployeeOptions, keep_history: bool = False) -> ESPPState:
+        """
+            Builds the ESPPState of a single path, so scalar strategies can be run against a batch.
+            With keep_history the state's contributions and uninvested history are filled in as well.
+        """
+        state = ESPPState()
+        state.dollars_ready_for_purchase = float(self.dollars_ready_for_purchase[path])
+        state.total_contributed = float(self.total_contributed[path])
+        state.shares_purchased = float(self.shares_purchased[path])
+        state.espp_dollar_value = float(self.espp_dollar_value[path])
+        state.irs_purchased_value = float(self.irs_purchased_value[path])
+        state.last_grant_price = float(self.last_grant_price[path])
+        state.current_stock_price = float(self.current_stock_price[path])
+        state.value_of_held_money = float(self.value_of_held_money[path])
+        state.period = self.period
+        state.total_periods = self.total_periods
+        state.schedule = self.schedule
+        state.money_refunded = float(self.money_refunded[path])
+        state.contributions_count = self.contributions_filled
+        state.contributions_sum = float(self.contributions_sum[path])
+        state.uninvested_sum = float(self.uninvested_sum[path])
+        if self.contributions_filled > 0:
+            state.last_contribution = float(self.contributions[path, self.contributions_filled - 1])
+            state.last_uninvested = employee_options.max_contribution - state.last_contribution
+        if keep_history:
+            contributions = self.contributions[path, :self.contributions_filled]
+            state.set_history(contributions, employee_options.max_contribution - contributions)
+        return state
+
+    def update_value_of_held_money(self, rate_of_return, employee_options: EmployeeOptions):
+        if not employee_options.ignore_liquidity_preference:
+            self.value_of_held_money *= (
+                1 + (rate_of_return /
+                     (employee_options.company_stock_plan.pay_periods_per_offering * employee_options.company_stock_plan.offering_periods)
+                     )
+            )
+
+    def compound_held_money(self, held_money_growth: float):
+        """
+            update_value_of_held_money with the growth factor from the PlanSchedule.
+        """
+        self.value_of_held_money *= held_money_growth
+
+    def update_stock_values_after_purchase(
+        self,
+        purchase_mask: np.ndarray,
+        shares_purchased_in_period: np.ndarray,
+        leftover_cash: np.ndarray,
+        stock_price: np.ndarray,
+        employee_options: EmployeeOptions
+    ) -> None:
+        """
+            Applies a purchase to the paths selected by purchase_mask. shares_purchased_in_period and leftover_cash
+            must already be zero for the paths that are not purchasing.
+        """
+        self.shares_purchased += shares_purchased_in_period
+        self.espp_dollar_value += shares_purchased_in_period * stock_price
+
+        self.money_refunded += leftover_cash
+        self.total_contributed -= leftover_cash
+        self.dollars_ready_for_purchase[purchase_mask] = 0
+
+        if employee_options.company_stock_plan.allows_lookback:
+            self.irs_purchased_value += shares_purchased_in_period * self.last_grant_price
+        else:
+            self.irs_purchased_value += shares_purchased_in_period * stock_price
+
+        if not employee_options.ignore_liquidity_preference:
+            self.value_of_held_money += leftover_cash + (shares_purchased_in_period * stock_price)
+        else:
+            self.value_of_held_money += (shares_purchased_in_period * stock_price)
+
+    def update_contributions_and_uninvested(self, contribution: np.ndarray, uninvested_money: np.ndarray, employee_options: EmployeeOptions):
+        self.contributions[:, self.contributions_filled] = contribution
+        self.contributions_filled += 1
+        self.contributions_sum += contribution
+        self.uninvested_sum += uninvested_money
+        if not employee_options.ignore_liquidity_preference:
+            self.value_of_held_money += uninvested_money
+        self.total_contributed += contribution
+        self.dollars_ready_for_purchase += contribution
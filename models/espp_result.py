@@ -1,11 +1,61 @@
-from dataclasses import dataclass, field
+import math
+import typing as t
+from dataclasses import dataclass
+
+import numpy as np
 
 @dataclass
+class RunningStatistics:
+    """
+        Count, mean, variance, min, max and sum of a column, updated a batch at a time without keeping the values.
+        Batches are combined with the parallel form of Welford's algorithm, so the variance stays accurate
+        over any number of values.
+    """
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    minimum: float = math.inf
+    maximum: float = -math.inf
+    total: float = 0.0
+
+    def add_batch(self, values: np.ndarray) -> None:
+        if values.shape[0] == 0:
+            return
+        batch_mean = float(np.mean(values))
+        self.merge(RunningStatistics(
+            count=values.shape[0],
+            mean=batch_mean,
+            m2=float(np.sum(np.square(values - batch_mean))),
+            minimum=float(np.min(values)),
+            maximum=float(np.max(values)),
+            total=float(np.sum(values))
+        ))
+
+    def merge(self, other: 'RunningStatistics') -> None:
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.total += other.total
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / self.count if self.count > 0 else 0.0
+
+
 class ESPPResult:
     """
     This class is used to store the results of the ESPP plan.
 
-    The _sum variables represents the sum of multiple ESPPResult objects.
+    Each result is a column with one value per simulated path, stored in a preallocated numpy buffer that grows
+    by doubling, so adding a path is O(1) amortized. Columns are read as numpy arrays, e.g. result.roi.
+
+    The _sum properties represent the sum of a column over every result that was added.
 
     baseline_value represents the sum of money that can be contributed to the ESPP plan.
     total_value represents the total value of the money that can be contributed to the ESPP plan after the plan is over,
@@ -14,32 +64,208 @@ class ESPPResult:
     roi represents the return on investment of the ESPP plan including the liquidity preference rate and capital gains tax rate.
     money_refunded represents the sum of money that was refunded from the ESPP plan because too much money was contributed.
     espp_return represents the return on investment of the ESPP plan excluding the liquidity preference rate and capital gains tax rate.
+
+    With streaming=True the per path values are not kept. Only running statistics of every column
+    (see RunningStatistics) and a histogram of roi are, so memory stays constant however many paths are added.
+    The roi histogram has histogram_bins bins over histogram_range, values outside it are counted in
+    roi_histogram_below and roi_histogram_above.
     """
-    baseline_value_sum: float = 0.0
-    total_value_sum: float = 0.0
-    money_contributed_sum: float = 0.0
-    roi_sum: float = 0.0
-    money_refunded_sum: float = 0.0
-    espp_return_sum: float = 0.0
-
-    baseline_value: list[float] = field(default_factory=list)
-    total_value: list[float] = field(default_factory=list)
-    money_contributed: list[float] = field(default_factory=list)
-    roi: list[float] = field(default_factory=list)
-    money_refunded: list[float] = field(default_factory=list)
-    espp_return: list[float] = field(default_factory=list)
-
-    def add(self, other: 'ESPPResult'): 
-        self.baseline_value_sum += sum(other.baseline_value)
-        self.total_value_sum += sum(other.total_value)
-        self.money_contributed_sum += sum(other.money_contributed)
-        self.roi_sum += sum(other.roi)
-        self.money_refunded_sum += sum(other.money_refunded)
-        self.espp_return_sum += sum(other.espp_return)
-
-        self.baseline_value.extend(other.baseline_value)
-        self.total_value.extend(other.total_value)
-        self.money_contributed.extend(other.money_contributed)
-        self.roi.extend(other.roi)
-        self.money_refunded.extend(other.money_refunded)
-        self.espp_return.extend(other.espp_return)
+    COLUMNS = ("baseline_value", "total_value", "money_contributed", "roi", "money_refunded", "espp_return")
+
+    def __init__(
+        self,
+        baseline_value: t.Optional[t.Sequence[float]] = None,
+        total_value: t.Optional[t.Sequence[float]] = None,
+        money_contributed: t.Optional[t.Sequence[float]] = None,
+        roi: t.Optional[t.Sequence[float]] = None,
+        money_refunded: t.Optional[t.Sequence[float]] = None,
+        espp_return: t.Optional[t.Sequence[float]] = None,
+        capacity: int = 0,
+        streaming: bool = False,
+        histogram_bins: int = 1000,
+        histogram_range: t.Tuple[float, float] = (-1.0, 3.0)
+    ):
+        self.streaming = streaming
+        self.size = 0
+        self._values = np.empty((len(self.COLUMNS), capacity if not streaming else 0))
+
+        if streaming:
+            self.statistics = {column: RunningStatistics() for column in self.COLUMNS}
+            self.roi_histogram_edges = np.linspace(histogram_range[0], histogram_range[1], histogram_bins + 1)
+            self.roi_histogram = np.zeros(histogram_bins, dtype=np.int64)
+            self.roi_histogram_below = 0
+            self.roi_histogram_above = 0
+
+        columns = {
+            "baseline_value": baseline_value,
+            "total_value": total_value,
+            "money_contributed": money_contributed,
+            "roi": roi,
+            "money_refunded": money_refunded,
+            "espp_return": espp_return
+        }
+        if any(values is not None for values in columns.values()):
+            self.add_batch(**{column: [] if values is None else values for column, values in columns.items()})
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ESPPResult) or self.streaming or other.streaming:
+            return NotImplemented
+        return self.size == other.size and np.array_equal(self._values[:, :self.size], other._values[:, :other.size])
+
+    def __getstate__(self):
+        # Leave the unused capacity out when the result is pickled, e.g. sent back from a worker process
+        state = self.__dict__.copy()
+        state["_values"] = self._values[:, :self.size].copy()
+        return state
+
+    def column(self, name: str) -> np.ndarray:
+        """
+            The values of a column, one per path. The array is a view, valid until more results are added.
+        """
+        if self.streaming:
+            raise ValueError("streaming results only keep running statistics, not per path values")
+        return self._values[self.COLUMNS.index(name), :self.size]
+
+    def _ensure_capacity(self, additional: int) -> None:
+        needed = self.size + additional
+        if needed > self._values.shape[1]:
+            values = np.empty((len(self.COLUMNS), max(needed, 2 * self._values.shape[1])))
+            values[:, :self.size] = self._values[:, :self.size]
+            self._values = values
+
+    def add_batch(self, **columns: t.Sequence[float]) -> None:
+        """
+            Adds the results of many paths at once, one sequence or array per column, all of the same length.
+        """
+        missing = set(self.COLUMNS) - set(columns)
+        if missing:
+            raise ValueError(f"missing columns: {', '.join(sorted(missing))}")
+        values = [np.asarray(columns[column], dtype=float).ravel() for column in self.COLUMNS]
+        count = values[0].shape[0]
+        if any(column_values.shape[0] != count for column_values in values):
+            raise ValueError("every column must have the same number of values")
+
+        if self.streaming:
+            for column, column_values in zip(self.COLUMNS, values):
+                self.statistics[column].add_batch(column_values)
+            roi = values[self.COLUMNS.index("roi")]
+            self.roi_histogram += np.histogram(roi, bins=self.roi_histogram_edges)[0]
+            self.roi_histogram_below += int(np.count_nonzero(roi < self.roi_histogram_edges[0]))
+            self.roi_histogram_above += int(np.count_nonzero(roi > self.roi_histogram_edges[-1]))
+        else:
+            self._ensure_capacity(count)
+            for row, column_values in enumerate(values):
+                self._values[row, self.size:self.size + count] = column_values
+        self.size += count
+
+    def add(self, other: 'ESPPResult'):
+        if not other.streaming:
+            self.add_batch(**{column: other.column(column) for column in self.COLUMNS})
+            return
+        if not self.streaming:
+            raise ValueError("a streaming result can only be added to another streaming result")
+        if not np.array_equal(self.roi_histogram_edges, other.roi_histogram_edges):
+            raise ValueError("streaming results must use the same roi histogram bins")
+        for column in self.COLUMNS:
+            self.statistics[column].merge(other.statistics[column])
+        self.roi_histogram += other.roi_histogram
+        self.roi_histogram_below += other.roi_histogram_below
+        self.roi_histogram_above += other.roi_histogram_above
+        self.size += other.size
+
+    def total(self, column: str) -> float:
+        if self.streaming:
+            return self.statistics[column].total
+        return float(np.sum(self.column(column)))
+
+    def mean(self, column: str = "roi") -> float:
+        if self.streaming:
+            return self.statistics[column].mean
+        return float(np.mean(self.column(column))) if self.size else 0.0
+
+    def std(self, column: str = "roi") -> float:
+        if self.streaming:
+            return math.sqrt(self.statistics[column].variance)
+        return float(np.std(self.column(column))) if self.size else 0.0
+
+    def minimum(self, column: str = "roi") -> float:
+        if self.streaming:
+            return self.statistics[column].minimum
+        return float(np.min(self.column(column))) if self.size else math.inf
+
+    def maximum(self, column: str = "roi") -> float:
+        if self.streaming:
+            return self.statistics[column].maximum
+        return float(np.max(self.column(column))) if self.size else -math.inf
+
+    @property
+    def baseline_value(self) -> np.ndarray:
+        return self.column("baseline_value")
+
+    @property
+    def total_value(self) -> np.ndarray:
+        return self.column("total_value")
+
+    @property
+    def money_contributed(self) -> np.ndarray:
+        return self.column("money_contributed")
+
+    @property
+    def roi(self) -> np.ndarray:
+        return self.column("roi")
+
+    @property
+    def money_refunded(self) -> np.ndarray:
+        return self.column("money_refunded")
+
+    @property
+    def espp_return(self) -> np.ndarray:
+        return self.column("espp_return")
+
+    @property
+    def baseline_value_sum(self) -> float:
+        return self.total("baseline_value")
+
+    @property
+    def total_value_sum(self) -> float:
+        return self.total("total_value")
+
+    @property
+    def money_contributed_sum(self) -> float:
+        return self.total("money_contributed")
+
+    @property
+    def roi_sum(self) -> float:
+        return self.total("roi")
+
+    @property
+    def money_refunded_sum(self) -> float:
+        return self.total("money_refunded")
+
+    @property
+    def espp_return_sum(self) -> float:
+        return self.total("espp_return")
+
+    @classmethod
+    def concat(cls, results: t.Iterable['ESPPResult']) -> 'ESPPResult':
+        """
+            Combines results in order into a single result. The sums are taken over the combined columns,
+            so the result is the same no matter how the price paths were split up.
+            Streaming results are merged into a streaming result.
+        """
+        results = list(results)
+        if any(result.streaming for result in results):
+            first_streaming = next(result for result in results if result.streaming)
+            combined = cls(
+                streaming=True,
+                histogram_bins=first_streaming.roi_histogram.shape[0],
+                histogram_range=(float(first_streaming.roi_histogram_edges[0]), float(first_streaming.roi_histogram_edges[-1]))
+            )
+        else:
+            combined = cls(capacity=sum(result.size for result in results))
+        for result in results:
+            combined.add(result)
+        return combined
@@ -1,18 +1,53 @@
 """
     Moved to its own file to avoid circular imports
 """
+import typing as t
+
+import numpy as np
+
 from models.company_plan import CompanyStockPlan
 from models.employee_options import EmployeeOptions
+from models.plan_schedule import PlanSchedule
 
 
 class ESPPState():
     """
         Object to contain the current state of the ESPP run. Helps abstract away a lot of the information that may be needed
         in calculating a espp strategy.
-    """
 
-    def __init__(self):
+        Uses __slots__ and running totals so strategies never have to scan the history: use last_contribution and
+        contributions_sum instead of contributions[-1] and sum(contributions).
+        The per period history is only kept when history_length is given, in preallocated arrays of that length.
+    """
+    __slots__ = (
+        "last_contribution",
+        "last_uninvested",
+        "contributions_sum",
+        "uninvested_sum",
+        "contributions_count",
+        "dollars_ready_for_purchase",
+        "total_contributed",
+        "shares_purchased",
+        "espp_dollar_value",
+        "irs_purchased_value",
+        "last_grant_price",
+        "current_stock_price",
+        "value_of_held_money",
+        "period",
+        "total_periods",
+        "money_refunded",
+        "schedule",
+        "_contributions",
+        "_uninvested"
+    )
+
+    def __init__(self, history_length: t.Optional[int] = None):
+        # The contribution and uninvested money of the previous period, and their running sums
         self.last_contribution = 0
+        self.last_uninvested = 0
+        self.contributions_sum = 0
+        self.uninvested_sum = 0
+        self.contributions_count = 0
         # Amount contributed to ESPP
         self.dollars_ready_for_purchase = 0
         # Amount contributed to ESPP over both stock plans
@@ -28,9 +63,9 @@ class ESPPState():
         self.last_grant_price = 0
         self.current_stock_price = 0
 
-        # The contributions and uninvested money for each period
-        self.contributions = []
-        self.uninvested = []
+        # The contributions and uninvested money for each period, only kept when history_length is given
+        self._contributions: t.Optional[np.ndarray] = np.zeros(history_length) if history_length is not None else None
+        self._uninvested: t.Optional[np.ndarray] = np.zeros(history_length) if history_length is not None else None
 
         # Represents money deliberately not contributed to the ESPP, and the interest gained on that money
         # If ignore_liquidity_preference is False, this money only represents returns from the ESPP
@@ -41,6 +76,46 @@ class ESPPState():
 
         self.money_refunded = 0
 
+        # The precomputed plan values of the run, set by the engine
+        self.schedule: t.Optional[PlanSchedule] = None
+
+    @property
+    def keeps_history(self) -> bool:
+        return self._contributions is not None
+
+    @property
+    def contributions(self) -> np.ndarray:
+        """
+            The contribution of every period so far. Only available when the state keeps history.
+        """
+        if self._contributions is None:
+            raise AttributeError(
+                "this ESPPState does not keep history, use last_contribution and contributions_sum "
+                "or set keep_history=True on the run or \"keep_history\": True on the strategy entry"
+            )
+        return self._contributions[:self.contributions_count]
+
+    @property
+    def uninvested(self) -> np.ndarray:
+        """
+            The uninvested money of every period so far. Only available when the state keeps history.
+        """
+        if self._uninvested is None:
+            raise AttributeError(
+                "this ESPPState does not keep history, use last_uninvested and uninvested_sum "
+                "or set keep_history=True on the run or \"keep_history\": True on the strategy entry"
+            )
+        return self._uninvested[:self.contributions_count]
+
+    def set_history(self, contributions: np.ndarray, uninvested: np.ndarray) -> None:
+        """
+            Replaces the history with already filled arrays, e.g. views into an ESPPBatchState.
+            The running totals are not changed.
+        """
+        self._contributions = contributions
+        self._uninvested = uninvested
+        self.contributions_count = contributions.shape[0]
+
     def update(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -48,13 +123,19 @@ class ESPPState():
     def update_value_of_held_money(self, rate_of_return, employee_options: EmployeeOptions):
         if not employee_options.ignore_liquidity_preference:
             self.value_of_held_money = (
-                self.value_of_held_money * 
-                (1 + (rate_of_return / 
+                self.value_of_held_money *
+                (1 + (rate_of_return /
                       (employee_options.company_stock_plan.pay_periods_per_offering * employee_options.company_stock_plan.offering_periods)
                       )
                 )
             )
 
+    def compound_held_money(self, held_money_growth: float):
+        """
+            update_value_of_held_money with the growth factor from the PlanSchedule.
+        """
+        self.value_of_held_money = self.value_of_held_money * held_money_growth
+
     def update_stock_values_after_purchase(self, shares_purchased_in_period: float, leftover_cash: float, stock_price: float, employee_options: EmployeeOptions) -> None:
         self.shares_purchased += shares_purchased_in_period
         self.espp_dollar_value += shares_purchased_in_period * stock_price
@@ -74,9 +155,15 @@ class ESPPState():
             self.value_of_held_money += (shares_purchased_in_period * stock_price)
 
     def update_contributions_and_uninvested(self, contribution, uninvested_money, employee_options: EmployeeOptions):
-        self.contributions.append(contribution)
-        self.uninvested.append(uninvested_money)
+        if self._contributions is not None and self._uninvested is not None:
+            self._contributions[self.contributions_count] = contribution
+            self._uninvested[self.contributions_count] = uninvested_money
+        self.contributions_count += 1
+        self.last_contribution = contribution
+        self.last_uninvested = uninvested_money
+        self.contributions_sum += contribution
+        self.uninvested_sum += uninvested_money
         if not employee_options.ignore_liquidity_preference:
             self.value_of_held_money += uninvested_money
         self.total_contributed += contribution
-        self.dollars_ready_for_purchase += contribution
\ No newline at end of file
+        self.dollars_ready_for_purchase += contribution
@@ -0,0 +1,97 @@
+import functools
+import math
+import typing as t
+
+from constants import MAX_PRICE_IRS
+from models.employee_options import EmployeeOptions
+
+
+class PlanSchedule:
+    """
+        Everything the engines and the built-in strategies derive from the plan and the options, computed once per
+        run instead of in every period. Per period values are tuples indexed by period, which are faster to read
+        one value at a time than numpy arrays. Use plan_schedule to get one, schedules are shared between runs with
+        the same plan and options.
+
+        offering_start: The period is the first of an offering period, period % pay_periods_per_offering == 0
+        purchase_period: Shares are purchased in the period, every offering start but the first period
+        before_last_offering: The period is before the last offering period
+        halfway_period: The period is halfway through an offering period, as readjust_halfway checks it
+        held_money_growth: Growth of the held money per period, None when the liquidity preference is ignored
+        max_pay_in: The company limit on the money contributed, also the cap on the ESPP dollar value
+        irs_contribution: MAX_PRICE_IRS spread evenly over every pay period
+        proportioned_contribution: The max contribution, lowered to irs_contribution
+        level_1_contribution, level_2_contribution: The contribution levels of maximize_for_large_periods
+        level_1_threshold, level_2_threshold: The probability needed to keep contributing at each level
+        expected_growth, expected_spread: (1 + expected_rate_of_return) ^ (period / 24) and volatility * sqrt(period / 24)
+    """
+    def __init__(
+        self,
+        total_periods: int,
+        pay_periods_per_offering: float,
+        offering_periods: float,
+        discount_rate: float,
+        max_contribution: float,
+        rate_of_return: float,
+        ignore_liquidity_preference: bool,
+        expected_rate_of_return: float,
+        volatility: float,
+        level_1_intercept: float,
+        level_1_slope: float,
+        level_2_intercept: float,
+        level_2_slope: float
+    ):
+        periods = range(total_periods)
+        self.total_periods = total_periods
+        self.pay_periods_per_offering = pay_periods_per_offering
+        self.offering_periods = offering_periods
+
+        self.offering_start = tuple(period % pay_periods_per_offering == 0 for period in periods)
+        self.purchase_period = tuple(period != 0 and period % pay_periods_per_offering == 0 for period in periods)
+        self.before_last_offering = tuple(period < pay_periods_per_offering * (offering_periods - 1) for period in periods)
+        self.halfway_period = tuple(period % pay_periods_per_offering == pay_periods_per_offering / offering_periods / 2 for period in periods)
+
+        self.held_money_growth = None if ignore_liquidity_preference else 1 + (rate_of_return / (pay_periods_per_offering * offering_periods))
+        self.max_pay_in = MAX_PRICE_IRS * discount_rate
+
+        self.irs_contribution = MAX_PRICE_IRS / (pay_periods_per_offering * offering_periods)
+        self.proportioned_contribution = min(max_contribution, self.irs_contribution)
+        self.level_1_contribution = min(max_contribution, MAX_PRICE_IRS * 2 / (pay_periods_per_offering * offering_periods))
+        self.level_2_contribution = min(max_contribution, MAX_PRICE_IRS / (pay_periods_per_offering * offering_periods))
+        self.level_1_threshold = tuple(level_1_intercept + level_1_slope * (period / pay_periods_per_offering) for period in periods)
+        self.level_2_threshold = tuple(level_2_intercept + level_2_slope * (period / pay_periods_per_offering) for period in periods)
+        self.expected_growth = tuple(math.pow((1 + expected_rate_of_return), period / 24) for period in periods)
+        self.expected_spread = tuple(volatility * math.sqrt(period / 24) for period in periods)
+
+    def __deepcopy__(self, memo) -> 'PlanSchedule':
+        # Never changed after it is built, so state snapshots share it
+        return self
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_plan_schedule(*values) -> PlanSchedule:
+    return PlanSchedule(*values)
+
+
+def plan_schedule(employee_options: EmployeeOptions, total_periods: int) -> PlanSchedule:
+    """
+        The schedule of a run of total_periods periods (price points) with employee_options. Cached by the values it
+        is built from, so options changed in place still get a matching schedule.
+    """
+    plan = employee_options.company_stock_plan
+    parameters = employee_options.strategy_parameters
+    return _cached_plan_schedule(
+        total_periods,
+        plan.pay_periods_per_offering,
+        plan.offering_periods,
+        plan.discount_rate,
+        employee_options.max_contribution,
+        employee_options.rate_of_return,
+        employee_options.ignore_liquidity_preference,
+        employee_options.company_stock_parameters.expected_rate_of_return,
+        employee_options.company_stock_parameters.volatility,
+        parameters.level_1_intercept,
+        parameters.level_1_slope,
+        parameters.level_2_intercept,
+        parameters.level_2_slope
+    )
@@ -0,0 +1,34 @@
+from dataclasses import asdict, dataclass
+
+
+@dataclass
+class StrategyParameters:
+    """
+        Tunable constants of the built-in strategies. The defaults are the values the strategies were written with.
+
+        maximize_for_large_periods:
+            level_1_intercept, level_1_slope: Contribute at level 1 while the probability is above
+                level_1_intercept + level_1_slope * (period / pay periods per offering).
+            level_2_intercept, level_2_slope: The same for level 2.
+            fill_factor: Share of the remaining IRS room contributed when neither level is reached.
+            std_dev_fraction: How far above the last grant price, in multiples of the volatility, the target price is.
+                0.5 is half a standard deviation.
+
+        readjust_halfway:
+            readjust_drop: Stop contributing halfway through an offering period if the stock has dropped
+                by more than this share of the last grant price.
+    """
+    level_1_intercept: float = 0.32
+    level_1_slope: float = 0.63
+    level_2_intercept: float = 0.32
+    level_2_slope: float = 0.43
+    fill_factor: float = 0.9
+    std_dev_fraction: float = 0.5
+    readjust_drop: float = 0.15
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'StrategyParameters':
+        return cls(**values)
@@ -0,0 +1,129 @@
+import concurrent.futures
+import math
+import os
+import typing as t
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from espp_batch_run import ESPPBatchRun
+from models.employee_options import EmployeeOptions
+from models.espp_batch_state import ESPPBatchState
+from models.espp_result import ESPPResult
+import strategies
+
+# Price matrix attached by each worker process in _attach_prices
+_worker_shared_memory: t.Optional[shared_memory.SharedMemory] = None
+_worker_prices: t.Optional[np.ndarray] = None
+
+
+def _attach_prices(shared_memory_name: str, shape: t.Tuple[int, ...], dtype: str):
+    """
+        Process pool initializer. Maps the parent's price matrix into this worker once, so chunks are read
+        from shared memory instead of being pickled with every task.
+    """
+    global _worker_shared_memory, _worker_prices
+    _worker_shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+    _worker_prices = np.ndarray(shape, dtype=dtype, buffer=_worker_shared_memory.buf)
+
+
+def _run_chunk(
+    start: int,
+    stop: int,
+    employee_options: EmployeeOptions,
+    step_function: t.Callable[[EmployeeOptions, ESPPBatchState], np.ndarray]
+) -> ESPPResult:
+    assert _worker_prices is not None, "worker was not initialized with _attach_prices"
+    return ESPPBatchRun(_worker_prices[start:stop], employee_options, step_function).run()
+
+
+class ParallelScenarioRunner():
+    """
+        Runs strategies over a price matrix with a process pool. The price matrix is copied once into shared memory,
+        split into chunks of rows, and each chunk is run with ESPPBatchRun in a worker process.
+        The chunk results are combined in order with ESPPResult.concat, so the result is identical to a serial run
+        no matter how many workers are used.
+
+        Use as a context manager so the pool and the shared memory are cleaned up:
+
+            with ParallelScenarioRunner(prices, workers=8) as runner:
+                result = runner.run(employee_options, strategy)
+    """
+    def __init__(
+        self,
+        prices: np.ndarray,
+        workers: t.Optional[int] = None,
+        chunk_size: t.Optional[int] = None
+    ):
+        """
+            workers: The number of worker processes. Defaults to the number of CPUs.
+            chunk_size: The number of price paths sent to a worker per task. Defaults to splitting the paths
+                into 4 chunks per worker, which keeps the workers busy if some chunks finish early.
+        """
+        self.prices = np.ascontiguousarray(np.atleast_2d(prices))
+        self.workers = workers or os.cpu_count() or 1
+        if chunk_size is None:
+            chunk_size = math.ceil(self.prices.shape[0] / (self.workers * 4))
+        self.chunk_size = max(int(chunk_size), 1)
+
+        self._shared_memory: t.Optional[shared_memory.SharedMemory] = None
+        self._executor: t.Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'ParallelScenarioRunner':
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=max(self.prices.nbytes, 1))
+        try:
+            shared_prices = np.ndarray(self.prices.shape, dtype=self.prices.dtype, buffer=self._shared_memory.buf)
+            shared_prices[:] = self.prices
+            del shared_prices
+
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_attach_prices,
+                initargs=(self._shared_memory.name, self.prices.shape, self.prices.dtype.str)
+            )
+        except BaseException:
+            # __exit__ is not called when __enter__ raises, so the segment would outlive the process
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory = None
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory = None
+
+    def chunks(self) -> t.List[t.Tuple[int, int]]:
+        return [
+            (start, min(start + self.chunk_size, self.prices.shape[0]))
+            for start in range(0, self.prices.shape[0], self.chunk_size)
+        ]
+
+    def submit(self, employee_options: EmployeeOptions, func: t.Dict[str, t.Any]) -> t.List[concurrent.futures.Future]:
+        """
+            Queues one strategy entry over every price path without waiting for it, and returns the futures
+            of its chunks in order. Pass them to collect to get the ESPPResult.
+        """
+        if self._executor is None:
+            raise RuntimeError("ParallelScenarioRunner must be used as a context manager")
+
+        step_function = strategies.get_batch_strategy(func)
+        return [
+            self._executor.submit(_run_chunk, start, stop, employee_options, step_function)
+            for start, stop in self.chunks()
+        ]
+
+    @staticmethod
+    def collect(futures: t.List[concurrent.futures.Future]) -> ESPPResult:
+        return ESPPResult.concat(future.result() for future in futures)
+
+    def run(self, employee_options: EmployeeOptions, func: t.Dict[str, t.Any]) -> ESPPResult:
+        """
+            Runs one strategy entry from the strategies registry over every price path.
+        """
+        return self.collect(self.submit(employee_options, func))
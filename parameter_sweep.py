@@ -0,0 +1,193 @@
+"""
+    Runs strategies over every combination of a grid of EmployeeOptions and CompanyStockPlan parameters,
+    instead of editing sample/main.py and re-running it for each value.
+
+        table = run_parameter_sweep(
+            prices,
+            cvs_employee_options,
+            {"max_contribution": [1000, 2000, 3000], "allows_lookback": [True, False]},
+            workers=8
+        )
+        table.to_csv("sweep.csv")
+
+    Every combination is run against the same price matrix, which is put in shared memory once for all of them.
+"""
+import csv
+import itertools
+import math
+import os
+import typing as t
+
+import numpy as np
+
+from models.company_plan import CompanyStockPlan
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+from parallel_run import ParallelScenarioRunner
+from stock_price import estimate_strategy_roi, run_strategy
+import strategies
+
+# Parameters that can be swept, and whether they belong to the CompanyStockPlan or the EmployeeOptions
+PLAN_PARAMETERS = ("discount_rate", "offering_periods", "pay_periods_per_offering", "cost_to_sell", "allows_lookback")
+EMPLOYEE_PARAMETERS = ("max_contribution", "liquidity_preference_rate", "capital_gains_tax_rate", "ignore_liquidity_preference", "steps_to_zero")
+
+RESULT_COLUMNS = (
+    "strategy",
+    "paths",
+    "mean_roi",
+    "roi_standard_error",
+    "roi_std",
+    "mean_total_value",
+    "mean_money_contributed",
+    "mean_money_refunded",
+    "mean_espp_return"
+)
+
+
+class SweepTable():
+    """
+        Tidy table of sweep results: one row per parameter combination and strategy, with one column per swept
+        parameter followed by RESULT_COLUMNS.
+    """
+    def __init__(self, parameters: t.Sequence[str], rows: t.Optional[t.List[t.Dict[str, t.Any]]] = None):
+        self.columns = tuple(parameters) + RESULT_COLUMNS
+        self.rows = rows if rows is not None else []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def column(self, name: str) -> t.List[t.Any]:
+        return [row[name] for row in self.rows]
+
+    def best(self, column: str = "mean_roi") -> t.Dict[str, t.Any]:
+        """
+            The row with the highest value in column.
+        """
+        return max(self.rows, key=lambda row: row[column])
+
+    def to_csv(self, file_name: str) -> str:
+        path = file_name if file_name.endswith('.csv') else f'{file_name}.csv'
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
+        return path
+
+
+def _employee_options_with(
+    employee_options: EmployeeOptions,
+    parameters: t.Dict[str, t.Any]
+) -> EmployeeOptions:
+    plan_values = employee_options.company_stock_plan.to_dict()
+    plan_values.update({name: value for name, value in parameters.items() if name in PLAN_PARAMETERS})
+    employee_values = {
+        "max_contribution": employee_options.max_contribution,
+        "liquidity_preference_rate": employee_options.rate_of_return,
+        "capital_gains_tax_rate": employee_options.capital_gains_tax_rate,
+        "ignore_liquidity_preference": employee_options.ignore_liquidity_preference,
+        "steps_to_zero": employee_options.steps_to_zero
+    }
+    employee_values.update({name: value for name, value in parameters.items() if name in EMPLOYEE_PARAMETERS})
+
+    return EmployeeOptions(
+        CompanyStockPlan.from_dict(plan_values),
+        employee_options.company_stock_parameters,
+        employee_values["max_contribution"],
+        employee_values["steps_to_zero"],
+        employee_values["liquidity_preference_rate"],
+        employee_values["capital_gains_tax_rate"],
+        employee_values["ignore_liquidity_preference"],
+        employee_options.default_to_max_allowed,
+        employee_options.strategy_parameters
+    )
+
+
+def sweep_combinations(
+    employee_options: EmployeeOptions,
+    grid: t.Dict[str, t.Sequence[t.Any]]
+) -> t.List[t.Tuple[t.Dict[str, t.Any], EmployeeOptions]]:
+    """
+        Every combination of the grid values, in the order of itertools.product over the grid, with the
+        EmployeeOptions it gives. Parameters not in the grid keep the value from employee_options.
+    """
+    unknown = set(grid) - set(PLAN_PARAMETERS) - set(EMPLOYEE_PARAMETERS)
+    if unknown:
+        raise ValueError(f"cannot sweep {', '.join(sorted(unknown))}, supported parameters are {', '.join(PLAN_PARAMETERS + EMPLOYEE_PARAMETERS)}")
+
+    names = list(grid)
+    combinations = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        parameters = dict(zip(names, values))
+        combinations.append((parameters, _employee_options_with(employee_options, parameters)))
+    return combinations
+
+
+def _result_row(
+    parameters: t.Dict[str, t.Any],
+    func: t.Dict[str, t.Any],
+    espp_result: ESPPResult,
+    terminal_prices: np.ndarray,
+    employee_options: EmployeeOptions
+) -> t.Dict[str, t.Any]:
+    roi_estimate = estimate_strategy_roi(espp_result, terminal_prices, employee_options)
+    return {
+        **parameters,
+        "strategy": func["name"],
+        "paths": espp_result.size,
+        "mean_roi": roi_estimate.mean,
+        "roi_standard_error": roi_estimate.standard_error,
+        "roi_std": espp_result.std("roi"),
+        "mean_total_value": espp_result.mean("total_value"),
+        "mean_money_contributed": espp_result.mean("money_contributed"),
+        "mean_money_refunded": espp_result.mean("money_refunded"),
+        "mean_espp_return": espp_result.mean("espp_return")
+    }
+
+
+def run_parameter_sweep(
+    prices: np.ndarray,
+    employee_options: EmployeeOptions,
+    grid: t.Dict[str, t.Sequence[t.Any]],
+    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None,
+    batch: bool = True,
+    workers: t.Optional[int] = 1,
+    jit: bool = False
+) -> SweepTable:
+    """
+        Runs every strategy in functions against every combination of grid over the same price paths.
+
+        grid maps parameter names from PLAN_PARAMETERS and EMPLOYEE_PARAMETERS to the values to try.
+        workers=1 runs in this process, any other value runs every combination and strategy at once on a
+        ParallelScenarioRunner, with None meaning one worker per CPU. jit always runs in this process, see strategy_runner.
+
+        The price matrix, its terminal prices for the ROI estimates and the strategy lookups don't depend on the
+        swept parameters, so they are set up once for the whole sweep.
+    """
+    if functions is None:
+        functions = strategies.get_all_strategies()
+    combinations = sweep_combinations(employee_options, grid)
+    terminal_prices = np.array(prices[:, -1])
+    table = SweepTable(list(grid))
+
+    if workers == 1 or jit:
+        for parameters, combination_options in combinations:
+            for func in functions:
+                espp_result = run_strategy(prices, combination_options, func, batch, jit)
+                table.rows.append(_result_row(parameters, func, espp_result, terminal_prices, combination_options))
+        return table
+
+    # Only split the paths into chunks when there are too few runs to keep every worker busy
+    worker_count = workers or os.cpu_count() or 1
+    runs = max(len(combinations) * len(functions), 1)
+    chunks_per_run = max(math.ceil(worker_count * 4 / runs), 1)
+    chunk_size = math.ceil(prices.shape[0] / chunks_per_run)
+
+    with ParallelScenarioRunner(prices, worker_count, chunk_size) as runner:
+        pending = [
+            (parameters, combination_options, func, runner.submit(combination_options, func))
+            for parameters, combination_options in combinations
+            for func in functions
+        ]
+        for parameters, combination_options, func, futures in pending:
+            table.rows.append(_result_row(parameters, func, runner.collect(futures), terminal_prices, combination_options))
+    return table
@@ -0,0 +1,190 @@
+"""
+    Per stage timing of strategy runs, to see whether the time goes into the strategy, the purchases, compounding
+    the held money or the charts.
+
+        with profiling.profile_run() as profile:
+            run_strategies_against_scenarios(prices, employee_options)
+        print(profile.table())
+        profile.to_json("profile.json")
+
+    The engines look up the active profile once per run and wrap their stages with instrument, which returns the
+    function itself when no profile is active, so the loops run the same code as without profiling.
+    Stages run in worker processes or compiled JIT kernels are not seen, profile with workers=1 and jit=False.
+"""
+import contextlib
+import json
+import time
+import tracemalloc
+import typing as t
+from dataclasses import asdict, dataclass
+
+_active_profile: t.Optional['Profile'] = None
+
+# Label of stages recorded outside of a strategy
+ALL_STRATEGIES = "all strategies"
+
+
+@dataclass
+class StageStatistics:
+    """
+        calls and total wall seconds of a stage. peak_allocated_bytes is the most memory allocated during one call,
+        when allocations are tracked.
+    """
+    calls: int = 0
+    seconds: float = 0.0
+    peak_allocated_bytes: int = 0
+
+
+class Profile():
+    """
+        Stage statistics per strategy, filled while the profile is active.
+    """
+    def __init__(self, track_allocations: bool = False):
+        self.track_allocations = track_allocations
+        self.strategy = ALL_STRATEGIES
+        self.stages: t.Dict[str, t.Dict[str, StageStatistics]] = {}
+        # [memory when the stage started, most memory above that so far] of each stage being timed
+        self._allocation_stack: t.List[t.List[int]] = []
+
+    def _start_allocations(self) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        if self._allocation_stack:
+            # The peak is reset for the inner stage, so the outer stage keeps what it reached until now
+            outer = self._allocation_stack[-1]
+            outer[1] = max(outer[1], peak - outer[0])
+        tracemalloc.reset_peak()
+        self._allocation_stack.append([current, 0])
+
+    def _stop_allocations(self) -> int:
+        _, peak = tracemalloc.get_traced_memory()
+        start, stage_peak = self._allocation_stack.pop()
+        if self._allocation_stack:
+            outer = self._allocation_stack[-1]
+            outer[1] = max(outer[1], peak - outer[0])
+        return max(stage_peak, peak - start)
+
+    def record(self, stage: str, seconds: float, allocated_bytes: int = 0) -> None:
+        statistics = self.stages.setdefault(self.strategy, {}).setdefault(stage, StageStatistics())
+        statistics.calls += 1
+        statistics.seconds += seconds
+        statistics.peak_allocated_bytes = max(statistics.peak_allocated_bytes, allocated_bytes)
+
+    def to_dict(self) -> t.Dict[str, t.Dict[str, t.Dict[str, float]]]:
+        return {
+            strategy: {stage: asdict(statistics) for stage, statistics in stages.items()}
+            for strategy, stages in self.stages.items()
+        }
+
+    def to_json(self, file_name: t.Optional[str] = None) -> str:
+        report = json.dumps(self.to_dict(), indent=2)
+        if file_name is not None:
+            with open(file_name, 'w') as report_file:
+                report_file.write(report)
+        return report
+
+    def table(self) -> str:
+        """
+            One line per strategy and stage, slowest stages first, with the share of the strategy's 'run' stage.
+        """
+        width = max([len(strategy) for strategy in self.stages] + [len("strategy")])
+        lines = [f'{"strategy":<{width}} {"stage":<16} {"calls":>10} {"seconds":>10} {"% of run":>9} {"us/call":>10} {"peak MiB":>9}']
+        for strategy, stages in self.stages.items():
+            run_seconds = stages["run"].seconds if "run" in stages else 0.0
+            for stage, statistics in sorted(stages.items(), key=lambda item: -item[1].seconds):
+                share = f'{statistics.seconds / run_seconds:>9.1%}' if run_seconds else f'{"":>9}'
+                lines.append(
+                    f'{strategy:<{width}} {stage:<16} {statistics.calls:>10} {statistics.seconds:>10.4f} {share} '
+                    f'{statistics.seconds / statistics.calls * 1e6:>10.2f} {statistics.peak_allocated_bytes / 2**20:>9.2f}'
+                )
+        return '\n'.join(lines)
+
+
+def active_profile() -> t.Optional[Profile]:
+    return _active_profile
+
+
+@contextlib.contextmanager
+def profile_run(track_allocations: bool = False) -> t.Iterator[Profile]:
+    """
+        Profiles everything run inside the block. track_allocations also records the peak memory allocated by each
+        stage with tracemalloc, which slows down the run a lot more than the timing alone.
+    """
+    global _active_profile
+    previous = _active_profile
+    profile = Profile(track_allocations)
+    started_tracing = track_allocations and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _active_profile = profile
+    try:
+        yield profile
+    finally:
+        _active_profile = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def _strategy_label(profile: Profile, strategy: str) -> t.Iterator[None]:
+    previous = profile.strategy
+    profile.strategy = strategy
+    try:
+        yield
+    finally:
+        profile.strategy = previous
+
+
+def strategy(name: str) -> t.ContextManager[None]:
+    """
+        Records the stages run inside the block under the strategy name.
+    """
+    profile = _active_profile
+    if profile is None:
+        return contextlib.nullcontext()
+    return _strategy_label(profile, name)
+
+
+@contextlib.contextmanager
+def _timed_stage(profile: Profile, name: str) -> t.Iterator[None]:
+    if profile.track_allocations:
+        profile._start_allocations()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        profile.record(name, seconds, profile._stop_allocations() if profile.track_allocations else 0)
+
+
+def stage(name: str) -> t.ContextManager[None]:
+    """
+        Times the block as one call of the stage, for code run once per strategy. Loops wrap their functions with instrument.
+    """
+    profile = _active_profile
+    if profile is None:
+        return contextlib.nullcontext()
+    return _timed_stage(profile, name)
+
+
+_F = t.TypeVar('_F', bound=t.Callable[..., t.Any])
+
+
+def instrument(profile: t.Optional[Profile], name: str, function: _F) -> _F:
+    """
+        function itself without a profile, otherwise a wrapper recording every call as the stage name.
+    """
+    if profile is None:
+        return function
+
+    if profile.track_allocations:
+        def timed(*args, **kwargs):
+            with _timed_stage(profile, name):
+                return function(*args, **kwargs)
+    else:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.record(name, time.perf_counter() - start)
+    return t.cast(_F, timed)
@@ -0,0 +1,184 @@
+"""
+    On-disk cache of strategy results, so running the same strategy over the same price paths with the same
+    options again, for example to redraw charts, loads the result instead of simulating it.
+
+    A result is keyed by:
+        - a content hash of the price matrix, its shape and dtype
+        - the module, name and source code hash of the strategy functions
+        - the EmployeeOptions, including the CompanyStockPlan, serialized as sorted JSON
+        - CACHE_VERSION, bumped whenever a change to the engines changes results
+
+    Each result is one .npy file. The cache is bounded in bytes, and the least recently used files are removed first.
+"""
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import typing as t
+
+import numpy as np
+
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+# Rows hashed at a time, so memory mapped price files are not loaded all at once
+_HASH_ROWS = 65536
+
+
+def default_cache_directory() -> str:
+    return os.environ.get("ESPP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "espp_results"))
+
+
+def hash_prices(prices: np.ndarray) -> str:
+    """
+        Content hash of a price matrix. Equal prices give equal hashes whether they were loaded from a CSV file,
+        a scenario file or generated in memory, as long as the dtype is the same.
+    """
+    prices = np.atleast_2d(prices)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps({"shape": prices.shape, "dtype": prices.dtype.str}).encode('utf-8'))
+    for start in range(0, prices.shape[0], _HASH_ROWS):
+        digest.update(np.ascontiguousarray(prices[start:start + _HASH_ROWS]).data)
+    return digest.hexdigest()
+
+
+def _callable_fingerprint(func: t.Optional[t.Callable]) -> t.Optional[str]:
+    if func is None:
+        return None
+    target = func if inspect.isfunction(func) or inspect.ismethod(func) else type(func)
+    try:
+        source = inspect.getsource(target)
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        source = repr((code.co_code, code.co_consts)) if code is not None else repr(func)
+    # ScalarStrategyAdapter and similar wrappers are identified by the function they wrap
+    wrapped = getattr(func, "step_function", None)
+    return "{}.{}:{}:{}".format(
+        getattr(target, "__module__", ""),
+        getattr(target, "__qualname__", repr(target)),
+        hashlib.sha256(source.encode('utf-8')).hexdigest(),
+        _callable_fingerprint(wrapped) if callable(wrapped) else ""
+    )
+
+
+def strategy_fingerprint(func: t.Dict[str, t.Any]) -> t.Dict[str, t.Optional[str]]:
+    """
+        Identity and source hash of the scalar and batch functions of a strategy entry.
+    """
+    return {
+        "strategy": _callable_fingerprint(func.get("strategy")),
+        "batch_strategy": _callable_fingerprint(func.get("batch_strategy"))
+    }
+
+
+class ResultCache():
+    """
+        Size bounded LRU cache of ESPPResults in a directory.
+
+            cache = ResultCache()
+            price_hash = hash_prices(prices)
+            result = cache.get_or_run(cache.key(price_hash, employee_options, func), lambda: run_strategy(prices, employee_options, func))
+
+        Streaming results don't keep per path values and are never cached.
+    """
+    SUFFIX = '.npy'
+
+    def __init__(self, directory: t.Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory if directory is not None else default_cache_directory()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, price_hash: str, employee_options: EmployeeOptions, func: t.Dict[str, t.Any]) -> str:
+        serialized = json.dumps(
+            {
+                "version": CACHE_VERSION,
+                "prices": price_hash,
+                "strategy": strategy_fingerprint(func),
+                "employee_options": employee_options.to_dict()
+            },
+            sort_keys=True,
+            default=float
+        )
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}{self.SUFFIX}')
+
+    def get(self, key: str) -> t.Optional[ESPPResult]:
+        path = self._path(key)
+        try:
+            values = np.load(path, allow_pickle=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # A partially written or corrupted entry is dropped and treated as a miss
+            self._remove(path)
+            return None
+        if values.ndim != 2 or values.shape[0] != len(ESPPResult.COLUMNS):
+            self._remove(path)
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return ESPPResult(**dict(zip(ESPPResult.COLUMNS, values)))
+
+    def put(self, key: str, espp_result: ESPPResult) -> None:
+        if espp_result.streaming:
+            return
+        values = np.stack([espp_result.column(column) for column in ESPPResult.COLUMNS])
+        # Written to a temporary file first so readers never see a partial entry
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                np.save(cache_file, values, allow_pickle=False)
+            os.replace(temporary_path, self._path(key))
+        except BaseException:
+            self._remove(temporary_path)
+            raise
+        self.evict()
+
+    def get_or_run(self, key: str, run: t.Callable[[], ESPPResult]) -> ESPPResult:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        espp_result = run()
+        self.put(key, espp_result)
+        return espp_result
+
+    def _entries(self) -> t.List[t.Tuple[float, int, str]]:
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith(self.SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """
+            Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self) -> None:
+        for _, _, path in self._entries():
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
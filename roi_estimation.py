@@ -0,0 +1,119 @@
+"""
+    Mean ROI estimates with standard errors, so runs can be sized by the error they need instead of a fixed
+    number of simulations.
+"""
+import math
+import typing as t
+from dataclasses import dataclass
+
+import numpy as np
+
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from models.espp_result import ESPPResult
+
+
+@dataclass
+class ROIEstimate:
+    """
+        mean is the estimated mean ROI and standard_error its standard error.
+        method is "plain" for the sample mean, or "control_variate" when the terminal stock price was used
+        as a control variate, with control_coefficient the fitted coefficient.
+    """
+    mean: float
+    standard_error: float
+    paths: int
+    method: str = "plain"
+    control_coefficient: float = 0.0
+
+
+def expected_terminal_price(company_stock_start_parameters: CompanyStockStartParameters, time_frame: float = 1) -> float:
+    """
+        The known mean of the simulated price after time_frame years, S(0) * exp(r * T). The paths are
+        log-normal with drift r - 0.5 * sigma^2, so their mean grows at the expected rate of return.
+    """
+    return company_stock_start_parameters.initial_price * math.exp(company_stock_start_parameters.expected_rate_of_return * time_frame)
+
+
+def _independent_units(values: np.ndarray, antithetic: bool) -> np.ndarray:
+    """
+        Antithetic pairs are not independent of each other's paths, so their standard error is taken over the pair means.
+        An odd path left over at the end is kept as its own unit.
+    """
+    if not antithetic:
+        return values
+    paired = values.shape[0] // 2 * 2
+    units = (values[0:paired:2] + values[1:paired:2]) / 2
+    return np.concatenate([units, values[paired:]])
+
+
+def estimate_mean_roi(
+    roi: t.Sequence[float],
+    terminal_prices: t.Optional[np.ndarray] = None,
+    expected_terminal: t.Optional[float] = None,
+    antithetic: bool = False
+) -> ROIEstimate:
+    """
+        Estimates the mean ROI over the paths.
+
+        terminal_prices and expected_terminal: The last simulated price of each path and its known mean. When given,
+            the terminal price is used as a control variate: ROI is strongly correlated with the terminal price, so
+            correcting the mean by how far the sampled terminal prices are from their known mean removes much of the noise.
+        antithetic: Set when the paths were generated with shocks="antithetic", so the standard error accounts for the pairs.
+
+        For Sobol' paths the standard error is computed as if the paths were independent, which overstates it.
+    """
+    values = np.asarray(roi, dtype=float)
+    paths = values.shape[0]
+    if paths == 0:
+        return ROIEstimate(mean=0.0, standard_error=math.inf, paths=0)
+
+    units = _independent_units(values, antithetic)
+
+    if terminal_prices is None or expected_terminal is None:
+        standard_error = float(np.std(units, ddof=1) / math.sqrt(units.shape[0])) if units.shape[0] > 1 else math.inf
+        return ROIEstimate(mean=float(np.mean(values)), standard_error=standard_error, paths=paths)
+
+    control = np.asarray(terminal_prices, dtype=float)
+    control_units = _independent_units(control, antithetic)
+
+    control_variance = np.var(control_units, ddof=1) if control_units.shape[0] > 1 else 0.0
+    control_coefficient = float(np.cov(units, control_units, ddof=1)[0, 1] / control_variance) if control_variance > 0 else 0.0
+
+    mean = float(np.mean(values) - control_coefficient * (np.mean(control) - expected_terminal))
+    residuals = units - control_coefficient * control_units
+    standard_error = float(np.std(residuals, ddof=1) / math.sqrt(units.shape[0])) if units.shape[0] > 1 else math.inf
+
+    return ROIEstimate(
+        mean=mean,
+        standard_error=standard_error,
+        paths=paths,
+        method="control_variate",
+        control_coefficient=control_coefficient
+    )
+
+
+def estimate_from_statistics(espp_result: ESPPResult) -> ROIEstimate:
+    """
+        Plain mean ROI estimate from the running statistics of a streaming ESPPResult.
+    """
+    if espp_result.size < 2:
+        return ROIEstimate(mean=espp_result.mean("roi"), standard_error=math.inf, paths=espp_result.size)
+    # Sample standard deviation from the population variance the running statistics keep
+    sample_std = espp_result.std("roi") * math.sqrt(espp_result.size / (espp_result.size - 1))
+    return ROIEstimate(
+        mean=espp_result.mean("roi"),
+        standard_error=sample_std / math.sqrt(espp_result.size),
+        paths=espp_result.size
+    )
+
+
+def paths_for_target_error(estimate: ROIEstimate, target_standard_error: float) -> int:
+    """
+        The number of paths needed to bring the estimate's standard error down to target_standard_error,
+        using that the standard error shrinks with the square root of the number of paths.
+    """
+    if target_standard_error <= 0:
+        raise ValueError("target_standard_error must be positive")
+    if not math.isfinite(estimate.standard_error):
+        raise ValueError("the estimate needs at least 2 independent paths to size a run")
+    return max(math.ceil(estimate.paths * (estimate.standard_error / target_standard_error) ** 2), 1)
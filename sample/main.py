@@ -1,15 +1,16 @@
 import os
 import sys
 
-import numpy as np
-
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from constants_company_plans import cvs_stock_plan
 from constants_company_stock_start_parameters import cvs_stock_params
 from constants_employee_options import cvs_employee_options
 
 
+from parameter_sweep import run_parameter_sweep
+from scenario_store import load_prices
 from stock_price import generate_scenarios, run_strategies_against_scenarios
+from volatility_surface import calibrate_volatility_surface, load_option_chain
 
 def sample_full_run_main():
     price_sets = generate_scenarios(
@@ -19,12 +20,49 @@ def sample_full_run_main():
     run_strategies_against_scenarios(price_sets, cvs_employee_options)
 
 def sample_load_file_main(file: str):
-    # Example: prices_CVS_20250119_140005.csv
-    price_sets = np.loadtxt(file, delimiter=',')
+    # Example: prices_CVS_20250119_140005.scenarios, or an older prices_CVS_20250119_140005.csv
+    # Scenario files are memory mapped, so paths are only read from disk as they are simulated
+    price_sets = load_prices(file)
+    run_strategies_against_scenarios(price_sets, cvs_employee_options)
+
+def sample_sweep_main():
+    # Runs every strategy for each combination over one set of price paths, instead of editing the options by hand
+    price_sets = generate_scenarios(
+        cvs_stock_plan,
+        cvs_stock_params
+    )
+    table = run_parameter_sweep(
+        price_sets,
+        cvs_employee_options,
+        {
+            "max_contribution": [1000, 2000, 3000],
+            "capital_gains_tax_rate": [0.15, 0.2],
+            "allows_lookback": [True, False]
+        },
+        workers=None
+    )
+    print(table.best())
+    table.to_csv('sweep_CVS')
+
+def sample_calibrated_run_main(option_chain_file: str):
+    # Example: CVS_options.csv, with the volatility of each pay period calibrated from the option chain
+    # instead of the hand typed volatility in cvs_stock_params
+    surface = calibrate_volatility_surface(load_option_chain(option_chain_file), risk_free_rate=0.04)
+    stock_params = surface.start_parameters(cvs_stock_plan, cvs_stock_params.expected_rate_of_return)
+    price_sets = generate_scenarios(
+        cvs_stock_plan,
+        stock_params
+    )
     run_strategies_against_scenarios(price_sets, cvs_employee_options)
 
 if __name__ == "__main__":
+    # python main.py, python main.py sweep, python main.py calibrate CVS_options.csv
+    # or python main.py prices_CVS_20250119_140005.scenarios
     if len(sys.argv) == 1:
         sample_full_run_main()
+    elif sys.argv[1] == "sweep":
+        sample_sweep_main()
+    elif sys.argv[1] == "calibrate":
+        sample_calibrated_run_main(sys.argv[2])
     else:
         sample_load_file_main(sys.argv[1])
\ No newline at end of file
@@ -0,0 +1,189 @@
+"""
+    Binary storage for simulated price paths.
+
+    A scenario file is a small JSON header followed by the raw price matrix in C order:
+
+        8 bytes   magic, b'ESPPSCN' followed by the format version
+        8 bytes   little endian length of the JSON header, including padding
+        n bytes   JSON header, padded with spaces so the prices start on a 64 byte boundary
+        rest      prices, shape and dtype given in the header
+
+    The header carries the CompanyStockPlan and CompanyStockStartParameters that produced the paths.
+    Because the prices are stored raw, they can be memory mapped and read without parsing or copying.
+"""
+import json
+import os
+import typing as t
+from dataclasses import dataclass, field
+
+import numpy as np
+import numpy.typing as npt
+
+from models.company_plan import CompanyStockPlan
+from models.company_stock_start_parameters import CompanyStockStartParameters
+
+SCENARIO_FILE_EXTENSION = '.scenarios'
+_MAGIC = b'ESPPSCN\x01'
+_ALIGNMENT = 64
+
+
+@dataclass
+class ScenarioSet:
+    """
+        Price paths loaded from a scenario file, with the parameters that generated them.
+
+        prices is a read only memory map when loaded with mmap=True, so rows are only read from disk when used.
+    """
+    prices: np.ndarray
+    company_stock_plan: CompanyStockPlan
+    company_stock_start_parameters: CompanyStockStartParameters
+    metadata: t.Dict[str, t.Any] = field(default_factory=dict)
+
+
+def scenario_file_path(file_name: str) -> str:
+    return file_name if file_name.endswith(SCENARIO_FILE_EXTENSION) else f'{file_name}{SCENARIO_FILE_EXTENSION}'
+
+
+def _encode_header(header: t.Dict[str, t.Any]) -> bytes:
+    encoded = json.dumps(header, default=float).encode('utf-8')
+    data_start = len(_MAGIC) + 8 + len(encoded)
+    padding = -data_start % _ALIGNMENT
+    return encoded + b' ' * padding
+
+
+class ScenarioWriter():
+    """
+        Writes price paths to a scenario file block by block, so paths from iter_scenarios can be stored
+        without holding the whole matrix in memory. The total number of paths must be known up front.
+
+            with ScenarioWriter(file_name, simulations, steps + 1, plan, parameters) as writer:
+                for block in iter_scenarios(plan, parameters, simulations):
+                    writer.write(block)
+    """
+    def __init__(
+        self,
+        file_name: str,
+        simulations: int,
+        periods: int,
+        company_stock_plan: CompanyStockPlan,
+        company_stock_start_parameters: CompanyStockStartParameters,
+        dtype: npt.DTypeLike = np.float64,
+        metadata: t.Optional[t.Dict[str, t.Any]] = None
+    ):
+        self.path = scenario_file_path(file_name)
+        self.shape = (int(simulations), int(periods))
+        self.dtype = np.dtype(dtype)
+        self.header = {
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "company_stock_plan": company_stock_plan.to_dict(),
+            "company_stock_start_parameters": company_stock_start_parameters.to_dict(),
+            "metadata": metadata or {}
+        }
+        self.rows_written = 0
+        self._file: t.Optional[t.BinaryIO] = None
+
+    def __enter__(self) -> 'ScenarioWriter':
+        encoded_header = _encode_header(self.header)
+        self._file = open(self.path, 'wb')
+        self._file.write(_MAGIC)
+        self._file.write(len(encoded_header).to_bytes(8, 'little'))
+        self._file.write(encoded_header)
+        return self
+
+    def write(self, prices: np.ndarray) -> None:
+        if self._file is None:
+            raise RuntimeError("ScenarioWriter must be used as a context manager")
+        prices = np.ascontiguousarray(prices, dtype=self.dtype)
+        if prices.ndim != 2 or prices.shape[1] != self.shape[1]:
+            raise ValueError(f"expected blocks with {self.shape[1]} periods, got shape {prices.shape}")
+        if self.rows_written + prices.shape[0] > self.shape[0]:
+            raise ValueError(f"more than the {self.shape[0]} declared paths were written")
+        self._file.write(prices.tobytes())
+        self.rows_written += prices.shape[0]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if exc_type is None and self.rows_written != self.shape[0]:
+            raise ValueError(f"{self.rows_written} paths were written, but {self.shape[0]} were declared")
+
+
+def save_scenarios(
+    file_name: str,
+    prices: np.ndarray,
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    metadata: t.Optional[t.Dict[str, t.Any]] = None
+) -> str:
+    """
+        Saves a full price matrix to a scenario file and returns the path written.
+    """
+    prices = np.atleast_2d(prices)
+    with ScenarioWriter(
+        file_name,
+        prices.shape[0],
+        prices.shape[1],
+        company_stock_plan,
+        company_stock_start_parameters,
+        prices.dtype,
+        metadata
+    ) as writer:
+        writer.write(prices)
+    return writer.path
+
+
+def read_scenario_header(file_name: str) -> t.Tuple[t.Dict[str, t.Any], int]:
+    """
+        Returns the JSON header of a scenario file and the byte offset where the prices start.
+    """
+    with open(file_name, 'rb') as scenario_file:
+        magic = scenario_file.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError(f"{file_name} is not a scenario file")
+        header_length = int.from_bytes(scenario_file.read(8), 'little')
+        header = json.loads(scenario_file.read(header_length).decode('utf-8'))
+    return header, len(_MAGIC) + 8 + header_length
+
+
+def load_scenarios(file_name: str, mmap: bool = True) -> ScenarioSet:
+    """
+        Loads a scenario file. With mmap the prices are memory mapped read only instead of read into memory.
+    """
+    header, offset = read_scenario_header(file_name)
+    shape = tuple(header["shape"])
+    dtype = np.dtype(header["dtype"])
+
+    if mmap:
+        prices = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        prices = np.fromfile(file_name, dtype=dtype, offset=offset).reshape(shape)
+
+    return ScenarioSet(
+        prices=prices,
+        company_stock_plan=CompanyStockPlan.from_dict(header["company_stock_plan"]),
+        company_stock_start_parameters=CompanyStockStartParameters.from_dict(header["company_stock_start_parameters"]),
+        metadata=header.get("metadata", {})
+    )
+
+
+def export_csv(file_name: str, prices: np.ndarray, chunk_size: int = 100_000) -> str:
+    """
+        Writes price paths to a CSV file in the format np.loadtxt(file, delimiter=',') reads.
+        Rows are formatted in chunks so a memory mapped matrix is never fully loaded.
+    """
+    path = file_name if file_name.endswith('.csv') else f'{file_name}.csv'
+    with open(path, 'w') as csv_file:
+        for start in range(0, prices.shape[0], chunk_size):
+            np.savetxt(csv_file, prices[start:start + chunk_size], delimiter=',')
+    return path
+
+
+def load_prices(file_name: str, mmap: bool = True) -> np.ndarray:
+    """
+        Loads price paths from either a scenario file or a CSV file written by an older version.
+    """
+    if os.path.splitext(file_name)[1].lower() == '.csv':
+        return np.loadtxt(file_name, delimiter=',')
+    return load_scenarios(file_name, mmap).prices
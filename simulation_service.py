@@ -0,0 +1,440 @@
+"""
+    Asyncio service running employees' options against warm price matrices, for an internal endpoint where each
+    request is one employee's EmployeeOptions.
+
+        async with SimulationService(simulations=10_000, workers=4) as service:
+            outcomes = await service.simulate(employee_options)
+
+        python simulation_service.py --port 8080
+        curl -d '{"employee_options": {...}}' localhost:8080/simulate
+
+    The price matrix of each stock is generated once, by its CompanyStockStartParameters and the number of pay
+    periods, and kept in shared memory for the worker processes, so requests never generate or load prices.
+    Requests arriving within batch_window seconds of each other are sent to the process pool as one task per stock.
+    Identical requests share one run, and requests whose options only differ in ESPPBatchRun.POST_PROCESSING_OPTIONS
+    share one engine run through ESPPBatchRun.rerun. While every worker is busy requests keep queueing, so batches
+    grow with the load instead of the queue.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import typing as t
+from dataclasses import asdict, dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from espp_batch_run import ESPPBatchRun
+from models.company_plan import CompanyStockPlan
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from models.employee_options import EmployeeOptions
+from roi_estimation import ROIEstimate, estimate_mean_roi, expected_terminal_price
+from stock_price import generate_scenario_rows
+import strategies
+
+ROI_PERCENTILES = (5, 25, 50, 75, 95)
+
+# (options, strategy names) of one request, as sent to a worker
+_Job = t.Tuple[EmployeeOptions, t.Tuple[str, ...]]
+
+# Price matrices attached by a worker process, by shared memory name, least recently used first
+_worker_matrices: 'collections.OrderedDict[str, t.Tuple[shared_memory.SharedMemory, np.ndarray]]' = collections.OrderedDict()
+_WORKER_MATRICES = 8
+
+
+@dataclass
+class StrategyOutcome:
+    """
+        The outcome of one strategy for one employee, small enough to send back for every request
+        instead of the per path ESPPResult.
+    """
+    name: str
+    roi_estimate: ROIEstimate
+    roi_percentiles: t.Dict[int, float]
+    mean_total_value: float
+    mean_money_contributed: float
+    mean_money_refunded: float
+
+
+@dataclass
+class ServiceStatistics:
+    """
+        Counts since the service started. engine_runs is below requests when requests were coalesced.
+    """
+    requests: int = 0
+    batches: int = 0
+    engine_runs: int = 0
+    matrices_generated: int = 0
+
+
+def _matrix_key(company_stock_plan: CompanyStockPlan, company_stock_start_parameters: CompanyStockStartParameters) -> str:
+    # The paths only depend on the number of pay periods of the plan, so plans with the same schedule share them
+    steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
+    return json.dumps({"steps": steps, "parameters": company_stock_start_parameters.to_dict()}, sort_keys=True)
+
+
+def _options_key(employee_options: EmployeeOptions, ignore: t.Sequence[str] = ()) -> str:
+    return json.dumps({key: value for key, value in employee_options.to_dict().items() if key not in ignore}, sort_keys=True)
+
+
+def _attach_matrix(shared_memory_name: str, shape: t.Tuple[int, ...], dtype: str) -> np.ndarray:
+    """
+        Maps a price matrix into this worker the first time a task uses it. Matrices the service has since
+        dropped are closed once more than _WORKER_MATRICES are attached.
+    """
+    if shared_memory_name in _worker_matrices:
+        _worker_matrices.move_to_end(shared_memory_name)
+        return _worker_matrices[shared_memory_name][1]
+    matrix_memory = shared_memory.SharedMemory(name=shared_memory_name)
+    _worker_matrices[shared_memory_name] = (matrix_memory, np.ndarray(shape, dtype=dtype, buffer=matrix_memory.buf))
+    while len(_worker_matrices) > _WORKER_MATRICES:
+        _, (old_memory, _) = _worker_matrices.popitem(last=False)
+        old_memory.close()
+    return _worker_matrices[shared_memory_name][1]
+
+
+def _outcome(name: str, espp_result, prices: np.ndarray, employee_options: EmployeeOptions, antithetic: bool) -> StrategyOutcome:
+    roi = espp_result.roi
+    return StrategyOutcome(
+        name=name,
+        roi_estimate=estimate_mean_roi(roi, prices[:, -1], expected_terminal_price(employee_options.company_stock_parameters), antithetic),
+        roi_percentiles={percentile: float(value) for percentile, value in zip(ROI_PERCENTILES, np.percentile(roi, ROI_PERCENTILES))},
+        mean_total_value=float(np.mean(espp_result.total_value)),
+        mean_money_contributed=float(np.mean(espp_result.money_contributed)),
+        mean_money_refunded=float(np.mean(espp_result.money_refunded))
+    )
+
+
+def _run_batch(
+    shared_memory_name: str,
+    shape: t.Tuple[int, ...],
+    dtype: str,
+    jobs: t.List[_Job],
+    antithetic: bool
+) -> t.Tuple[t.List[t.List[StrategyOutcome]], int]:
+    """
+        Runs the jobs of one batch over one price matrix, in a worker process. Jobs running the same strategy
+        with options that only differ in post processing options share one engine run.
+        Returns the outcomes of each job, in order, and the number of engine runs.
+    """
+    prices = _attach_matrix(shared_memory_name, shape, dtype)
+    functions = {func["name"]: func for func in strategies.get_all_strategies()}
+
+    groups: t.Dict[t.Tuple[str, str], t.List[t.Tuple[int, int]]] = {}
+    for job_index, (employee_options, names) in enumerate(jobs):
+        options_key = _options_key(employee_options, ESPPBatchRun.POST_PROCESSING_OPTIONS)
+        for name_index, name in enumerate(names):
+            groups.setdefault((name, options_key), []).append((job_index, name_index))
+
+    outcomes: t.List[t.List[t.Optional[StrategyOutcome]]] = [[None] * len(names) for _, names in jobs]
+    for (name, _), members in groups.items():
+        first_job, first_name = members[0]
+        run = ESPPBatchRun(prices, jobs[first_job][0], strategies.get_batch_strategy(functions[name]), keep_snapshots=len(members) > 1)
+        result = run.run()
+        outcomes[first_job][first_name] = _outcome(name, result, prices, jobs[first_job][0], antithetic)
+        for job_index, name_index in members[1:]:
+            employee_options = jobs[job_index][0]
+            outcomes[job_index][name_index] = _outcome(name, run.rerun(employee_options), prices, employee_options, antithetic)
+    return t.cast(t.List[t.List[StrategyOutcome]], outcomes), len(groups)
+
+
+class _WarmMatrix():
+    """
+        A price matrix in shared memory.
+    """
+    def __init__(self, prices: np.ndarray):
+        self.shape = prices.shape
+        self.dtype = prices.dtype.str
+        self.memory = shared_memory.SharedMemory(create=True, size=max(prices.nbytes, 1))
+        np.ndarray(self.shape, dtype=prices.dtype, buffer=self.memory.buf)[:] = prices
+
+    def close(self) -> None:
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SimulationService():
+    """
+        Runs requests from many coroutines against warm price matrices with a process pool.
+        Use as an async context manager so the pool, the batching task and the shared memory are cleaned up.
+    """
+    def __init__(
+        self,
+        simulations: int = 10_000,
+        seed: int = 0,
+        shocks: str = "pseudo",
+        workers: t.Optional[int] = None,
+        batch_window: float = 0.002,
+        max_batch_size: int = 64,
+        max_matrices: int = 16
+    ):
+        """
+            simulations: The number of price paths of each warm matrix
+            seed, shocks: Passed to generate_scenario_rows, every matrix is generated with the same seed
+            workers: The number of worker processes. Defaults to the number of CPUs.
+            batch_window: How long a batch waits for more requests after its first one, in seconds
+            max_batch_size: The most requests sent to the pool as one batch
+            max_matrices: The most price matrices kept warm, the least recently used unused one is dropped first
+        """
+        self.simulations = simulations
+        self.seed = seed
+        self.shocks = shocks
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_window = batch_window
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_matrices = max(int(max_matrices), 1)
+        self.statistics = ServiceStatistics()
+
+        self._matrices: 'collections.OrderedDict[str, asyncio.Future]' = collections.OrderedDict()
+        # Batches waiting for or running on each matrix, a matrix is only dropped without any
+        self._matrix_users: t.Counter[str] = collections.Counter()
+        self._queue: t.Optional[asyncio.Queue] = None
+        self._executor: t.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._batcher: t.Optional[asyncio.Task] = None
+        self._running_batches: t.Set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> 'SimulationService':
+        # Workers are started on demand, forked workers would inherit the sockets of the connections open at the time
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(start_method))
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_requests())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # simulate refuses new requests from here on, the batcher fails the ones not yet sent to the pool
+        self._queue = None
+        if self._batcher is not None:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, return_exceptions=True)
+            self._batcher = None
+        if self._running_batches:
+            await asyncio.gather(*self._running_batches, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for matrix in self._matrices.values():
+            if matrix.done() and matrix.exception() is None:
+                matrix.result().close()
+        self._matrices.clear()
+
+    async def simulate(
+        self,
+        employee_options: EmployeeOptions,
+        strategy_names: t.Optional[t.Sequence[str]] = None
+    ) -> t.List[StrategyOutcome]:
+        """
+            The outcome of each strategy for employee_options over the warm matrix of its stock, every strategy by default.
+        """
+        if self._queue is None:
+            raise RuntimeError("SimulationService must be used as an async context manager")
+        known = [func["name"] for func in strategies.get_all_strategies()]
+        names = tuple(known if strategy_names is None else strategy_names)
+        unknown = [name for name in names if name not in known]
+        if unknown:
+            raise ValueError(f"Unknown strategies {unknown}")
+
+        self.statistics.requests += 1
+        outcome: asyncio.Future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((employee_options, names), outcome))
+        return await outcome
+
+    async def _warm_matrix(self, key: str, employee_options: EmployeeOptions) -> _WarmMatrix:
+        """
+            The matrix of the options' stock. The first request for a stock generates it in a thread,
+            concurrent requests for the same stock wait for that one.
+        """
+        if key in self._matrices:
+            self._matrices.move_to_end(key)
+            return await self._matrices[key]
+
+        loop = asyncio.get_running_loop()
+        matrix_future: asyncio.Future = loop.create_future()
+        self._matrices[key] = matrix_future
+        self._drop_unused_matrices()
+        try:
+            prices = await loop.run_in_executor(
+                None,
+                generate_scenario_rows,
+                employee_options.company_stock_plan,
+                employee_options.company_stock_parameters,
+                0,
+                self.simulations,
+                self.seed,
+                np.float64,
+                self.shocks
+            )
+            matrix_future.set_result(_WarmMatrix(prices))
+            self.statistics.matrices_generated += 1
+        except Exception as error:
+            # Not kept, so the next request tries again
+            del self._matrices[key]
+            matrix_future.set_exception(error)
+        return await matrix_future
+
+    def _drop_unused_matrices(self) -> None:
+        for key in list(self._matrices):
+            if len(self._matrices) <= self.max_matrices:
+                return
+            matrix = self._matrices[key]
+            if matrix.done() and self._matrix_users[key] == 0:
+                matrix.result().close()
+                del self._matrices[key]
+
+    async def _batch_requests(self) -> None:
+        """
+            Takes a batch from the queue whenever a worker is free: the first request, then every request arriving
+            within batch_window, up to max_batch_size. When cancelled, the requests of the batch being built and
+            the ones still queued fail with a RuntimeError.
+        """
+        assert self._queue is not None
+        queue = self._queue
+        free_workers = asyncio.Semaphore(self.workers)
+        loop = asyncio.get_running_loop()
+        batch: t.List[t.Tuple[_Job, asyncio.Future]] = []
+        try:
+            while True:
+                await free_workers.acquire()
+                batch = [await queue.get()]
+                deadline = loop.time() + self.batch_window
+                while len(batch) < self.max_batch_size:
+                    if not queue.empty():
+                        batch.append(queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                task = asyncio.create_task(self._run_batch(batch))
+                self._running_batches.add(task)
+                task.add_done_callback(self._running_batches.discard)
+                task.add_done_callback(lambda _: free_workers.release())
+                batch = []
+        finally:
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for _, outcome in batch:
+                if not outcome.done():
+                    outcome.set_exception(RuntimeError("SimulationService closed"))
+
+    async def _run_batch(self, batch: t.List[t.Tuple[_Job, asyncio.Future]]) -> None:
+        self.statistics.batches += 1
+        by_matrix: t.Dict[str, t.List[t.Tuple[_Job, asyncio.Future]]] = {}
+        for request in batch:
+            employee_options = request[0][0]
+            by_matrix.setdefault(_matrix_key(employee_options.company_stock_plan, employee_options.company_stock_parameters), []).append(request)
+        await asyncio.gather(*(self._run_matrix_batch(key, requests) for key, requests in by_matrix.items()))
+
+    async def _run_matrix_batch(self, key: str, requests: t.List[t.Tuple[_Job, asyncio.Future]]) -> None:
+        """
+            Runs the requests of one stock as one task in the pool. Identical requests are only sent once.
+        """
+        jobs: t.List[_Job] = []
+        job_indexes: t.Dict[t.Tuple[str, t.Tuple[str, ...]], int] = {}
+        request_jobs = []
+        for (employee_options, names), _ in requests:
+            job_key = (_options_key(employee_options), names)
+            if job_key not in job_indexes:
+                job_indexes[job_key] = len(jobs)
+                jobs.append((employee_options, names))
+            request_jobs.append(job_indexes[job_key])
+
+        self._matrix_users[key] += 1
+        try:
+            matrix = await self._warm_matrix(key, jobs[0][0])
+            outcomes, engine_runs = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                _run_batch,
+                matrix.memory.name,
+                matrix.shape,
+                matrix.dtype,
+                jobs,
+                self.shocks == "antithetic"
+            )
+            self.statistics.engine_runs += engine_runs
+        except Exception as error:
+            for _, outcome in requests:
+                if not outcome.done():
+                    outcome.set_exception(error)
+            return
+        finally:
+            self._matrix_users[key] -= 1
+
+        for (_, outcome), job_index in zip(requests, request_jobs):
+            if not outcome.done():
+                outcome.set_result(outcomes[job_index])
+
+
+async def _handle_http(service: SimulationService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+        POST /simulate with {"employee_options": EmployeeOptions.to_dict(), "strategies": [names]}, "strategies" optional.
+        Answers with the outcomes as JSON, one request per connection. Malformed or truncated requests get a 400,
+        any other failure, such as a broken process pool or a closed service, a 500.
+    """
+    status, body = "200 OK", b""
+    try:
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            payload = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if len(request_line) < 2 or request_line[0] != 'POST' or request_line[1] != '/simulate':
+                status, body = "404 Not Found", json.dumps({"error": "POST /simulate"}).encode('utf-8')
+            else:
+                request = json.loads(payload)
+                outcomes = await service.simulate(EmployeeOptions.from_dict(request["employee_options"]), request.get("strategies"))
+                body = json.dumps([asdict(outcome) for outcome in outcomes]).encode('utf-8')
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError) as error:
+            status, body = "400 Bad Request", json.dumps({"error": str(error)}).encode('utf-8')
+        except Exception as error:
+            status, body = "500 Internal Server Error", json.dumps({"error": f"{type(error).__name__}: {error}"}).encode('utf-8')
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1')
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        # The client went away, there is no one to answer
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service: SimulationService, host: str = "127.0.0.1", port: int = 8080) -> None:
+    """
+        Serves POST /simulate with service until cancelled. Meant for local testing, put a real server in front of it.
+    """
+    server = await asyncio.start_server(lambda reader, writer: _handle_http(service, reader, writer), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def _main(args: argparse.Namespace) -> None:
+    async with SimulationService(args.simulations, workers=args.workers, batch_window=args.batch_window) as service:
+        print(f'Serving POST /simulate on {args.host}:{args.port}')
+        await serve(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--simulations', type=int, default=10_000)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--batch-window', type=float, default=0.002)
+    asyncio.run(_main(parser.parse_args()))
@@ -1,7 +1,14 @@
+import typing as t
+from dataclasses import dataclass
+
 import numpy as np
 from scipy.stats import norm, linregress
 from scipy.optimize import brentq
 
+# Volatility range searched for implied volatilities, the same as implied_volatility's brentq bracket
+IV_LOWER_BOUND = 1e-6
+IV_UPPER_BOUND = 5.0
+
 # --- Black-Scholes pricing function ---
 def bs_price(S, K, T, r, sigma, option_type='call'):
     """
@@ -11,12 +18,20 @@ def bs_price(S, K, T, r, sigma, option_type='call'):
     T: time to expiration in years
     r: risk-free interest rate
     sigma: volatility
-    option_type: 'call' or 'put'
+    option_type: 'call' or 'put', or an array of them
     """
     d1 = (np.log(S / K) + (r + 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
     d2 = d1 - sigma * np.sqrt(T)
 
-    if option_type == 'call':
+    if not isinstance(option_type, str):
+        # An array of 'call' and 'put', one per option
+        is_call = _is_call(option_type)
+        price = np.where(
+            is_call,
+            S * norm.cdf(d1) - K * np.exp(-r * T) * norm.cdf(d2),
+            K * np.exp(-r * T) * norm.cdf(-d2) - S * norm.cdf(-d1)
+        )
+    elif option_type == 'call':
         price = S * norm.cdf(d1) - K * np.exp(-r * T) * norm.cdf(d2)
     elif option_type == 'put':
         price = K * np.exp(-r * T) * norm.cdf(-d2) - S * norm.cdf(-d1)
@@ -38,8 +53,119 @@ def implied_volatility(S, K, T, r, market_price, option_type='call'):
     """
     objective = lambda sigma: bs_price(S, K, T, r, sigma, option_type) - market_price
 
-    iv = brentq(objective, 1e-6, 5.0)  # Solve for IV in [0.000001, 500%]
+    iv = brentq(objective, IV_LOWER_BOUND, IV_UPPER_BOUND)  # Solve for IV in [0.000001, 500%]
     return iv
+
+def _is_call(option_type) -> np.ndarray:
+    option_type = np.asarray(option_type)
+    if not np.all((option_type == 'call') | (option_type == 'put')):
+        raise ValueError("option_type must be 'call' or 'put'")
+    return option_type == 'call'
+
+def bs_vega(S, K, T, r, sigma):
+    """
+    Black-Scholes vega, the derivative of the price with respect to sigma. The same for calls and puts.
+    """
+    d1 = (np.log(S / K) + (r + 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
+    return S * norm.pdf(d1) * np.sqrt(T)
+
+@dataclass
+class ImpliedVolatilities:
+    """
+    Result of implied_volatilities, one entry per option. volatility is nan where the solver did not converge,
+    which is the case for prices outside the no-arbitrage bounds or for volatilities outside
+    [IV_LOWER_BOUND, IV_UPPER_BOUND], where implied_volatility raises.
+    """
+    volatility: np.ndarray
+    converged: np.ndarray
+    iterations: np.ndarray
+
+def implied_volatilities(
+    S,
+    K,
+    T,
+    r,
+    market_price,
+    option_type='call',
+    tolerance: float = 1e-10,
+    max_iterations: int = 100
+) -> ImpliedVolatilities:
+    """
+    Implied volatilities of a whole option chain at once. S, K, T, r, market_price and option_type are
+    broadcast against each other, so a chain is arrays of strikes, expiries and prices with a single S and r.
+
+    Each option is solved with Halley's method, using the analytic vega and its derivative, starting from the
+    Manaster-Koehler guess. Every step also narrows a [low, high] bracket around the solution, and a step that
+    leaves the bracket or has no usable vega bisects it instead, so deep in or out of the money options where
+    vega is tiny still converge. An option has converged when its volatility step is below tolerance.
+    """
+    S, K, T, r, market_price = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (S, K, T, r, market_price)))
+    is_call = np.broadcast_to(_is_call(option_type), S.shape)
+    shape = S.shape
+    S, K, T, r, market_price, is_call = (np.ravel(value) for value in (S, K, T, r, market_price, is_call))
+
+    volatility = np.full(S.shape, np.nan)
+    converged = np.zeros(S.shape, dtype=bool)
+    iterations = np.zeros(S.shape, dtype=np.int64)
+
+    # Only prices strictly inside the volatility bracket have a solution
+    lower_price = bs_price(S, K, T, r, IV_LOWER_BOUND, np.where(is_call, 'call', 'put'))
+    upper_price = bs_price(S, K, T, r, IV_UPPER_BOUND, np.where(is_call, 'call', 'put'))
+    solvable = (T > 0) & (market_price >= lower_price) & (market_price <= upper_price)
+    active = np.flatnonzero(solvable)
+    S, K, T, r, market_price, is_call = (value[active] for value in (S, K, T, r, market_price, is_call))
+    log_moneyness = np.log(S / K)
+    sqrt_t = np.sqrt(T)
+    discounted_strike = K * np.exp(-r * T)
+
+    low = np.full(active.shape, IV_LOWER_BOUND)
+    high = np.full(active.shape, IV_UPPER_BOUND)
+    previous_step = high - low
+    # Manaster-Koehler starting point, which Newton's method converges from monotonically for calls
+    sigma = np.sqrt(2 * np.abs(log_moneyness + r * T) / T)
+    sigma = np.where((sigma > IV_LOWER_BOUND) & (sigma < IV_UPPER_BOUND), sigma, 0.5 * (IV_LOWER_BOUND + IV_UPPER_BOUND))
+
+    for iteration in range(1, max_iterations + 1):
+        if active.size == 0:
+            break
+        d1 = (log_moneyness + (r + 0.5 * sigma ** 2) * T) / (sigma * sqrt_t)
+        d2 = d1 - sigma * sqrt_t
+        call_price = S * norm.cdf(d1) - discounted_strike * norm.cdf(d2)
+        # Put prices from put-call parity
+        error = np.where(is_call, call_price, call_price - S + discounted_strike) - market_price
+        # The price increases with sigma, so the error gives the side of the solution
+        high = np.where(error > 0, sigma, high)
+        low = np.where(error < 0, sigma, low)
+
+        vega = S * norm.pdf(d1) * sqrt_t
+        volga = vega * d1 * d2 / sigma
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton_step = error / vega
+            step = newton_step / (1 - 0.5 * newton_step * volga / vega)
+            next_sigma = sigma - step
+        # Bisect when the step leaves the bracket, or isn't at least halving like rtsafe in Numerical Recipes,
+        # which happens far out of the money where the price is almost flat in sigma
+        bisect = ~np.isfinite(next_sigma) | (next_sigma <= low) | (next_sigma >= high) | (np.abs(step) > 0.5 * np.abs(previous_step))
+        next_sigma = np.where(bisect, 0.5 * (low + high), next_sigma)
+        previous_step = next_sigma - sigma
+
+        done = (error == 0) | (np.abs(previous_step) <= tolerance) | (high - low <= tolerance)
+        finished = active[done]
+        volatility[finished] = np.where(error[done] == 0, sigma[done], next_sigma[done])
+        converged[finished] = True
+        iterations[finished] = iteration
+
+        keep = ~done
+        active, sigma, low, high, previous_step = active[keep], next_sigma[keep], low[keep], high[keep], previous_step[keep]
+        S, K, T, r, market_price, is_call = (value[keep] for value in (S, K, T, r, market_price, is_call))
+        log_moneyness, sqrt_t, discounted_strike = log_moneyness[keep], sqrt_t[keep], discounted_strike[keep]
+
+    iterations[active] = max_iterations
+    return ImpliedVolatilities(
+        volatility=volatility.reshape(shape),
+        converged=converged.reshape(shape),
+        iterations=iterations.reshape(shape)
+    )
  
 def get_expected_rate_of_return_from_capm(stock_price_last_24_months: np.ndarray, spy_last_24_months: np.ndarray, risk_free_rate: float, market_return: float):
 
@@ -54,4 +180,41 @@ def get_expected_rate_of_return_from_capm(stock_price_last_24_months: np.ndarray
     # CAPM formula
     expected_return = risk_free_rate + beta * (market_return - risk_free_rate)
 
-    return float(expected_return)
\ No newline at end of file
+    return float(expected_return)
+
+def _monthly_returns(prices: np.ndarray) -> np.ndarray:
+    return (prices[..., 1:] - prices[..., :-1]) / prices[..., :-1]
+
+def capm_betas(stock_prices: np.ndarray, spy_prices: np.ndarray, window: t.Optional[int] = None) -> np.ndarray:
+    """
+    Betas of many stocks against SPY in one least squares pass, the same slope linregress gives for each stock.
+    stock_prices: (tickers, months) matrix of monthly prices
+    spy_prices: (months,) monthly prices of SPY over the same months
+    window: Number of monthly returns per beta. None gives one beta per ticker over all months, otherwise a
+        (tickers, months - window) matrix of rolling betas, the last one over the most recent window.
+    """
+    stock_returns = _monthly_returns(np.atleast_2d(np.asarray(stock_prices, dtype=float)))
+    spy_returns = _monthly_returns(np.asarray(spy_prices, dtype=float))
+    if window is not None:
+        if not 2 <= window <= spy_returns.shape[0]:
+            raise ValueError(f"window must be between 2 and {spy_returns.shape[0]} returns")
+        # (tickers, windows, window) views of the returns, without copying them
+        stock_returns = np.lib.stride_tricks.sliding_window_view(stock_returns, window, axis=-1)
+        spy_returns = np.lib.stride_tricks.sliding_window_view(spy_returns, window)
+
+    spy_deviations = spy_returns - spy_returns.mean(axis=-1, keepdims=True)
+    stock_deviations = stock_returns - stock_returns.mean(axis=-1, keepdims=True)
+    return (stock_deviations * spy_deviations).sum(axis=-1) / (spy_deviations ** 2).sum(axis=-1)
+
+def get_expected_rates_of_return_from_capm(
+    stock_prices: np.ndarray,
+    spy_prices: np.ndarray,
+    risk_free_rate: float,
+    market_return: float,
+    window: t.Optional[int] = None
+) -> np.ndarray:
+    """
+    get_expected_rate_of_return_from_capm for every row of a (tickers, months) price matrix at once, see capm_betas.
+    """
+    betas = capm_betas(stock_prices, spy_prices, window)
+    return risk_free_rate + betas * (market_return - risk_free_rate)
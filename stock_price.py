@@ -1,15 +1,30 @@
+import collections
+import concurrent.futures
+import contextlib
 from datetime import datetime
 import typing as t
 import io
+import os
+import warnings
 
 import numpy as np
+import numpy.typing as npt
 import cairo
 import math
+from scipy.special import ndtri
+from scipy.stats import qmc
 
-from charts import save_roi_distribution_chart
+from charts import LazyChart, RoiHistogram, render_charts, render_roi_histogram_grid, roi_histogram, streaming_roi_histogram
 from models.company_plan import CompanyStockPlan
 from models.company_stock_start_parameters import CompanyStockStartParameters
+from espp_batch_run import ESPPBatchRun
+from espp_jit_run import ESPPJitRun, supports_jit
 from espp_scenario_run import ESPPScenarioRun
+from parallel_run import ParallelScenarioRunner
+import profiling
+from result_cache import ResultCache, hash_prices
+from roi_estimation import ROIEstimate, estimate_from_statistics, estimate_mean_roi, expected_terminal_price, paths_for_target_error
+from scenario_store import ScenarioWriter, export_csv, save_scenarios
 from models.employee_options import (
     EmployeeOptions
 )
@@ -17,50 +32,265 @@ from models.employee_options import (
 from models.espp_result import ESPPResult
 import strategies
 
+# Number of consecutive price paths drawn from one spawned random stream, see draw_shocks
+PATHS_PER_STREAM = 8192
+
+def run_strategy(
+    prices: np.ndarray,
+    employee_options: EmployeeOptions,
+    func: t.Dict[str, t.Any],
+    batch: bool = True,
+    jit: bool = False
+) -> ESPPResult:
+    """
+        Runs one strategy entry over every price path.
+
+        batch runs all paths at once with ESPPBatchRun, otherwise each path is run with ESPPScenarioRun.
+        Both give the same results.
+        jit runs the built-in strategies with the compiled kernels of ESPPJitRun. Strategies without a kernel
+        fall back to the batch or scalar engine.
+    """
+    if jit and supports_jit(func):
+        return ESPPJitRun(prices, employee_options, func["strategy"]).run()
+    if batch:
+        return ESPPBatchRun(prices, employee_options, strategies.get_batch_strategy(func)).run()
+
+    running_ESPPResult = ESPPResult(capacity=len(prices))
+    for price in prices:
+        espp_state = ESPPScenarioRun(
+            price,
+            employee_options,
+            func["strategy"], # type: ignore
+            func.get("keep_history")
+        ).run()
+        running_ESPPResult.add(espp_state)
+    return running_ESPPResult
+
+def estimate_strategy_roi(
+    espp_result: ESPPResult,
+    terminal_prices: np.ndarray,
+    employee_options: EmployeeOptions,
+    antithetic: bool = False
+) -> ROIEstimate:
+    """
+        Mean ROI of a strategy run with its standard error, using the terminal stock price as a control variate.
+        Must be called before the ROI list is clamped for charting.
+
+        Streaming results don't keep per path ROI, so they get the plain estimate from their running statistics.
+    """
+    if espp_result.streaming:
+        return estimate_from_statistics(espp_result)
+    return estimate_mean_roi(
+        espp_result.roi,
+        terminal_prices,
+        expected_terminal_price(employee_options.company_stock_parameters),
+        antithetic
+    )
+
+def simulations_for_target_error(
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    employee_options: EmployeeOptions,
+    target_standard_error: float,
+    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None,
+    pilot_simulations: int = 10_000,
+    seed: t.Union[None, int, np.random.SeedSequence] = None,
+    shocks: str = "pseudo"
+) -> t.Dict[str, int]:
+    """
+        Runs a pilot of pilot_simulations paths and returns, per strategy name, how many paths are needed for the
+        mean ROI's standard error to reach target_standard_error with the same shocks mode.
+    """
+    if functions is None:
+        functions = strategies.get_all_strategies()
+    prices = generate_scenario_rows(company_stock_plan, company_stock_start_parameters, 0, pilot_simulations, scenario_seed_sequence(seed), shocks=shocks)
+    return {
+        func["name"]: paths_for_target_error(
+            estimate_strategy_roi(run_strategy(prices, employee_options, func), prices[:, -1], employee_options, shocks == "antithetic"),
+            target_standard_error
+        )
+        for func in functions
+    }
+
+@contextlib.contextmanager
+def strategy_runner(
+    prices: np.ndarray,
+    employee_options: EmployeeOptions,
+    batch: bool = True,
+    workers: t.Optional[int] = 1,
+    jit: bool = False
+) -> t.Iterator[t.Callable[[t.Dict[str, t.Any]], ESPPResult]]:
+    """
+        Yields a function that runs a strategy entry over every price path.
+
+        workers=1 runs in this process. Any other value runs the paths with a ParallelScenarioRunner,
+        with None meaning one worker per CPU. The pool and shared memory are kept for every strategy run
+        inside the with block. Results are the same for any number of workers.
+
+        jit always runs in this process, the compiled kernels already spread the paths over threads.
+    """
+    if workers == 1 or jit:
+        yield lambda func: run_strategy(prices, employee_options, func, batch, jit)
+    else:
+        with ParallelScenarioRunner(prices, workers) as runner:
+            yield lambda func: runner.run(employee_options, func)
+
+def attach_charts(
+    functions: t.List[t.Dict[str, t.Any]],
+    histograms: t.List[RoiHistogram],
+    lazy_charts: bool = False,
+    chart_workers: t.Optional[int] = None
+) -> None:
+    """
+        Gives each strategy entry its 'roi_histogram', a 'chart' LazyChart and its 'pic_bytes'.
+        With lazy_charts nothing is rendered and 'pic_bytes' is None, read chart.png to render a chart when needed.
+        Otherwise all charts are rendered together with render_charts over chart_workers threads.
+    """
+    pngs = [None] * len(histograms) if lazy_charts else render_charts(histograms, chart_workers)
+    for func, histogram, png in zip(functions, histograms, pngs):
+        func['roi_histogram'] = histogram
+        func['chart'] = LazyChart(histogram, png)
+        func['pic_bytes'] = png
 
 def run_strategies_against_scenarios(
     prices: np.ndarray,
     employee_options: EmployeeOptions,
-    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None
+    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None,
+    batch: bool = True,
+    workers: t.Optional[int] = 1,
+    antithetic: bool = False,
+    jit: bool = False,
+    cache: t.Optional[ResultCache] = None,
+    lazy_charts: bool = False,
+    chart_workers: t.Optional[int] = None,
+    profile: bool = False
 ):
+    """
+        Runs every strategy over the price paths. Each strategy entry gets its 'espp_result', an 'roi_estimate'
+        with the mean ROI and its standard error, and its ROI chart, see attach_charts.
+
+        antithetic must be set when the paths were generated with shocks="antithetic".
+        With a cache, results of earlier runs with the same prices, strategy and options are loaded instead of simulated.
+        The runner is only started once a strategy misses the cache.
+        profile times the stages of each strategy, see profiling, prints the report table and gives each entry
+        its stages as 'profile'. Use profiling.profile_run directly to keep the whole report.
+    """
     if functions is None:
         functions = strategies.get_all_strategies()
-    for func in functions:
+    price_hash = hash_prices(prices) if cache is not None else None
+    histograms = []
+    with contextlib.ExitStack() as stack:
+        run_profile = stack.enter_context(profiling.profile_run()) if profile else None
+        run = None
+        for func in functions:
+            function_name: str = func["name"] # type: ignore
+            print(f'\nRunning scenario {function_name}\n')
+            with profiling.strategy(function_name):
+                cache_key = cache.key(price_hash, employee_options, func) if cache is not None and price_hash is not None else None
+                running_ESPPResult = cache.get(cache_key) if cache is not None and cache_key is not None else None
+                if running_ESPPResult is None:
+                    if run is None:
+                        run = stack.enter_context(strategy_runner(prices, employee_options, batch, workers, jit))
+                    with profiling.stage("run"):
+                        running_ESPPResult = run(func)
+                    if cache is not None and cache_key is not None:
+                        cache.put(cache_key, running_ESPPResult)
+
+                with profiling.stage("roi_estimate"):
+                    func['roi_estimate'] = estimate_strategy_roi(running_ESPPResult, prices[:, -1], employee_options, antithetic)
+                print(f'Mean ROI {func["roi_estimate"].mean:.4%} +/- {func["roi_estimate"].standard_error:.4%}')
+
+                with profiling.stage("histogram"):
+                    histograms.append(roi_histogram(function_name, running_ESPPResult.roi))
+            func['espp_result'] = running_ESPPResult
+
+        with profiling.stage("charts"):
+            attach_charts(functions, histograms, lazy_charts, chart_workers)
+
+    if run_profile is not None:
+        print(run_profile.table())
+        for func in functions:
+            func['profile'] = run_profile.to_dict().get(func["name"], {})
+    return functions
+
+def run_strategies_against_scenario_blocks(
+    price_blocks: t.Iterable[np.ndarray],
+    employee_options: EmployeeOptions,
+    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None,
+    batch: bool = True,
+    antithetic: bool = False,
+    streaming: bool = False,
+    jit: bool = False,
+    lazy_charts: bool = False,
+    chart_workers: t.Optional[int] = None
+):
+    """
+        Streaming version of run_strategies_against_scenarios. Each block of price paths, for example from
+        iter_scenarios, is run through every strategy and then dropped, so the price matrix never has to fit in memory.
+        The results are the same as running the concatenated blocks through run_strategies_against_scenarios.
+
+        With streaming the results are streaming ESPPResults, so memory stays constant in the number of paths.
+        Their roi_estimate is the plain estimate, and their chart is drawn from the running ROI histogram.
+    """
+    if functions is None:
+        functions = strategies.get_all_strategies()
+    running_results = [ESPPResult(streaming=streaming) for _ in functions]
+    terminal_prices = []
+    for prices in price_blocks:
+        if not streaming:
+            terminal_prices.append(np.array(prices[:, -1]))
+        for func, running_ESPPResult in zip(functions, running_results):
+            running_ESPPResult.add(run_strategy(prices, employee_options, func, batch, jit))
+
+    histograms = []
+    for func, running_ESPPResult in zip(functions, running_results):
         function_name: str = func["name"] # type: ignore
-        print(f'\nRunning scenario {function_name}\n')
-        running_ESPPResult = ESPPResult()
-        for price in prices:
-            espp_state = ESPPScenarioRun(
-                price,
-                employee_options,
-                func["strategy"] # type: ignore
-            ).run()
-            running_ESPPResult.add(espp_state)
-
-        func['pic_bytes'] = save_roi_distribution_chart(
-            function_name,
-            running_ESPPResult.roi,
-            employee_options
+        func['roi_estimate'] = estimate_strategy_roi(
+            running_ESPPResult,
+            np.concatenate(terminal_prices) if terminal_prices else np.empty(0),
+            employee_options,
+            antithetic
         )
         func['espp_result'] = running_ESPPResult
+        if streaming:
+            histograms.append(streaming_roi_histogram(function_name, running_ESPPResult))
+        else:
+            histograms.append(roi_histogram(function_name, running_ESPPResult.roi))
+    attach_charts(functions, histograms, lazy_charts, chart_workers)
     return functions
 
 def run_scenarios_against_strategies(
     prices: np.ndarray,
     employee_options: EmployeeOptions,
-    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None
+    functions: t.Optional[t.List[t.Dict[str, t.Any]]] = None,
+    batch: bool = True,
+    workers: t.Optional[int] = 1,
+    jit: bool = False,
+    lazy_charts: bool = False,
+    chart_workers: t.Optional[int] = None,
+    combined_chart: t.Optional[str] = None
 ):
+    """
+        combined_chart: "png", "svg" or "pdf" draws every strategy into one document with
+            render_roi_histogram_grid, set as 'combined_chart' on every entry. The per strategy charts are then
+            left lazy, see attach_charts.
+    """
     functions = strategies.get_all_strategies()
-    for func in functions:
-        func["espp_result"] = ESPPResult() 
-    for price in prices:
+    if batch or workers != 1 or jit:
+        with strategy_runner(prices, employee_options, batch, workers, jit) as run:
+            for func in functions:
+                func["espp_result"] = run(func)
+    else:
         for func in functions:
-            espp_state = ESPPScenarioRun(
-                price,
-                employee_options,
-                func["strategy"]
-            ).run()
-            func["espp_result"].add(espp_state)
+            func["espp_result"] = ESPPResult()
+        for price in prices:
+            for func in functions:
+                espp_state = ESPPScenarioRun(
+                    price,
+                    employee_options,
+                    func["strategy"]
+                ).run()
+                func["espp_result"].add(espp_state)
     
     high_mean = 0
     high_std = 0
@@ -69,39 +299,271 @@ def run_scenarios_against_strategies(
             high_mean = np.mean(func["espp_result"].roi)
             high_std = np.std(func["espp_result"].roi)
 
-    for func in functions:
-        func['pic_bytes'] = save_roi_distribution_chart(func["name"], func["espp_result"].roi, employee_options, top_value=round(high_mean + (high_std * 3), 2))
+    top_value = round(high_mean + (high_std * 3), 2)
+    histograms = [roi_histogram(func["name"], func["espp_result"].roi, top_value) for func in functions]
+    attach_charts(functions, histograms, lazy_charts or combined_chart is not None, chart_workers)
+    if combined_chart is not None:
+        chart = render_roi_histogram_grid(histograms, combined_chart)
+        for func in functions:
+            func["combined_chart"] = chart
     return functions
 
 
-def generate_scenarios(
+def simulate_price_paths(
+    company_stock_start_parameters: CompanyStockStartParameters,
+    z: np.ndarray,
+    dt: float
+) -> np.ndarray:
+    """
+        Builds price paths from a (paths, steps) matrix of standard normal shocks, using the closed form of
+        geometric brownian motion instead of stepping through time:
+            S(t) = S(0) * exp(sum over steps of (r - 0.5 * sigma^2) * dt + sigma * sqrt(dt) * z)
+
+        "This process produces log-normally distributed prices, because it exponentiates normally distributed returns."
+        https://medium.com/@polanitzer/forward-looking-monte-carlo-simulation-predict-the-future-value-of-equity-using-the-lognormal-f54320f9c230
+
+        z is overwritten with the log returns to avoid another temporary matrix. The prices have the dtype of z.
+
+        With a volatility_term_structure, step i uses its own sigma_i in place of sigma.
+    """
+    volatility = company_stock_start_parameters.volatility
+    if company_stock_start_parameters.volatility_term_structure is not None:
+        volatility = np.asarray(company_stock_start_parameters.volatility_term_structure, dtype=float)
+        if volatility.shape != (z.shape[1],):
+            raise ValueError(f"volatility_term_structure has {volatility.shape[0]} periods, expected one per step ({z.shape[1]})")
+    z *= volatility * np.sqrt(dt)
+    z += (company_stock_start_parameters.expected_rate_of_return - 0.5 * volatility**2) * dt
+
+    prices = np.empty((z.shape[0], z.shape[1] + 1), dtype=z.dtype)
+    prices[:, 0] = company_stock_start_parameters.initial_price
+    np.cumsum(z, axis=1, out=prices[:, 1:])
+    np.exp(prices[:, 1:], out=prices[:, 1:])
+    prices[:, 1:] *= prices[:, :1]
+    return prices
+
+def scenario_seed_sequence(seed: t.Union[None, int, np.random.SeedSequence]) -> np.random.SeedSequence:
+    """
+        The root SeedSequence for a scenario run. With seed None fresh entropy is drawn; its entropy is saved with the
+        scenarios so the run can still be regenerated.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def _stream_seed_sequence(seed_sequence: np.random.SeedSequence, stream: int) -> np.random.SeedSequence:
+    """
+        The same child as seed_sequence.spawn(stream + 1)[stream], built directly so any stream can be regenerated
+        on its own.
+    """
+    return np.random.SeedSequence(
+        seed_sequence.entropy,
+        spawn_key=tuple(seed_sequence.spawn_key) + (stream,),
+        pool_size=seed_sequence.pool_size
+    )
+
+def draw_shocks(
+    seed_sequence: np.random.SeedSequence,
+    start: int,
+    stop: int,
+    steps: int,
+    dtype: npt.DTypeLike = np.float64,
+    shocks: str = "pseudo"
+) -> np.ndarray:
+    """
+        Standard normal shocks for price paths start to stop, one row per path.
+
+        The shocks of a path only depend on the seed and the path's index, so any range of paths can be regenerated
+        on demand, and the price matrix is bit-identical however it is split into chunks or across workers.
+
+        shocks picks how the shocks are drawn:
+            "pseudo": Every PATHS_PER_STREAM paths have their own independent generator spawned from seed_sequence.
+            "antithetic": Paths come in pairs, the odd path uses the negated shocks of the even path before it.
+                Pairs are negatively correlated, which lowers the variance of mean estimates.
+            "sobol": A scrambled Sobol' low discrepancy sequence, one dimension per step, mapped to normals.
+                Covers the shock space more evenly than pseudo random draws. Works best with a power of 2 paths.
+    """
+    if shocks == "pseudo":
+        return _draw_pseudo_random_shocks(seed_sequence, start, stop, steps, dtype)
+    if shocks == "antithetic":
+        base_start = start // 2
+        base = _draw_pseudo_random_shocks(seed_sequence, base_start, (stop + 1) // 2, steps, dtype)
+        paths = np.arange(start, stop)
+        z = base[paths // 2 - base_start]
+        z[paths % 2 == 1] *= -1
+        return z
+    if shocks == "sobol":
+        # A fresh copy of the seed sequence, the scrambling spawns from it and would change it for the next chunk
+        scramble_seed_sequence = np.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key, pool_size=seed_sequence.pool_size)
+        sampler = qmc.Sobol(steps, scramble=True, rng=np.random.default_rng(scramble_seed_sequence))
+        if start > 0:
+            sampler.fast_forward(start)
+        with warnings.catch_warnings():
+            # Sobol' warns when the number of points is not a power of 2, which chunking can't always avoid
+            warnings.simplefilter("ignore", UserWarning)
+            uniforms = sampler.random(stop - start)
+        return ndtri(uniforms).astype(dtype, copy=False)
+    raise ValueError("shocks must be 'pseudo', 'antithetic' or 'sobol'")
+
+def _draw_pseudo_random_shocks(
+    seed_sequence: np.random.SeedSequence,
+    start: int,
+    stop: int,
+    steps: int,
+    dtype: npt.DTypeLike = np.float64
+) -> np.ndarray:
+    z = np.empty((stop - start, steps), dtype=dtype)
+    row = start
+    while row < stop:
+        stream = row // PATHS_PER_STREAM
+        stream_start = stream * PATHS_PER_STREAM
+        stream_stop = min(stream_start + PATHS_PER_STREAM, stop)
+
+        rng = np.random.default_rng(_stream_seed_sequence(seed_sequence, stream))
+        if row > stream_start:
+            # Skip the paths of this stream that belong to an earlier chunk
+            rng.standard_normal((row - stream_start, steps), dtype=dtype)
+        z[row - start:stream_stop - start] = rng.standard_normal((stream_stop - row, steps), dtype=dtype)
+        row = stream_stop
+    return z
+
+def generate_scenario_rows(
     company_stock_plan: CompanyStockPlan,
     company_stock_start_parameters: CompanyStockStartParameters,
-    file_name: t.Optional[str] = None,
-    simulations=1000
-):
+    start: int,
+    stop: int,
+    seed: t.Union[int, np.random.SeedSequence],
+    dtype: npt.DTypeLike = np.float64,
+    shocks: str = "pseudo"
+) -> np.ndarray:
+    """
+        Regenerates price paths start to stop of a scenario run without generating the paths before them.
+    """
     time_frame = 1
     steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
 
     # Change in time over each iteration
     dt = time_frame / steps
 
-    prices = np.zeros((simulations, steps + 1))
-    prices[:, 0] = company_stock_start_parameters.initial_price
+    z = draw_shocks(scenario_seed_sequence(seed), start, stop, steps, dtype, shocks)
+    return simulate_price_paths(company_stock_start_parameters, z, dt)
+
+def iter_scenarios(
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    simulations=1000,
+    chunk_size: int = 100_000,
+    seed: t.Union[None, int, np.random.SeedSequence] = None,
+    dtype: npt.DTypeLike = np.float64,
+    workers: t.Optional[int] = 1,
+    shocks: str = "pseudo"
+) -> t.Iterator[np.ndarray]:
+    """
+        Yields the simulated price paths in blocks of at most chunk_size rows, so only one block has to be in memory.
+
+        Paths are drawn from independent streams spawned from the seed (see draw_shocks), so concatenating the blocks
+        gives exactly the matrix generate_scenarios returns for the same seed, whatever the chunk size or worker count.
+        With seed None the run cannot be regenerated later; pass a SeedSequence and keep its entropy if it needs to be.
+
+        dtype can be np.float32 to halve the memory of the price paths, or np.float64.
+
+        shocks can be "antithetic" or "sobol" to lower the variance of the ROI estimates, see draw_shocks.
+        Estimate antithetic runs with antithetic=True in roi_estimation.estimate_mean_roi.
+
+        workers other than 1 generates blocks in a process pool, None meaning one worker per CPU. At most two blocks
+        per worker are in flight, and blocks are still yielded in order.
+    """
+    seed_sequence = scenario_seed_sequence(seed)
+    chunk_size = max(int(chunk_size), 1)
+    chunks = [
+        (start, min(start + chunk_size, simulations))
+        for start in range(0, simulations, chunk_size)
+    ]
+
+    if workers == 1:
+        for start, stop in chunks:
+            yield generate_scenario_rows(company_stock_plan, company_stock_start_parameters, start, stop, seed_sequence, dtype, shocks)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight: t.Deque[concurrent.futures.Future] = collections.deque()
+        max_in_flight = 2 * workers
+        for start, stop in chunks:
+            in_flight.append(executor.submit(
+                generate_scenario_rows, company_stock_plan, company_stock_start_parameters, start, stop, seed_sequence, dtype, shocks
+            ))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def generate_scenarios(
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    file_name: t.Optional[str] = None,
+    simulations=1000,
+    seed: t.Union[None, int, np.random.SeedSequence] = None,
+    dtype: npt.DTypeLike = np.float64,
+    file_format: str = "scenarios",
+    workers: t.Optional[int] = 1,
+    shocks: str = "pseudo"
+):
+    """
+        Simulates the price paths and saves them to file_name. file_format "scenarios" writes a binary scenario file
+        that can be memory mapped with scenario_store.load_scenarios, "csv" writes the older text format.
+
+        The seed's entropy is saved in the scenario file, so the paths can be regenerated with generate_scenario_rows
+        even when no seed was given. The paths do not depend on the number of workers.
+    """
+    steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
+    seed_sequence = scenario_seed_sequence(seed)
+
+    prices = np.empty((simulations, steps + 1), dtype=dtype)
+    start = 0
+    for block in iter_scenarios(company_stock_plan, company_stock_start_parameters, simulations, seed=seed_sequence, dtype=dtype, workers=workers, shocks=shocks):
+        prices[start:start + block.shape[0]] = block
+        start += block.shape[0]
 
-    for t in range(1, steps + 1):
-        # potential to enhance: https://medium.com/@polanitzer/forward-looking-monte-carlo-simulation-predict-the-future-value-of-equity-using-the-lognormal-f54320f9c230
-        # "This process produces log-normally distributed prices, because it exponentiates normally distributed returns."
-        z = np.random.standard_normal(simulations)  # random variable
-        # Monte Carlo formula: S(t+1) = S(t) * exp((r - 0.5 * sigma^2) * dt + sigma * sqrt(dt) * z)
-        prices[:, t] = (
-            prices[:, t - 1] *
-            np.exp(
-                (company_stock_start_parameters.expected_rate_of_return - 0.5 * company_stock_start_parameters.volatility**2) * dt + 
-                company_stock_start_parameters.volatility * np.sqrt(dt) * z
-            )
-        )
     if file_name is None or len(file_name) == 0:
-        file_name = f'prices_{company_stock_plan.name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
-    np.savetxt(f'{file_name}.csv', prices, delimiter=',')
-    return prices
\ No newline at end of file
+        file_name = _default_scenario_file_name(company_stock_plan)
+    if file_format == "csv":
+        export_csv(file_name, prices)
+    elif file_format == "scenarios":
+        save_scenarios(file_name, prices, company_stock_plan, company_stock_start_parameters, _seed_metadata(seed_sequence, shocks))
+    else:
+        raise ValueError("file_format must be 'scenarios' or 'csv'")
+    return prices
+
+def generate_scenario_file(
+    company_stock_plan: CompanyStockPlan,
+    company_stock_start_parameters: CompanyStockStartParameters,
+    file_name: t.Optional[str] = None,
+    simulations=1000,
+    seed: t.Union[None, int, np.random.SeedSequence] = None,
+    dtype: npt.DTypeLike = np.float64,
+    chunk_size: int = 100_000,
+    workers: t.Optional[int] = 1,
+    shocks: str = "pseudo"
+) -> str:
+    """
+        Streams simulated price paths straight into a scenario file, one block at a time, and returns its path.
+        The file holds the same paths generate_scenarios returns for the same seed.
+    """
+    steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
+    seed_sequence = scenario_seed_sequence(seed)
+    if file_name is None or len(file_name) == 0:
+        file_name = _default_scenario_file_name(company_stock_plan)
+
+    with ScenarioWriter(file_name, simulations, steps + 1, company_stock_plan, company_stock_start_parameters, dtype, _seed_metadata(seed_sequence, shocks)) as writer:
+        for block in iter_scenarios(company_stock_plan, company_stock_start_parameters, simulations, chunk_size, seed_sequence, dtype, workers, shocks):
+            writer.write(block)
+    return writer.path
+
+def _seed_metadata(seed_sequence: np.random.SeedSequence, shocks: str) -> t.Dict[str, t.Any]:
+    """
+        What is needed to regenerate the paths: np.random.SeedSequence(entropy, spawn_key=spawn_key) and the shocks mode
+    """
+    return {"seed": {"entropy": seed_sequence.entropy, "spawn_key": list(seed_sequence.spawn_key)}, "shocks": shocks}
+
+def _default_scenario_file_name(company_stock_plan: CompanyStockPlan) -> str:
+    return f'prices_{company_stock_plan.name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
@@ -1,56 +1,78 @@
 import math
+import typing as t
 
-from scipy.stats import norm
+import numpy as np
+from scipy.special import ndtr
 
 from constants import MAX_PRICE_IRS
+from models.espp_batch_state import ESPPBatchState
 from models.espp_state import ESPPState
 from models.employee_options import EmployeeOptions
+from models.plan_schedule import PlanSchedule, plan_schedule
 
 def get_all_strategies():
+    """
+        Every strategy entry has a "strategy" function that takes a single ESPPState and returns a float, used by
+        ESPPScenarioRun. Entries that also have a "batch_strategy" function, which takes an ESPPBatchState and returns
+        one contribution per path, can be run by ESPPBatchRun directly. Use get_batch_strategy to run any entry
+        with ESPPBatchRun.
+
+        An optional "keep_history" sets whether the scalar "strategy" is given state.contributions and
+        state.uninvested. By default only strategies defined outside this module get them, see needs_history.
+    """
     return [
         {
             "name": "No contribution to ESPP",
             "strategy": no_contribution,
+            "batch_strategy": no_contribution_batch,
             "description": "This plan doesn't contribute any money to the ESPP."
         },
         {
             "name": "Max contribution to ESPP with company blocking overpayment",
             "strategy": max_all_the_way_company_hard_block,
+            "batch_strategy": max_all_the_way_company_hard_block_batch,
             "description": "Contributes max possible each period; company limits contributions once cap hits."
         },
         {
             "name": "Max contribution to ESPP with IRS blocking overpayment",
             "strategy": max_all_the_way_irs_hard_block,
+            "batch_strategy": max_all_the_way_irs_hard_block_batch,
             "description": "Contributes max possible each period; IRS limits contributions once cap hits."
         },
         {
             "name": "Max contribution to ESPP with company and IRS blocking overpayment",
             "strategy": max_both_hard_block,
+            "batch_strategy": max_both_hard_block_batch,
             "description": "Contributes max possible each period; company and IRS limit contributions once cap hits."
         },
         {
             "name": "Proportioned max contribution to ESPP with company blocking overpayment",
             "strategy": proportioned_max_all_the_way_company_hard_block,
+            "batch_strategy": proportioned_max_all_the_way_company_hard_block_batch,
             "description": "Contributes evenly each period to reduce overpayment risk; company limits contributions."
         },
         {
             "name": "Proportioned max contribution to ESPP with company and IRS blocking overpayment",
             "strategy": proportioned_max_both_hard_block,
+            "batch_strategy": proportioned_max_both_hard_block_batch,
             "description": "Contributes evenly each period to reduce overpayment risk; company and IRS limit contributions."
         },
         {
             "name": "Reduce IRS overpayment risk",
             "strategy": reduce_irs_over_risk,
+            "batch_strategy": reduce_irs_over_risk_batch,
             "description": "Averages contributions per period per IRS rules; stops when company limit is hit."
         },
         {
             "name": "Readjust halfway through the offering period",
             "strategy": readjust_halfway,
+            "batch_strategy": readjust_halfway_batch,
             "description": "Contributes max first 3 periods; readjusts if stock price drops by 15% halfway through."
         },
         {
             "name": "Maximize for large periods",
             "strategy": maximize_for_large_periods,
+            "batch_strategy": maximize_for_large_periods_batch,
             "description": "Implements a strategy that attempts to maximize contributions in high performing periods."
         }
     ]
@@ -60,11 +82,13 @@ def get_core_strategies():
         {
             "name": "No contribution to ESPP",
             "strategy": no_contribution,
+            "batch_strategy": no_contribution_batch,
             "description": "This plan doesn't contribute any money to the ESPP."
         },
         {
             "name": "Max contribution to ESPP with company and IRS blocking overpayment",
             "strategy": max_both_hard_block,
+            "batch_strategy": max_both_hard_block_batch,
             "description": "Contributes max possible each period; company and IRS limit contributions once cap hits."
         }
     ]
@@ -74,41 +98,95 @@ def get_no_lookback_strategies():
         {
             "name": "No contribution to ESPP",
             "strategy": no_contribution,
+            "batch_strategy": no_contribution_batch,
             "description": "This plan doesn't contribute any money to the ESPP."
         },
         {
             "name": "Max contribution to ESPP with company blocking overpayment",
             "strategy": max_all_the_way_company_hard_block,
+            "batch_strategy": max_all_the_way_company_hard_block_batch,
             "description": "Contributes max possible each period; company limits contributions once cap hits."
         },
         {
             "name": "Max contribution to ESPP with IRS blocking overpayment",
             "strategy": max_all_the_way_irs_hard_block,
+            "batch_strategy": max_all_the_way_irs_hard_block_batch,
             "description": "Contributes max possible each period; IRS limits contributions once cap hits."
         },
         {
             "name": "Max contribution to ESPP with company and IRS blocking overpayment",
             "strategy": max_both_hard_block,
+            "batch_strategy": max_both_hard_block_batch,
             "description": "Contributes max possible each period; company and IRS limit contributions once cap hits."
         },
         {
             "name": "Proportioned max contribution to ESPP with company blocking overpayment",
             "strategy": proportioned_max_all_the_way_company_hard_block,
+            "batch_strategy": proportioned_max_all_the_way_company_hard_block_batch,
             "description": "Contributes evenly each period to reduce overpayment risk; company limits contributions."
         },
         {
             "name": "Proportioned max contribution to ESPP with company and IRS blocking overpayment",
             "strategy": proportioned_max_both_hard_block,
+            "batch_strategy": proportioned_max_both_hard_block_batch,
             "description": "Contributes evenly each period to reduce overpayment risk; company and IRS limit contributions."
         },
     ]
 
+def needs_history(step_function: t.Callable) -> bool:
+    """
+        Whether a scalar strategy is run with the contributions and uninvested history by default. The built-in
+        strategies only read the running totals, any other strategy may read state.contributions or state.uninvested.
+    """
+    return getattr(step_function, "__module__", None) != __name__
+
+def get_batch_strategy(func: dict):
+    """
+        Returns the function to pass to ESPPBatchRun for a strategy entry. Entries without a "batch_strategy",
+        such as user defined strategies, have their scalar "strategy" wrapped in a ScalarStrategyAdapter.
+    """
+    if func.get("batch_strategy") is not None:
+        return func["batch_strategy"]
+    return ScalarStrategyAdapter(func["strategy"], func.get("keep_history"))
+
+class ScalarStrategyAdapter():
+    """
+        Runs a scalar strategy inside ESPPBatchRun by building an ESPPState for each path and calling the strategy
+        once per path. This gives the same results as ESPPScenarioRun, but none of the batch speedup.
+
+        A class instead of a closure so it can be pickled when sent to other processes.
+        keep_history fills in state.contributions and state.uninvested, which is slower. Defaults to needs_history.
+    """
+    def __init__(self, step_function: t.Callable[[EmployeeOptions, ESPPState], float], keep_history: t.Optional[bool] = None):
+        self.step_function = step_function
+        self.keep_history = needs_history(step_function) if keep_history is None else keep_history
+
+    def __call__(self, strategy: EmployeeOptions, state: ESPPBatchState):
+        contribution = np.empty(state.simulations)
+        for path in range(state.simulations):
+            contribution[path] = self.step_function(strategy, state.path_state(path, strategy, self.keep_history))
+        return contribution
+
+def _schedule(strategy: EmployeeOptions, state: t.Union[ESPPState, ESPPBatchState]) -> PlanSchedule:
+    """
+        The schedule the engine set on the state, or one built for the state when a strategy is called directly.
+    """
+    if state.schedule is not None:
+        return state.schedule
+    return plan_schedule(strategy, max(state.total_periods, state.period + 1))
+
 def no_contribution(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan doesn't contribute any money to the ESPP.
     """
     return 0
 
+def no_contribution_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of no_contribution.
+    """
+    return np.zeros(state.simulations)
+
 def max_all_the_way_company_hard_block(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan is to contribute the maximum amount possible in each offering period, but the company limits the amount
@@ -122,6 +200,18 @@ def max_all_the_way_company_hard_block(strategy: EmployeeOptions, state: ESPPSta
 
     return contribution
 
+def max_all_the_way_company_hard_block_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of max_all_the_way_company_hard_block.
+    """
+
+    contribution = np.full(state.simulations, float(strategy.max_contribution))
+    return np.where(
+        state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in,
+        strategy.company_stock_plan.max_pay_in - state.total_contributed,
+        contribution
+    )
+
 def proportioned_max_all_the_way_company_hard_block(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan is to contribute the maximum amount possible in each offering period, but the company limits the amount
@@ -132,12 +222,24 @@ def proportioned_max_all_the_way_company_hard_block(strategy: EmployeeOptions, s
         The hard block doesn't let you contribute over the max pay in.
     """
 
-    contribution = min(strategy.max_contribution, MAX_PRICE_IRS / (strategy.company_stock_plan.offering_periods * strategy.company_stock_plan.pay_periods_per_offering))
+    contribution = _schedule(strategy, state).proportioned_contribution
     if state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in:
         contribution = strategy.company_stock_plan.max_pay_in - state.total_contributed
 
     return contribution
 
+def proportioned_max_all_the_way_company_hard_block_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of proportioned_max_all_the_way_company_hard_block.
+    """
+
+    contribution = np.full(state.simulations, float(_schedule(strategy, state).proportioned_contribution))
+    return np.where(
+        state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in,
+        strategy.company_stock_plan.max_pay_in - state.total_contributed,
+        contribution
+    )
+
 def max_all_the_way_irs_hard_block(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan is to contribute the maximum amount possible in each offering period, but the irs limits the amount
@@ -154,6 +256,14 @@ def max_all_the_way_irs_hard_block(strategy: EmployeeOptions, state: ESPPState):
 
     return contribution
 
+def max_all_the_way_irs_hard_block_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of max_all_the_way_irs_hard_block.
+    """
+
+    contribution = np.full(state.simulations, float(strategy.max_contribution))
+    return _irs_hard_block_batch(contribution, state)
+
 def max_both_hard_block(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan combines the blocking of irs and company
@@ -167,6 +277,14 @@ def max_both_hard_block(strategy: EmployeeOptions, state: ESPPState):
 
     return contribution
 
+def max_both_hard_block_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of max_both_hard_block.
+    """
+
+    contribution = np.full(state.simulations, float(strategy.max_contribution))
+    return _both_hard_block_batch(contribution, strategy, state)
+
 def proportioned_max_both_hard_block(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan combines the blocking of irs and company
@@ -174,7 +292,7 @@ def proportioned_max_both_hard_block(strategy: EmployeeOptions, state: ESPPState
         This is different because the max_contribution is reduced to ensure that the company cap is not guaranteed to be hit.
     """
 
-    contribution = min(strategy.max_contribution, MAX_PRICE_IRS / (strategy.company_stock_plan.offering_periods * strategy.company_stock_plan.pay_periods_per_offering))
+    contribution = _schedule(strategy, state).proportioned_contribution
     if state.irs_purchased_value + state.dollars_ready_for_purchase + contribution > MAX_PRICE_IRS:
         contribution = MAX_PRICE_IRS - state.dollars_ready_for_purchase - state.irs_purchased_value
     if contribution != 0 and state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in:
@@ -182,19 +300,25 @@ def proportioned_max_both_hard_block(strategy: EmployeeOptions, state: ESPPState
 
     return contribution
 
+def proportioned_max_both_hard_block_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of proportioned_max_both_hard_block.
+    """
+
+    contribution = np.full(state.simulations, float(_schedule(strategy, state).proportioned_contribution))
+    return _both_hard_block_batch(contribution, strategy, state)
+
 def reduce_irs_over_risk(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan is intended to average out the amount you can contribute in each period according to IRS rules, which is 25,000 / the number of offering periods.
         You still may return money from this strategy if the stock price drops, but it will be less than doing a max contribution every period. This is only
         needed if the maximum you can contribute is more than 25,000 per year.
     """
-    if state.period % strategy.company_stock_plan.pay_periods_per_offering == 0:
-        if strategy.max_contribution < (MAX_PRICE_IRS/(strategy.company_stock_plan.pay_periods_per_offering * strategy.company_stock_plan.offering_periods)):
-            contribution = strategy.max_contribution
-        else:
-            contribution = MAX_PRICE_IRS/(strategy.company_stock_plan.pay_periods_per_offering * strategy.company_stock_plan.offering_periods)
+    schedule = _schedule(strategy, state)
+    if schedule.offering_start[state.period]:
+        contribution = schedule.proportioned_contribution
     else:
-        contribution = state.contributions[-1]
+        contribution = state.last_contribution
 
     # If already over on the company, stops. Rarely hits, still a small net negative compared to other strategies.
     if contribution != 0 and state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in:
@@ -202,24 +326,37 @@ def reduce_irs_over_risk(strategy: EmployeeOptions, state: ESPPState):
 
     return contribution
 
+def reduce_irs_over_risk_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of reduce_irs_over_risk.
+    """
+    schedule = _schedule(strategy, state)
+    if schedule.offering_start[state.period]:
+        contribution = np.full(state.simulations, float(schedule.proportioned_contribution))
+    else:
+        contribution = state.last_contribution.copy()
+
+    return _company_hard_block_batch(contribution, strategy, state)
+
 
 def readjust_halfway(strategy: EmployeeOptions, state: ESPPState):
     """
         This plan is to contribute the maximum amount possible for the first offering period, but then readjust the contribution
         to the amount the IRS allows for the second offering period.
     """
+    schedule = _schedule(strategy, state)
     contribution = 0
-    if state.period % strategy.company_stock_plan.pay_periods_per_offering == 0:
+    if schedule.offering_start[state.period]:
         contribution = strategy.max_contribution
     elif (
         # we aren't in the last period
-        state.period < strategy.company_stock_plan.pay_periods_per_offering * (strategy.company_stock_plan.offering_periods - 1)
+        schedule.before_last_offering[state.period]
         and
         # we are halfway through the current offering period
-        state.period % strategy.company_stock_plan.pay_periods_per_offering == strategy.company_stock_plan.pay_periods_per_offering / strategy.company_stock_plan.offering_periods/ 2
+        schedule.halfway_period[state.period]
         and 
-        # the stock price has dropped by X% (todo: parameterize)
-        state.last_grant_price * 0.85 > state.current_stock_price
+        # the stock price has dropped by more than readjust_drop
+        state.last_grant_price * (1 - strategy.strategy_parameters.readjust_drop) > state.current_stock_price
         #and
         # the plan has been funded to 80% of the IRS limit
         # this didn't yield positive results
@@ -227,7 +364,7 @@ def readjust_halfway(strategy: EmployeeOptions, state: ESPPState):
     ):
         contribution = 0
     else:
-        contribution = state.contributions[-1]
+        contribution = state.last_contribution
 
     if state.irs_purchased_value + state.dollars_ready_for_purchase + contribution > MAX_PRICE_IRS:
         contribution = MAX_PRICE_IRS - state.dollars_ready_for_purchase - state.irs_purchased_value
@@ -236,6 +373,28 @@ def readjust_halfway(strategy: EmployeeOptions, state: ESPPState):
 
     return contribution
 
+def readjust_halfway_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of readjust_halfway. The halfway check only depends on the period, so it is shared by all paths,
+        while the price drop check is done per path.
+    """
+    schedule = _schedule(strategy, state)
+    if schedule.offering_start[state.period]:
+        contribution = np.full(state.simulations, float(strategy.max_contribution))
+    else:
+        contribution = state.last_contribution.copy()
+        if schedule.before_last_offering[state.period] and schedule.halfway_period[state.period]:
+            contribution[state.last_grant_price * (1 - strategy.strategy_parameters.readjust_drop) > state.current_stock_price] = 0
+
+    return _both_hard_block_batch(contribution, strategy, state)
+
+def _norm_cdf(x: float) -> float:
+    """
+        Standard normal CDF of a single float, also compiled into the espp_jit_run kernels. scipy's norm.cdf gives
+        the same probabilities but costs microseconds per call in distribution object overhead.
+    """
+    return 0.5 * math.erfc(-x / math.sqrt(2.0))
+
 def maximize_for_large_periods(strategy: EmployeeOptions, state: ESPPState):
     """
         After trial and error, the best returns are those that can capture when a stock dramatically rises.
@@ -269,7 +428,7 @@ def maximize_for_large_periods(strategy: EmployeeOptions, state: ESPPState):
         The probability of the return being one standard deviation above the mean needs to above the linear formula in order to contribute at that level.
         However, according to current stock plans, contributions cannot increase in an offering period.
 
-        Currently, I am arbitrarily using 
+        The default StrategyParameters, originally picked arbitrarily, use
         L1 = 0.32 + 0.63x, where x is the current period number / total periods in offering period.
             This means to contribute at an L1 level, the probability of the return being one standard deviation above the mean needs to be above 0.32 + 0.43 * (current period number / total periods in offering period).
             The last period needs to have a 75% probability of being one standard deviation above the mean to contribute at the L2 level.
@@ -279,36 +438,39 @@ def maximize_for_large_periods(strategy: EmployeeOptions, state: ESPPState):
 
         In the second period, the goal is to contribute as much as possible, with company blocks and IRS blocks still
         in place.
+
+        The intercepts and slopes, the fill factor and the target price are read from strategy.strategy_parameters,
+        and can be tuned with strategy_optimizer.optimize_strategy_parameters.
     """
     contribution = 0
 
-    level_1_contribution = min(strategy.max_contribution, MAX_PRICE_IRS * 2 / (strategy.company_stock_plan.pay_periods_per_offering * strategy.company_stock_plan.offering_periods))
-    level_2_contribution = min(strategy.max_contribution, MAX_PRICE_IRS / (strategy.company_stock_plan.pay_periods_per_offering * strategy.company_stock_plan.offering_periods))
+    schedule = _schedule(strategy, state)
+    level_1_contribution = schedule.level_1_contribution
+    level_2_contribution = schedule.level_2_contribution
 
-    one_std_dev_above = state.last_grant_price + strategy.company_stock_parameters.volatility
-    half_std_dev_above = state.last_grant_price + strategy.company_stock_parameters.volatility / 2
-    quarter_std_dev_above = state.last_grant_price + strategy.company_stock_parameters.volatility / 4
-    
-    std_dev_to_use = half_std_dev_above
+    parameters = strategy.strategy_parameters
+
+    # Half a standard deviation above by default, std_dev_fraction of 1 and 0.25 give one and a quarter standard deviation
+    std_dev_to_use = state.last_grant_price + strategy.company_stock_parameters.volatility * parameters.std_dev_fraction
 
     if state.period == 0:
         contribution = level_1_contribution
-    elif state.period % strategy.company_stock_plan.pay_periods_per_offering == 0:
+    elif schedule.offering_start[state.period]:
         contribution = strategy.max_contribution
     # if not in the last period, however, only planned for 2 periods
-    elif state.period < strategy.company_stock_plan.pay_periods_per_offering * (strategy.company_stock_plan.offering_periods - 1):
-        if state.contributions[-1] in (level_1_contribution, level_2_contribution):
-            current_expected_mean = state.current_stock_price * math.pow((1 + strategy.company_stock_parameters.expected_rate_of_return), state.period / 24) 
-            current_expected_volatility = state.current_stock_price * strategy.company_stock_parameters.volatility * math.sqrt(state.period / 24)
+    elif schedule.before_last_offering[state.period]:
+        if state.last_contribution in (level_1_contribution, level_2_contribution):
+            current_expected_mean = state.current_stock_price * schedule.expected_growth[state.period]
+            current_expected_volatility = state.current_stock_price * schedule.expected_spread[state.period]
 
             normalized_std_dev_goal = (std_dev_to_use - current_expected_mean) / current_expected_volatility
 
             # Calculate the probability
-            probability = 1 - norm.cdf(normalized_std_dev_goal)
+            probability = 1 - _norm_cdf(normalized_std_dev_goal)
 
-            if probability > 0.32 + 0.63 * (state.period / strategy.company_stock_plan.pay_periods_per_offering) and level_1_contribution == state.contributions[-1]:
+            if probability > schedule.level_1_threshold[state.period] and level_1_contribution == state.last_contribution:
                 contribution = level_1_contribution
-            elif probability > 0.32 +  0.43 * (state.period / strategy.company_stock_plan.pay_periods_per_offering) and state.contributions[-1] in (level_1_contribution, level_2_contribution) :
+            elif probability > schedule.level_2_threshold[state.period] and state.last_contribution in (level_1_contribution, level_2_contribution) :
                 contribution = level_2_contribution
             else:
                 # fill out the remaining period so a max contribution can be done in the second period.
@@ -316,10 +478,10 @@ def maximize_for_large_periods(strategy: EmployeeOptions, state: ESPPState):
                 # assumes 1 period
                 # 25000 * discount_rate 
                 potential_contribution = (
-                    (MAX_PRICE_IRS * strategy.company_stock_plan.discount_rate 
-                    - sum(state.contributions)
+                    (schedule.max_pay_in
+                    - state.contributions_sum
                     - (strategy.max_contribution * strategy.company_stock_plan.pay_periods_per_offering))
-                    * 0.9
+                    * parameters.fill_factor
                 ) / (strategy.company_stock_plan.pay_periods_per_offering - state.period)
                 potential_contribution = min(potential_contribution, strategy.max_contribution)
                 if potential_contribution > 0:
@@ -327,13 +489,92 @@ def maximize_for_large_periods(strategy: EmployeeOptions, state: ESPPState):
                 else:
                     contribution = 0
         else:
-            contribution = state.contributions[-1]
+            contribution = state.last_contribution
     else:
-        contribution = state.contributions[-1]
+        contribution = state.last_contribution
     
     if state.irs_purchased_value + state.dollars_ready_for_purchase + contribution > MAX_PRICE_IRS:
         contribution = MAX_PRICE_IRS - state.dollars_ready_for_purchase - state.irs_purchased_value
     if contribution != 0 and state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in:
         contribution = min(contribution, strategy.company_stock_plan.max_pay_in - state.total_contributed)
 
-    return contribution
\ No newline at end of file
+    return contribution
+
+def maximize_for_large_periods_batch(strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Batch version of maximize_for_large_periods. The period checks are shared by all paths, the probability
+        checks are done per path.
+    """
+    schedule = _schedule(strategy, state)
+    level_1_contribution = schedule.level_1_contribution
+    level_2_contribution = schedule.level_2_contribution
+
+    parameters = strategy.strategy_parameters
+    std_dev_to_use = state.last_grant_price + strategy.company_stock_parameters.volatility * parameters.std_dev_fraction
+
+    if state.period == 0:
+        contribution = np.full(state.simulations, float(level_1_contribution))
+    elif schedule.offering_start[state.period]:
+        contribution = np.full(state.simulations, float(strategy.max_contribution))
+    elif schedule.before_last_offering[state.period]:
+        last_contribution = state.last_contribution
+        contribution = last_contribution.copy()
+        eligible = (last_contribution == level_1_contribution) | (last_contribution == level_2_contribution)
+        if eligible.any():
+            current_expected_mean = state.current_stock_price * schedule.expected_growth[state.period]
+            current_expected_volatility = state.current_stock_price * schedule.expected_spread[state.period]
+
+            normalized_std_dev_goal = (std_dev_to_use - current_expected_mean) / current_expected_volatility
+
+            # Calculate the probability, ndtr is the ufunc behind norm.cdf
+            probability = 1 - ndtr(normalized_std_dev_goal)
+
+            level_1 = eligible & (probability > schedule.level_1_threshold[state.period]) & (last_contribution == level_1_contribution)
+            level_2 = eligible & ~level_1 & (probability > schedule.level_2_threshold[state.period])
+            fill = eligible & ~level_1 & ~level_2
+
+            # fill out the remaining period so a max contribution can be done in the second period.
+            potential_contribution = (
+                (schedule.max_pay_in
+                - state.contributions_sum
+                - (strategy.max_contribution * strategy.company_stock_plan.pay_periods_per_offering))
+                * parameters.fill_factor
+            ) / (strategy.company_stock_plan.pay_periods_per_offering - state.period)
+            potential_contribution = np.minimum(potential_contribution, strategy.max_contribution)
+
+            contribution[level_1] = level_1_contribution
+            contribution[level_2] = level_2_contribution
+            contribution[fill] = np.where(potential_contribution > 0, potential_contribution, 0)[fill]
+    else:
+        contribution = state.last_contribution.copy()
+
+    return _both_hard_block_batch(contribution, strategy, state)
+
+
+def _irs_hard_block_batch(contribution, state: ESPPBatchState):
+    """
+        Lowers each path's contribution so the IRS limit is not passed, matching the IRS block in the scalar strategies.
+    """
+    return np.where(
+        state.irs_purchased_value + state.dollars_ready_for_purchase + contribution > MAX_PRICE_IRS,
+        MAX_PRICE_IRS - state.dollars_ready_for_purchase - state.irs_purchased_value,
+        contribution
+    )
+
+def _company_hard_block_batch(contribution, strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Lowers each non-zero contribution so the company max pay in is not passed, matching the company block in the scalar strategies.
+    """
+    max_pay_in_remaining = strategy.company_stock_plan.max_pay_in - state.total_contributed
+    return np.where(
+        (contribution != 0) & (state.total_contributed + contribution > strategy.company_stock_plan.max_pay_in),
+        np.minimum(contribution, max_pay_in_remaining),
+        contribution
+    )
+
+def _both_hard_block_batch(contribution, strategy: EmployeeOptions, state: ESPPBatchState):
+    """
+        Applies the IRS block and then the company block, in the same order as max_both_hard_block.
+    """
+    contribution = _irs_hard_block_batch(contribution, state)
+    return _company_hard_block_batch(contribution, strategy, state)
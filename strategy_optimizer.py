@@ -0,0 +1,173 @@
+"""
+    Tunes the StrategyParameters of a built-in strategy by searching for the values with the best mean or
+    risk adjusted ROI over a fixed set of price paths.
+
+        result = optimize_strategy_parameters(prices, employee_options, strategies.get_all_strategies()[-1])
+        employee_options.strategy_parameters = result.strategy_parameters
+
+    Every candidate is run against the same price paths (common random numbers), so the difference between two
+    candidates is only due to their parameters and not to sampling noise. That also means the tuned parameters
+    can overfit the paths they were tuned on; pass validation_prices generated with another seed to check them.
+"""
+import copy
+import typing as t
+from dataclasses import dataclass, replace
+
+import numpy as np
+from scipy.optimize import differential_evolution
+
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+from models.strategy_parameters import StrategyParameters
+from stock_price import run_strategy
+import strategies
+
+# The StrategyParameters read by each strategy
+STRATEGY_PARAMETERS: t.Dict[t.Callable, t.Tuple[str, ...]] = {
+    strategies.maximize_for_large_periods: (
+        "level_1_intercept",
+        "level_1_slope",
+        "level_2_intercept",
+        "level_2_slope",
+        "fill_factor",
+        "std_dev_fraction"
+    ),
+    strategies.readjust_halfway: ("readjust_drop",),
+}
+
+DEFAULT_BOUNDS: t.Dict[str, t.Tuple[float, float]] = {
+    "level_1_intercept": (0.0, 1.0),
+    "level_1_slope": (0.0, 1.0),
+    "level_2_intercept": (0.0, 1.0),
+    "level_2_slope": (0.0, 1.0),
+    "fill_factor": (0.0, 1.0),
+    "std_dev_fraction": (0.0, 2.0),
+    "readjust_drop": (0.0, 0.5),
+}
+
+
+@dataclass
+class OptimizationResult:
+    """
+        strategy_parameters are the best parameters found, and objective, mean_roi and roi_std their scores on the
+        tuning paths. initial_objective is the score of the parameters the search started from, which are kept
+        if nothing better is found. validation_mean_roi is the mean ROI on the validation paths, if given.
+    """
+    strategy_parameters: StrategyParameters
+    objective: float
+    mean_roi: float
+    roi_std: float
+    initial_objective: float
+    evaluations: int
+    validation_mean_roi: t.Optional[float] = None
+
+
+def roi_objective(espp_result: ESPPResult, objective: str = "mean", risk_aversion: float = 1.0) -> float:
+    """
+        "mean" scores a run by its mean ROI, "risk_adjusted" by its mean ROI minus risk_aversion standard deviations.
+    """
+    if objective == "mean":
+        return espp_result.mean("roi")
+    if objective == "risk_adjusted":
+        return espp_result.mean("roi") - risk_aversion * espp_result.std("roi")
+    raise ValueError(f"unknown objective {objective}, expected 'mean' or 'risk_adjusted'")
+
+
+class StrategyObjective():
+    """
+        The function minimized by the optimizer: runs the strategy with a candidate's parameters over the fixed
+        price paths with the batch engine, and returns the negated score. Counts its evaluations.
+    """
+    def __init__(
+        self,
+        prices: np.ndarray,
+        employee_options: EmployeeOptions,
+        func: t.Dict[str, t.Any],
+        parameters: t.Sequence[str],
+        objective: str = "mean",
+        risk_aversion: float = 1.0,
+        jit: bool = False
+    ):
+        self.prices = prices
+        self.employee_options = employee_options
+        self.func = func
+        self.parameters = tuple(parameters)
+        self.objective = objective
+        self.risk_aversion = risk_aversion
+        self.jit = jit
+        self.evaluations = 0
+
+    def strategy_parameters(self, values: t.Sequence[float]) -> StrategyParameters:
+        return replace(self.employee_options.strategy_parameters, **dict(zip(self.parameters, map(float, values))))
+
+    def run(self, strategy_parameters: StrategyParameters, prices: t.Optional[np.ndarray] = None) -> ESPPResult:
+        candidate_options = copy.copy(self.employee_options)
+        candidate_options.strategy_parameters = strategy_parameters
+        self.evaluations += 1
+        return run_strategy(self.prices if prices is None else prices, candidate_options, self.func, jit=self.jit)
+
+    def __call__(self, values: np.ndarray) -> float:
+        return -roi_objective(self.run(self.strategy_parameters(values)), self.objective, self.risk_aversion)
+
+
+def optimize_strategy_parameters(
+    prices: np.ndarray,
+    employee_options: EmployeeOptions,
+    func: t.Dict[str, t.Any],
+    parameters: t.Optional[t.Sequence[str]] = None,
+    bounds: t.Optional[t.Dict[str, t.Tuple[float, float]]] = None,
+    objective: str = "mean",
+    risk_aversion: float = 1.0,
+    maxiter: int = 50,
+    popsize: int = 15,
+    seed: t.Union[None, int, np.random.Generator] = None,
+    validation_prices: t.Optional[np.ndarray] = None,
+    jit: bool = False
+) -> OptimizationResult:
+    """
+        Searches the parameters of a strategy entry with scipy's differential evolution, starting from
+        employee_options.strategy_parameters.
+
+        parameters: The StrategyParameters fields to tune. Defaults to every field the strategy reads, see STRATEGY_PARAMETERS.
+        bounds: Search range per parameter, overriding DEFAULT_BOUNDS.
+        objective, risk_aversion: How runs are scored, see roi_objective.
+        maxiter, popsize: Differential evolution runs about (maxiter + 1) * popsize * len(parameters) evaluations.
+
+        The strategy's contributions jump when a threshold is crossed, so the ROI is a step function of the parameters.
+        Differential evolution only compares scores, so unlike gradient based methods it is not stuck on the flat steps.
+    """
+    if parameters is None:
+        if func.get("strategy") not in STRATEGY_PARAMETERS:
+            raise ValueError(f"{func.get('name')} has no tunable parameters, pass parameters explicitly")
+        parameters = STRATEGY_PARAMETERS[func["strategy"]]
+    search_bounds = {**DEFAULT_BOUNDS, **(bounds or {})}
+
+    strategy_objective = StrategyObjective(prices, employee_options, func, parameters, objective, risk_aversion, jit)
+    initial_values = [getattr(employee_options.strategy_parameters, name) for name in strategy_objective.parameters]
+    initial_objective = -strategy_objective(np.array(initial_values))
+
+    search = differential_evolution(
+        strategy_objective,
+        [search_bounds[name] for name in strategy_objective.parameters],
+        maxiter=maxiter,
+        popsize=popsize,
+        rng=seed,
+        polish=False,
+        x0=np.clip(initial_values, *np.array([search_bounds[name] for name in strategy_objective.parameters]).T)
+    )
+
+    if -search.fun > initial_objective:
+        best_parameters = strategy_objective.strategy_parameters(search.x)
+    else:
+        best_parameters = employee_options.strategy_parameters
+    best_result = strategy_objective.run(best_parameters)
+
+    return OptimizationResult(
+        strategy_parameters=best_parameters,
+        objective=roi_objective(best_result, objective, risk_aversion),
+        mean_roi=best_result.mean("roi"),
+        roi_std=best_result.std("roi"),
+        initial_objective=initial_objective,
+        evaluations=strategy_objective.evaluations,
+        validation_mean_roi=strategy_objective.run(best_parameters, validation_prices).mean("roi") if validation_prices is not None else None
+    )
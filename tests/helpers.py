@@ -0,0 +1,96 @@
+"""
+    Options and price paths shared by the engine tests.
+"""
+import itertools
+import typing as t
+
+import numpy as np
+
+from espp_scenario_run import ESPPScenarioRun
+from models.company_plan import CompanyStockPlan
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from models.employee_options import EmployeeOptions
+from models.espp_result import ESPPResult
+
+RESULT_COLUMNS = ("baseline_value", "total_value", "money_contributed", "roi", "money_refunded", "espp_return")
+
+# (offering_periods, pay_periods_per_offering) of the plans the engines are compared on
+OFFERING_STRUCTURES = ((2.0, 12.0), (4.0, 6.0))
+
+# max_contribution of 500 never reaches the IRS or company limits, 3000 reaches both
+MAX_CONTRIBUTIONS = (500, 3000)
+
+OPTION_GRID = [
+    {
+        "allows_lookback": allows_lookback,
+        "ignore_liquidity_preference": ignore_liquidity_preference,
+        "max_contribution": max_contribution,
+        "offering_periods": offering_periods,
+        "pay_periods_per_offering": pay_periods_per_offering
+    }
+    for allows_lookback, ignore_liquidity_preference, max_contribution, (offering_periods, pay_periods_per_offering)
+    in itertools.product((True, False), (True, False), MAX_CONTRIBUTIONS, OFFERING_STRUCTURES)
+]
+
+
+def option_grid_id(values: t.Dict[str, t.Any]) -> str:
+    return "lookback={allows_lookback}-ignore_liquidity={ignore_liquidity_preference}-max={max_contribution}-{offering_periods:g}x{pay_periods_per_offering:g}".format(**values)
+
+
+def employee_options(
+    allows_lookback: bool = False,
+    ignore_liquidity_preference: bool = False,
+    max_contribution: float = 1000,
+    offering_periods: float = 2.0,
+    pay_periods_per_offering: float = 12.0
+) -> EmployeeOptions:
+    """
+        The sample CVS options with the plan and the options of the grid changed.
+    """
+    return EmployeeOptions(
+        company_stock_plan=CompanyStockPlan(
+            name='CVS',
+            discount_rate=0.9,
+            offering_periods=offering_periods,
+            pay_periods_per_offering=pay_periods_per_offering,
+            cost_to_sell=7.0,
+            allows_lookback=allows_lookback
+        ),
+        company_stock_parameters=CompanyStockStartParameters(initial_price=80.85, expected_rate_of_return=0.0951, volatility=0.3724),
+        max_contribution=max_contribution,
+        steps_to_zero=0,
+        liquidity_preference_rate=0.05,
+        ignore_liquidity_preference=ignore_liquidity_preference,
+        capital_gains_tax_rate=0.15
+    )
+
+
+def price_matrix(options: EmployeeOptions, simulations: int = 200, seed: int = 0) -> np.ndarray:
+    """
+        Seeded geometric brownian motion paths of the options' stock, one price per pay period plus the start price.
+    """
+    plan = options.company_stock_plan
+    parameters = options.company_stock_parameters
+    steps = int(plan.pay_periods_per_offering * plan.offering_periods)
+    dt = 1 / steps
+    z = np.random.default_rng(seed).standard_normal((simulations, steps))
+    log_returns = (parameters.expected_rate_of_return - 0.5 * parameters.volatility**2) * dt + parameters.volatility * np.sqrt(dt) * z
+    prices = np.empty((simulations, steps + 1))
+    prices[:, 0] = parameters.initial_price
+    prices[:, 1:] = parameters.initial_price * np.exp(np.cumsum(log_returns, axis=1))
+    return prices
+
+
+def scalar_result(prices: np.ndarray, options: EmployeeOptions, step_function: t.Callable, **kwargs) -> ESPPResult:
+    """
+        The reference result, ESPPScenarioRun over each row of prices.
+    """
+    result = ESPPResult()
+    for price in prices:
+        result.add(ESPPScenarioRun(price, options, step_function, **kwargs).run())
+    return result
+
+
+def assert_results_equal(result: ESPPResult, expected: ESPPResult) -> None:
+    for column in RESULT_COLUMNS:
+        assert np.array_equal(getattr(result, column), getattr(expected, column)), column
@@ -0,0 +1,81 @@
+import copy
+
+import numpy as np
+import pytest
+
+from espp_batch_run import ESPPBatchRun
+from helpers import OPTION_GRID, assert_results_equal, employee_options, option_grid_id, price_matrix, scalar_result
+import strategies
+
+STRATEGIES = strategies.get_all_strategies()
+
+# One block for every path, and blocks of 7 that leave a partial block at the end
+BLOCK_SIZES = [10_000, 7]
+
+
+def scaled_after_first_offering_batch(strategy, state):
+    """
+        Contributes max_contribution, scaled by fill_factor from the second offering period on, so changing
+        fill_factor cannot affect the periods before that offering boundary.
+    """
+    contribution = np.full(state.simulations, float(strategy.max_contribution))
+    if state.period >= strategy.company_stock_plan.pay_periods_per_offering:
+        contribution *= strategy.strategy_parameters.fill_factor
+    return contribution
+
+
+@pytest.mark.parametrize("values", OPTION_GRID, ids=option_grid_id)
+@pytest.mark.parametrize("func", STRATEGIES, ids=[func["name"] for func in STRATEGIES])
+def test_batch_run_matches_scenario_run(values, func):
+    options = employee_options(**values)
+    prices = price_matrix(options)
+
+    assert_results_equal(ESPPBatchRun(prices, options, strategies.get_batch_strategy(func)).run(), scalar_result(prices, options, func["strategy"]))
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 10_000])
+def test_block_size_does_not_change_results(block_size):
+    options = employee_options(max_contribution=3000)
+    prices = price_matrix(options)
+    step_function = strategies.maximize_for_large_periods_batch
+
+    assert_results_equal(ESPPBatchRun(prices, options, step_function, block_size=block_size).run(), ESPPBatchRun(prices, options, step_function).run())
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_rerun_with_changed_tax_rate_matches_run(block_size, monkeypatch):
+    options = employee_options(max_contribution=3000)
+    prices = price_matrix(options)
+    step_function = strategies.maximize_for_large_periods_batch
+    run = ESPPBatchRun(prices, options, step_function, block_size=block_size, keep_snapshots=True)
+    original = run.run()
+
+    changed = copy.deepcopy(options)
+    changed.capital_gains_tax_rate = 0.24
+    # Only the results are recomputed, no period is replayed
+    monkeypatch.setattr(ESPPBatchRun, "_run_block", lambda *args, **kwargs: pytest.fail("rerun replayed periods"))
+    rerun = run.rerun(changed)
+    monkeypatch.undo()
+
+    assert_results_equal(rerun, ESPPBatchRun(prices, changed, step_function, block_size=block_size).run())
+    assert rerun != original
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_rerun_from_offering_boundary_matches_run(block_size):
+    options = employee_options(max_contribution=500)
+    prices = price_matrix(options)
+    step_function = scaled_after_first_offering_batch
+    run = ESPPBatchRun(prices, options, step_function, block_size=block_size, keep_snapshots=True)
+    original = run.run()
+
+    changed = copy.deepcopy(options)
+    changed.strategy_parameters.fill_factor = 0.5
+    boundary = int(options.company_stock_plan.pay_periods_per_offering)
+    assert all(boundary in snapshots for snapshots in run.snapshots)
+    rerun = run.rerun(changed, from_period=boundary)
+
+    assert_results_equal(rerun, ESPPBatchRun(prices, changed, step_function, block_size=block_size).run())
+    assert rerun != original
+    # The snapshots are not changed by a rerun
+    assert_results_equal(run.rerun(options, from_period=boundary), original)
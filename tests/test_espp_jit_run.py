@@ -0,0 +1,57 @@
+import importlib.util
+import sys
+
+import pytest
+
+import espp_jit_run
+from espp_jit_run import JIT_STRATEGY_CODES, ESPPJitRun, supports_jit
+from helpers import OPTION_GRID, assert_results_equal, employee_options, option_grid_id, price_matrix, scalar_result
+import strategies
+
+STEP_FUNCTIONS = list(JIT_STRATEGY_CODES)
+
+
+@pytest.fixture(scope="module")
+def fallback_module():
+    """
+        A copy of espp_jit_run loaded as if numba was not installed, running the kernels as plain Python.
+    """
+    with pytest.MonkeyPatch.context() as patch:
+        # None in sys.modules makes the import raise ImportError
+        patch.setitem(sys.modules, "numba", None)
+        spec = importlib.util.spec_from_file_location("espp_jit_run_fallback", espp_jit_run.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("values", OPTION_GRID, ids=option_grid_id)
+@pytest.mark.parametrize("step_function", STEP_FUNCTIONS, ids=[step_function.__name__ for step_function in STEP_FUNCTIONS])
+def test_jit_run_matches_scenario_run(values, step_function):
+    options = employee_options(**values)
+    prices = price_matrix(options)
+
+    assert_results_equal(ESPPJitRun(prices, options, step_function).run(), scalar_result(prices, options, step_function))
+
+
+@pytest.mark.parametrize("values", OPTION_GRID, ids=option_grid_id)
+@pytest.mark.parametrize("step_function", STEP_FUNCTIONS, ids=[step_function.__name__ for step_function in STEP_FUNCTIONS])
+def test_fallback_matches_scenario_run(fallback_module, values, step_function):
+    assert not fallback_module.NUMBA_AVAILABLE
+    options = employee_options(**values)
+    prices = price_matrix(options, simulations=50)
+
+    assert_results_equal(fallback_module.ESPPJitRun(prices, options, step_function).run(), scalar_result(prices, options, step_function))
+
+
+def test_supports_jit():
+    for func in strategies.get_all_strategies():
+        assert supports_jit(func)
+    assert not supports_jit({"name": "user", "strategy": lambda options, state: options.max_contribution})
+    assert not supports_jit({"name": "batch only", "strategy": None, "batch_strategy": strategies.no_contribution_batch})
+
+
+def test_unknown_strategy_is_rejected():
+    options = employee_options()
+    with pytest.raises(ValueError):
+        ESPPJitRun(price_matrix(options), options, lambda options, state: options.max_contribution)
@@ -0,0 +1,86 @@
+import asyncio
+import copy
+
+import pytest
+
+pytest.importorskip("cairo")
+
+from helpers import employee_options
+from simulation_service import SimulationService
+
+STRATEGY = "Maximize for large periods"
+
+
+def service(**kwargs) -> SimulationService:
+    kwargs.setdefault("simulations", 100)
+    kwargs.setdefault("workers", 1)
+    return SimulationService(**kwargs)
+
+
+def test_identical_requests_share_one_run():
+    options = employee_options(max_contribution=3000)
+
+    async def run():
+        async with service(batch_window=0.05) as simulation_service:
+            outcomes = await asyncio.gather(*(simulation_service.simulate(copy.deepcopy(options), [STRATEGY]) for _ in range(3)))
+            return outcomes, simulation_service.statistics
+
+    outcomes, statistics = asyncio.run(run())
+
+    assert outcomes[0] == outcomes[1] == outcomes[2]
+    assert outcomes[0][0].name == STRATEGY
+    assert (statistics.requests, statistics.batches, statistics.engine_runs) == (3, 1, 1)
+
+
+def test_tax_rate_only_requests_share_one_engine_run():
+    options = employee_options(max_contribution=3000)
+    taxed = copy.deepcopy(options)
+    taxed.capital_gains_tax_rate = 0.24
+
+    async def run():
+        async with service(batch_window=0.05) as simulation_service:
+            batched = await asyncio.gather(simulation_service.simulate(options, [STRATEGY]), simulation_service.simulate(taxed, [STRATEGY]))
+            engine_runs = simulation_service.statistics.engine_runs
+            alone = await simulation_service.simulate(taxed, [STRATEGY])
+            return batched, engine_runs, alone
+
+    batched, engine_runs, alone = asyncio.run(run())
+
+    assert engine_runs == 1
+    assert batched[0] != batched[1]
+    # The rerun gives the same outcome as running the options on their own
+    assert batched[1] == alone
+
+
+def test_close_fails_queued_requests():
+    options = employee_options()
+
+    async def run():
+        async with service(batch_window=0, max_batch_size=1) as simulation_service:
+            # The first request takes the only worker, the others wait in the queue
+            requests = [asyncio.create_task(simulation_service.simulate(options, [STRATEGY])) for _ in range(3)]
+            await asyncio.sleep(0.1)
+        with pytest.raises(RuntimeError, match="async context manager"):
+            await simulation_service.simulate(options, [STRATEGY])
+        return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 5)
+
+    first, *queued = asyncio.run(run())
+
+    assert first[0].name == STRATEGY
+    for outcome in queued:
+        assert isinstance(outcome, RuntimeError)
+        assert str(outcome) == "SimulationService closed"
+
+
+def test_close_fails_batch_being_built():
+    options = employee_options()
+
+    async def run():
+        async with service(batch_window=60) as simulation_service:
+            requests = [asyncio.create_task(simulation_service.simulate(options, [STRATEGY])) for _ in range(2)]
+            await asyncio.sleep(0.1)
+        return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 5)
+
+    for outcome in asyncio.run(run()):
+        assert isinstance(outcome, RuntimeError)
+        assert str(outcome) == "SimulationService closed"
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from helpers import employee_options, price_matrix, scalar_result
+from espp_batch_run import ESPPBatchRun
+import strategies
+
+
+def history_strategy(options, state):
+    """
+        A user strategy written against the contribution history, cutting back while little money is held back.
+    """
+    if len(state.contributions) == 0:
+        return options.max_contribution
+    if sum(state.uninvested) < 1000:
+        return max(state.contributions[-1] - 10, 0)
+    return state.contributions[-1]
+
+
+def running_totals_strategy(options, state):
+    """
+        history_strategy written against the running totals.
+    """
+    if state.contributions_count == 0:
+        return options.max_contribution
+    if state.uninvested_sum < 1000:
+        return max(state.last_contribution - 10, 0)
+    return state.last_contribution
+
+
+def test_needs_history():
+    assert not strategies.needs_history(strategies.maximize_for_large_periods)
+    assert strategies.needs_history(history_strategy)
+    assert strategies.needs_history(lambda options, state: state.contributions[-1])
+
+
+def test_history_strategy_runs_through_adapter():
+    options = employee_options(max_contribution=3000)
+    prices = price_matrix(options)
+
+    adapted = ESPPBatchRun(prices, options, strategies.get_batch_strategy({"name": "history", "strategy": history_strategy})).run()
+    totals = ESPPBatchRun(prices, options, strategies.ScalarStrategyAdapter(running_totals_strategy)).run()
+
+    assert adapted == totals
+    assert np.any(adapted.money_contributed != 3000 * 24)
+
+
+def test_keep_history_entry_key():
+    entry = {"name": "totals", "strategy": running_totals_strategy, "keep_history": False}
+    assert not strategies.get_batch_strategy(entry).keep_history
+    assert strategies.get_batch_strategy({"name": "history", "strategy": history_strategy}).keep_history
+
+
+def test_history_strategy_runs_in_scenario_run():
+    options = employee_options(max_contribution=3000)
+    prices = price_matrix(options)
+
+    assert scalar_result(prices, options, history_strategy) == scalar_result(prices, options, running_totals_strategy)
+    assert scalar_result(prices, options, running_totals_strategy, keep_history=False) == scalar_result(prices, options, running_totals_strategy)
+
+
+def test_history_strategy_runs_through_run_strategy():
+    pytest.importorskip("cairo")
+    from stock_price import run_strategy
+
+    options = employee_options(max_contribution=3000)
+    prices = price_matrix(options)
+    entry = {"name": "history", "strategy": history_strategy}
+
+    assert run_strategy(prices, options, entry) == run_strategy(prices, options, entry, batch=False)
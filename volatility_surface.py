@@ -0,0 +1,368 @@
+"""
+    Calibrates the volatility of CompanyStockStartParameters from a market option chain instead of typing it by hand.
+
+        chain = load_option_chain("CVS_options.csv")
+        surface = calibrate_volatility_surface(chain, risk_free_rate=0.04)
+        cvs_stock_params = surface.start_parameters(cvs_stock_plan, expected_rate_of_return=0.0951)
+
+    The implied volatility of every quote is solved at once with stock_calculations.implied_volatilities. Each
+    expiry keeps the smile of its out of the money quotes, and expiries are joined by interpolating the total
+    implied variance w(T) = sigma(T)^2 * T linearly in T. The volatility of pay period i is the forward volatility
+    sqrt((w(t_i) - w(t_i-1)) / dt), given to generate_scenarios as CompanyStockStartParameters.volatility_term_structure.
+
+    calibrate_volatility_surfaces calibrates many tickers in one batch, and can keep the surfaces in a SurfaceCache
+    so a chain that was already calibrated is loaded instead.
+"""
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import typing as t
+from dataclasses import dataclass
+from datetime import date
+
+import numpy as np
+
+from models.company_plan import CompanyStockPlan
+from models.company_stock_start_parameters import CompanyStockStartParameters
+from result_cache import DEFAULT_MAX_BYTES, ResultCache
+from stock_calculations import implied_volatilities
+
+# Bumped whenever a change to the calibration changes the surfaces
+CALIBRATION_VERSION = 1
+
+_OPTION_TYPES = {"call": "call", "c": "call", "put": "put", "p": "put"}
+
+
+@dataclass
+class OptionChain:
+    """
+        Option quotes of one ticker, one entry per quote. expiries are in years from the quote date.
+    """
+    ticker: str
+    underlying_price: float
+    strikes: np.ndarray
+    expiries: np.ndarray
+    option_types: np.ndarray
+    prices: np.ndarray
+
+    def __len__(self) -> int:
+        return self.strikes.shape[0]
+
+
+def load_option_chains(file_name: str, as_of: t.Optional[date] = None) -> t.Dict[str, OptionChain]:
+    """
+        Reads a CSV option chain file, with a header row and one quote per row, into one OptionChain per ticker.
+
+        Columns:
+            ticker: Optional, the file name without extension when missing
+            underlying_price: Price of the stock when the option was quoted
+            strike
+            option_type: call or put, or C or P
+            time_to_expiry: In years, or an expiration column with YYYY-MM-DD dates counted from as_of (today by default)
+            price: Or bid and ask columns, using the mid price
+    """
+    as_of = as_of or date.today()
+    default_ticker = os.path.splitext(os.path.basename(file_name))[0]
+    quotes: t.Dict[str, t.Dict[str, list]] = {}
+
+    with open(file_name, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            row = {name.strip().lower(): value.strip() for name, value in row.items() if name is not None}
+            if "time_to_expiry" in row:
+                expiry = float(row["time_to_expiry"])
+            else:
+                expiry = (date.fromisoformat(row["expiration"]) - as_of).days / 365
+            if "price" in row:
+                price = float(row["price"])
+            else:
+                price = (float(row["bid"]) + float(row["ask"])) / 2
+            option_type = _OPTION_TYPES.get(row["option_type"].lower())
+            if option_type is None:
+                raise ValueError(f"unknown option type {row['option_type']} in {file_name}, expected call or put")
+
+            ticker_quotes = quotes.setdefault(row.get("ticker") or default_ticker, {
+                "underlying_price": [], "strikes": [], "expiries": [], "option_types": [], "prices": []
+            })
+            ticker_quotes["underlying_price"].append(float(row["underlying_price"]))
+            ticker_quotes["strikes"].append(float(row["strike"]))
+            ticker_quotes["expiries"].append(expiry)
+            ticker_quotes["option_types"].append(option_type)
+            ticker_quotes["prices"].append(price)
+
+    return {
+        ticker: OptionChain(
+            ticker=ticker,
+            # Quotes are taken at slightly different times, the median is used as the price of the stock
+            underlying_price=float(np.median(ticker_quotes["underlying_price"])),
+            strikes=np.array(ticker_quotes["strikes"]),
+            expiries=np.array(ticker_quotes["expiries"]),
+            option_types=np.array(ticker_quotes["option_types"]),
+            prices=np.array(ticker_quotes["prices"])
+        )
+        for ticker, ticker_quotes in quotes.items()
+    }
+
+
+def load_option_chain(file_name: str, as_of: t.Optional[date] = None) -> OptionChain:
+    chains = load_option_chains(file_name, as_of)
+    if len(chains) != 1:
+        raise ValueError(f"{file_name} has quotes for {len(chains)} tickers, use load_option_chains")
+    return next(iter(chains.values()))
+
+
+class VolatilitySurface():
+    """
+        Implied volatility by strike and expiry, interpolated from the calibrated smiles.
+
+        expiries: The quoted expiries in years, ascending
+        log_moneyness, volatilities: The smile of each expiry, the implied volatility by log(strike / forward)
+    """
+    def __init__(
+        self,
+        ticker: str,
+        underlying_price: float,
+        risk_free_rate: float,
+        expiries: np.ndarray,
+        log_moneyness: t.List[np.ndarray],
+        volatilities: t.List[np.ndarray]
+    ):
+        self.ticker = ticker
+        self.underlying_price = underlying_price
+        self.risk_free_rate = risk_free_rate
+        self.expiries = expiries
+        self.log_moneyness = log_moneyness
+        self.volatilities = volatilities
+        self.atm_volatilities = np.array([np.interp(0.0, k, vol) for k, vol in zip(log_moneyness, volatilities)])
+        # Total variance can't decrease with expiry without calendar arbitrage, noisy quotes are flattened
+        self._atm_total_variances = np.maximum.accumulate(self.atm_volatilities ** 2 * expiries)
+        self._pay_period_volatilities: t.Dict[t.Tuple[int, float], t.Tuple[float, ...]] = {}
+
+    def _interpolate_total_variance(self, node_variances: np.ndarray, expiry: np.ndarray) -> np.ndarray:
+        """
+            Linear in expiry between the quoted expiries, from 0 at expiry 0, and at the last quoted volatility
+            after the last expiry. node_variances has one row per quoted expiry.
+        """
+        times = np.concatenate([[0.0], self.expiries])
+        variances = np.concatenate([np.zeros((1,) + node_variances.shape[1:]), node_variances])
+        upper = np.clip(np.searchsorted(times, expiry), 1, times.shape[0] - 1)
+        weight = (expiry - times[upper - 1]) / (times[upper] - times[upper - 1])
+        columns = np.arange(expiry.shape[0]) if node_variances.ndim == 2 else None
+        if columns is None:
+            lower_variance, upper_variance = variances[upper - 1], variances[upper]
+        else:
+            lower_variance, upper_variance = variances[upper - 1, columns], variances[upper, columns]
+        interpolated = lower_variance + weight * (upper_variance - lower_variance)
+        extrapolated = upper_variance * expiry / times[-1]
+        return np.where(expiry > times[-1], extrapolated, interpolated)
+
+    def total_variance(self, expiry) -> np.ndarray:
+        """
+            At the money total implied variance sigma^2 * T for each expiry in years.
+        """
+        expiry = np.atleast_1d(np.asarray(expiry, dtype=float))
+        return self._interpolate_total_variance(self._atm_total_variances, expiry)
+
+    def term_structure(self, expiry) -> np.ndarray:
+        """
+            At the money implied volatility for each expiry in years.
+        """
+        expiry = np.atleast_1d(np.asarray(expiry, dtype=float))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = np.sqrt(self.total_variance(expiry) / expiry)
+        # The limit at expiry 0 is the volatility of the first expiry
+        return np.where(expiry > 0, volatility, self.atm_volatilities[0])
+
+    def implied_volatility(self, strike, expiry) -> np.ndarray:
+        """
+            Implied volatility of options by strike and expiry in years, broadcast against each other. The smile is
+            flat past the quoted strikes of an expiry.
+        """
+        strike, expiry = np.broadcast_arrays(np.asarray(strike, dtype=float), np.asarray(expiry, dtype=float))
+        shape = strike.shape
+        strike, expiry = strike.ravel(), expiry.ravel()
+        k = np.log(strike / (self.underlying_price * np.exp(self.risk_free_rate * expiry)))
+        node_variances = np.stack([
+            np.interp(k, smile_k, smile_volatility) ** 2 * node_expiry
+            for node_expiry, smile_k, smile_volatility in zip(self.expiries, self.log_moneyness, self.volatilities)
+        ])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = np.sqrt(self._interpolate_total_variance(node_variances, expiry) / expiry)
+        return volatility.reshape(shape)
+
+    def pay_period_volatilities(self, steps: int, time_frame: float = 1.0) -> t.Tuple[float, ...]:
+        """
+            Forward volatility of each of steps equal periods over time_frame years. Kept per (steps, time_frame),
+            so plans with the same number of pay periods share them.
+        """
+        cache_key = (int(steps), float(time_frame))
+        if cache_key not in self._pay_period_volatilities:
+            times = np.linspace(0, time_frame, steps + 1)
+            forward_variances = np.diff(self.total_variance(times)) / np.diff(times)
+            self._pay_period_volatilities[cache_key] = tuple(np.sqrt(np.maximum(forward_variances, 0)).tolist())
+        return self._pay_period_volatilities[cache_key]
+
+    def start_parameters(
+        self,
+        company_stock_plan: CompanyStockPlan,
+        expected_rate_of_return: float,
+        time_frame: float = 1.0
+    ) -> CompanyStockStartParameters:
+        """
+            CompanyStockStartParameters for generate_scenarios: the volatility of each pay period of the plan,
+            and as volatility, which the strategies use, the at the money implied volatility over time_frame.
+        """
+        steps = int(company_stock_plan.pay_periods_per_offering * company_stock_plan.offering_periods)
+        return CompanyStockStartParameters(
+            initial_price=self.underlying_price,
+            expected_rate_of_return=expected_rate_of_return,
+            volatility=float(self.term_structure(time_frame)[0]),
+            volatility_term_structure=self.pay_period_volatilities(steps, time_frame)
+        )
+
+    def to_arrays(self) -> t.Dict[str, np.ndarray]:
+        return {
+            "ticker": np.array(self.ticker),
+            "parameters": np.array([self.underlying_price, self.risk_free_rate]),
+            "expiries": self.expiries,
+            "smile_sizes": np.array([k.shape[0] for k in self.log_moneyness]),
+            "log_moneyness": np.concatenate(self.log_moneyness),
+            "volatilities": np.concatenate(self.volatilities)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: t.Mapping[str, np.ndarray]) -> 'VolatilitySurface':
+        splits = np.cumsum(arrays["smile_sizes"])[:-1]
+        return cls(
+            ticker=str(arrays["ticker"]),
+            underlying_price=float(arrays["parameters"][0]),
+            risk_free_rate=float(arrays["parameters"][1]),
+            expiries=np.asarray(arrays["expiries"]),
+            log_moneyness=np.split(np.asarray(arrays["log_moneyness"]), splits),
+            volatilities=np.split(np.asarray(arrays["volatilities"]), splits)
+        )
+
+
+def _fit_surface(
+    chain: OptionChain,
+    risk_free_rate: float,
+    volatility: np.ndarray,
+    converged: np.ndarray
+) -> VolatilitySurface:
+    forward = chain.underlying_price * np.exp(risk_free_rate * chain.expiries)
+    log_moneyness = np.log(chain.strikes / forward)
+    # Out of the money quotes are the most liquid and carry the least early exercise and dividend premium
+    out_of_the_money = (chain.option_types == "call") == (chain.strikes >= forward)
+
+    expiries, smiles_k, smiles_volatility = [], [], []
+    for expiry in np.unique(chain.expiries[converged]):
+        at_expiry = converged & (chain.expiries == expiry)
+        if np.any(at_expiry & out_of_the_money):
+            at_expiry &= out_of_the_money
+        order = np.argsort(log_moneyness[at_expiry], kind='stable')
+        expiries.append(expiry)
+        smiles_k.append(log_moneyness[at_expiry][order])
+        smiles_volatility.append(volatility[at_expiry][order])
+    if not expiries:
+        raise ValueError(f"no implied volatility could be solved for any {chain.ticker} quote")
+
+    return VolatilitySurface(chain.ticker, chain.underlying_price, risk_free_rate, np.array(expiries), smiles_k, smiles_volatility)
+
+
+class SurfaceCache(ResultCache):
+    """
+        Size bounded LRU cache of calibrated VolatilitySurfaces, keyed by the content of the option chain and the
+        risk free rate. Defaults to ESPP_SURFACE_CACHE_DIR or ~/.cache/espp_volatility_surfaces.
+    """
+    SUFFIX = '.npz'
+
+    def __init__(self, directory: t.Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        if directory is None:
+            directory = os.environ.get("ESPP_SURFACE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "espp_volatility_surfaces"))
+        super().__init__(directory, max_bytes)
+
+    def key(self, chain: OptionChain, risk_free_rate: float) -> str:
+        digest = hashlib.sha256(json.dumps({
+            "version": CALIBRATION_VERSION,
+            "ticker": chain.ticker,
+            "underlying_price": chain.underlying_price,
+            "risk_free_rate": risk_free_rate
+        }, sort_keys=True).encode('utf-8'))
+        for values in (chain.strikes, chain.expiries, chain.prices):
+            digest.update(np.ascontiguousarray(values, dtype=float).data)
+        digest.update("".join(chain.option_types.tolist()).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> t.Optional[VolatilitySurface]:
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                surface = VolatilitySurface.from_arrays(arrays)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            self._remove(path)
+            return None
+        os.utime(path)
+        return surface
+
+    def put(self, key: str, surface: VolatilitySurface) -> None:
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                np.savez(cache_file, **surface.to_arrays())
+            os.replace(temporary_path, self._path(key))
+        except BaseException:
+            self._remove(temporary_path)
+            raise
+        self.evict()
+
+
+def calibrate_volatility_surfaces(
+    chains: t.Iterable[OptionChain],
+    risk_free_rate: float,
+    cache: t.Optional[SurfaceCache] = None
+) -> t.Dict[str, VolatilitySurface]:
+    """
+        Calibrates the surfaces of many tickers, for example a daily batch job. The quotes of every chain that is
+        not in the cache are solved in a single implied_volatilities call.
+    """
+    surfaces: t.Dict[str, VolatilitySurface] = {}
+    pending: t.List[t.Tuple[OptionChain, t.Optional[str]]] = []
+    for chain in chains:
+        key = cache.key(chain, risk_free_rate) if cache is not None else None
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            surfaces[chain.ticker] = cached
+        else:
+            pending.append((chain, key))
+    if not pending:
+        return surfaces
+
+    solved = implied_volatilities(
+        np.concatenate([np.full(len(chain), chain.underlying_price) for chain, _ in pending]),
+        np.concatenate([chain.strikes for chain, _ in pending]),
+        np.concatenate([chain.expiries for chain, _ in pending]),
+        risk_free_rate,
+        np.concatenate([chain.prices for chain, _ in pending]),
+        np.concatenate([chain.option_types for chain, _ in pending])
+    )
+
+    start = 0
+    for chain, key in pending:
+        stop = start + len(chain)
+        surface = _fit_surface(chain, risk_free_rate, solved.volatility[start:stop], solved.converged[start:stop])
+        if cache is not None:
+            cache.put(key, surface)
+        surfaces[chain.ticker] = surface
+        start = stop
+    return surfaces
+
+
+def calibrate_volatility_surface(
+    chain: OptionChain,
+    risk_free_rate: float,
+    cache: t.Optional[SurfaceCache] = None
+) -> VolatilitySurface:
+    return calibrate_volatility_surfaces([chain], risk_free_rate, cache)[chain.ticker]